@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# 抓取生成Epub流程的性能基准测试
+#
+# 在本地启动一个自动生成的小说测试网站，分别统计目录抓取、章节内容提取、
+# EBook.add_chapter、update_links 及 save_as 各阶段的耗时、吞吐量和内存峰值，
+# 结果可以保存为JSON文件，用于在不同提交之间进行比较：
+#
+#   python benchmark.py --chapters 500 --encoding gbk --json before.json
+#   python benchmark.py --chapters 500 --encoding gbk --compare before.json
+#
+# 使用 --compression 1,6,9 时再对生成的Epub按不同的压缩方式重新打包，比较耗时与文件大小。
+
+import os
+import sys
+import time
+import json
+import random
+import zipfile
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from lib.ebook import EBook
+from lib.downloader import Downloader
+from lib.extractor import TocExtractor, ChapterExtractor
+from lib.package import CompressionPolicy, PackageWriter, zlib_ng
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# 1x1 像素的PNG图片，测试网站的所有图片都使用该内容
+PNG_DATA = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+
+WORDS = '天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜'
+
+
+class FixtureSite():
+    # 自动生成的小说测试网站，页面内容由参数确定，每次生成的结果都相同
+    def __init__(self, chapters=200, page_size=5000, images=1, toc_page_size=100,
+                 chapter_pages=1, volume_size=50, encoding='utf-8', seed=0):
+        self.chapters = chapters
+        self.page_size = page_size
+        self.images = images
+        self.toc_page_size = max(1, toc_page_size)
+        self.chapter_pages = max(1, chapter_pages)
+        self.volume_size = volume_size
+        self.encoding = encoding
+        self.seed = seed
+        self.__pages = {}
+        self.__server = None
+        self.__thread = None
+
+    @property
+    def toc_pages(self):
+        return (self.chapters + self.toc_page_size - 1) // self.toc_page_size
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address[:2]
+        return 'http://{}:{}/'.format(host, port)
+
+    def start(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                result = site.render(self.path)
+                if result is None:
+                    self.send_error(404)
+                    return
+                content_type, data = result
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(
+            target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__server:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def prerender(self):
+        # 预先生成所有页面，避免生成页面的耗时计入抓取阶段
+        for n in range(1, self.toc_pages + 1):
+            self.render('index_%d.html' % n)
+        for chapter in range(1, self.chapters + 1):
+            for page in range(1, self.chapter_pages + 1):
+                self.render('ch/%d_%d.html' % (chapter, page))
+        return self
+
+    def render(self, path):
+        # 根据请求路径生成页面，返回 (Content-Type, 内容) 或 None
+        path = path.split('?')[0].split('#')[0].strip('/')
+        if path not in self.__pages:
+            self.__pages[path] = self.__render(path)
+        return self.__pages[path]
+
+    def __render(self, path):
+        name, ext = os.path.splitext(path)
+        try:
+            if ext == '.png' and name.startswith('img/'):
+                return 'image/png', PNG_DATA
+            if ext != '.html':
+                return None
+            if name.startswith('index_'):
+                html = self.toc_page(int(name[6:]))
+            elif name.startswith('ch/'):
+                chapter, page = name[3:].split('_')
+                html = self.chapter_page(int(chapter), int(page))
+            else:
+                return None
+        except (ValueError, IndexError):
+            return None
+        if html is None:
+            return None
+        return 'text/html; charset=' + self.encoding, html.encode(self.encoding, errors='ignore')
+
+    def page(self, title, body):
+        return ('<!DOCTYPE html>\r\n<html><head><meta charset="{}"><title>{}</title></head>'
+                '<body><div class="header">导航 | 书架 | 排行</div>{}'
+                '<div class="footer">版权所有</div></body></html>').format(self.encoding, title, body)
+
+    def toc_page(self, n):
+        if n < 1 or n > self.toc_pages:
+            return None
+        start = (n - 1) * self.toc_page_size
+        end = min(start + self.toc_page_size, self.chapters)
+        items = []
+        for i in range(start, end):
+            if self.volume_size and i % self.volume_size == 0:
+                items.append('<dt>第 {} 卷</dt>'.format(i // self.volume_size + 1))
+            items.append('<dd><a href="ch/{}_1.html">第 {} 章</a></dd>'.format(i + 1, i + 1))
+        body = '<div id="list"><dl>{}</dl></div>'.format(''.join(items))
+        if n < self.toc_pages:
+            body += '<div class="page"><a href="index_{}.html">下一页</a></div>'.format(n + 1)
+        return self.page('目录', body)
+
+    def chapter_page(self, chapter, page):
+        if chapter < 1 or chapter > self.chapters or page < 1 or page > self.chapter_pages:
+            return None
+        rnd = random.Random('{}-{}-{}'.format(self.seed, chapter, page))
+        paragraphs = []
+        size = 0
+        while size < self.page_size:
+            text = ''.join(rnd.choice(WORDS) for i in range(rnd.randint(40, 160)))
+            paragraphs.append('<p>{}</p>'.format(text))
+            size += len(text)
+        for i in range(self.images):
+            pos = rnd.randint(0, len(paragraphs))
+            paragraphs.insert(pos, '<p><img src="/img/{}_{}_{}.png"/></p>'.format(chapter, page, i))
+        # 增加指向上一章节的超链接，用于测试 update_links
+        if chapter > 1:
+            paragraphs.append('<p><a href="{}_1.html">上一章</a></p>'.format(chapter - 1))
+        body = '<h1>第 {} 章</h1><div id="content">{}</div>'.format(chapter, ''.join(paragraphs))
+        if page < self.chapter_pages:
+            body += '<div class="page"><a href="{}_{}.html">下一页</a></div>'.format(chapter, page + 1)
+        return self.page('第 {} 章'.format(chapter), body)
+
+
+def peak_rss():
+    # 返回进程的内存峰值(MB)，不支持的平台返回 None
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 / 1024
+    return rss / 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Timer():
+    # 记录各阶段的耗时、处理数量及处理字节数
+    def __init__(self):
+        self.phases = []
+
+    def run(self, name, func, *args, count=None, size=None):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        items = count(result) if callable(count) else count
+        nbytes = size(result) if callable(size) else size
+        self.phases.append({
+            'phase': name,
+            'seconds': elapsed,
+            'items': items,
+            'items_per_second': items / elapsed if items and elapsed else None,
+            'mb_per_second': nbytes / elapsed / 1024 / 1024 if nbytes and elapsed else None,
+            'peak_rss_mb': peak_rss(),
+        })
+        return result
+
+
+def run_benchmark(args):
+    site = FixtureSite(chapters=args.chapters, page_size=args.page_size, images=args.images,
+                       toc_page_size=args.toc_page_size, chapter_pages=args.chapter_pages,
+                       encoding=args.encoding)
+    downloader = Downloader(cache=False, retry=1, retry_interval=0)
+    timer = Timer()
+    with site.prerender():
+        book = EBook(author='benchmark', title='benchmark')
+        book.downloader = downloader.get
+
+        def fetch(url):
+            return downloader.get(url, encoding=args.encoding)
+
+        # 与导入章节对话框中填写的选择器相同
+        toc_extractor = TocExtractor(group='#list dt', link='#list dd a', pagination='div.page a')
+        chapter_extractor = ChapterExtractor(title='h1', content='#content p', pagination='div.page a')
+
+        index = site.url + 'index_1.html'
+        toc = timer.run('toc', toc_extractor.chapter_list, fetch, index, index,
+                        count=site.toc_pages)
+        entries = [ch for volume in toc for ch in (volume['child'] or [volume])]
+
+        def extract():
+            return [ch for entry in entries for ch in chapter_extractor.chapters(fetch, entry)]
+        chapters = timer.run('extract', extract, count=len(entries) * site.chapter_pages,
+                             size=lambda r: sum(len(c[1].encode('utf-8')) for c in r))
+
+        def add_chapters():
+            for title, content, url in chapters:
+                book.add_chapter(title=title, content=content, url=url)
+        timer.run('add_chapter', add_chapters, count=len(chapters),
+                  size=sum(len(c[1].encode('utf-8')) for c in chapters))
+        timer.run('update_links', book.update_links, count=len(chapters))
+
+        fd, path = tempfile.mkstemp(suffix='.epub')
+        os.close(fd)
+        try:
+            timer.run('save_as', book.save_as, path, count=len(chapters))
+            epub_size = os.path.getsize(path)
+            compression = compare_compression(path, args.compression) if args.compression else []
+        finally:
+            os.remove(path)
+
+    return {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'params': vars(args).copy(),
+        'chapters': len(chapters),
+        'epub_bytes': epub_size,
+        'phases': timer.phases,
+        'compression': compression,
+    }
+
+
+def compare_compression(path, levels):
+    # 按不同的压缩库、压缩级别及是否压缩媒体文件重新打包生成的Epub，返回耗时与大小
+    with zipfile.ZipFile(path) as z:
+        entries = [(info.filename, z.read(info)) for info in z.infolist()]
+    backends = ['zlib'] + (['zlib-ng'] if zlib_ng else [])
+    result = []
+    fd, out = tempfile.mkstemp(suffix='.epub')
+    os.close(fd)
+    try:
+        for backend in backends:
+            for level in [int(x) for x in levels.split(',') if x.strip()]:
+                for store_media in (True, False):
+                    writer = PackageWriter(out, policy=CompressionPolicy(level, store_media, backend))
+                    start = time.perf_counter()
+                    writer.write(entries)
+                    result.append({
+                        'backend': backend,
+                        'level': level,
+                        'store_media': store_media,
+                        'seconds': time.perf_counter() - start,
+                        'bytes': os.path.getsize(out),
+                    })
+    finally:
+        os.remove(out)
+    return result
+
+
+def merge_runs(runs):
+    # 多次运行时每个阶段取最短耗时
+    result = runs[0]
+    for run in runs[1:]:
+        for best, phase in zip(result['phases'], run['phases']):
+            if phase['seconds'] < best['seconds']:
+                best.update(phase)
+    return result
+
+
+def print_report(result, baseline=None):
+    print('版本: {}  章节数: {}  Epub大小: {:.1f} KB'.format(
+        result['revision'] or '-', result['chapters'], result['epub_bytes'] / 1024))
+    base = {p['phase']: p for p in baseline['phases']} if baseline else {}
+    header = '{:<14}{:>10}{:>12}{:>10}{:>12}'.format('阶段', '耗时(s)', '数量/秒', 'MB/秒', '内存峰值(MB)')
+    if base:
+        header += '{:>12}'.format('对比')
+    print(header)
+    for p in result['phases']:
+        line = '{:<14}{:>10.3f}{:>12}{:>10}{:>12}'.format(
+            p['phase'], p['seconds'],
+            '{:.1f}'.format(p['items_per_second']) if p['items_per_second'] else '-',
+            '{:.2f}'.format(p['mb_per_second']) if p['mb_per_second'] else '-',
+            '{:.1f}'.format(p['peak_rss_mb']) if p['peak_rss_mb'] else '-')
+        if p['phase'] in base and base[p['phase']]['seconds']:
+            line += '{:>+11.1f}%'.format((p['seconds'] / base[p['phase']]['seconds'] - 1) * 100)
+        print(line)
+    print('注：save_as 阶段包含一次 update_links 的耗时。')
+    if result.get('compression'):
+        print()
+        print('{:<10}{:>6}{:>12}{:>10}{:>12}'.format('压缩库', '级别', '媒体文件', '耗时(s)', '大小(KB)'))
+        for c in result['compression']:
+            print('{:<10}{:>6}{:>12}{:>10.3f}{:>12.1f}'.format(
+                c['backend'], c['level'], '不压缩' if c['store_media'] else '压缩',
+                c['seconds'], c['bytes'] / 1024))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Epub电子书生成流程的性能基准测试')
+    parser.add_argument('--chapters', type=int, default=200, help='章节数量')
+    parser.add_argument('--page-size', type=int, default=5000, help='每个章节页面的文字数')
+    parser.add_argument('--images', type=int, default=1, help='每个章节页面的图片数量')
+    parser.add_argument('--toc-page-size', type=int, default=100, help='每个目录分页的章节数')
+    parser.add_argument('--chapter-pages', type=int, default=1, help='每个章节的分页数')
+    parser.add_argument('--encoding', default='utf-8', choices=['utf-8', 'gbk'], help='网页编码')
+    parser.add_argument('--compression', help='比较不同压缩级别的耗时与大小，例如 1,6,9')
+    parser.add_argument('--repeat', type=int, default=1, help='重复运行次数，各阶段取最短耗时')
+    parser.add_argument('--json', help='将结果保存为JSON文件')
+    parser.add_argument('--compare', help='与之前保存的JSON结果进行比较')
+    args = parser.parse_args(argv)
+
+    options = argparse.Namespace(**{k: v for k, v in vars(args).items()
+                                    if k not in ('repeat', 'json', 'compare')})
+    result = merge_runs([run_benchmark(options) for i in range(max(1, args.repeat))])
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, mode='r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, mode='w', encoding='utf-8') as f:
+            json.dump(result, f, indent=4, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,15 @@
 
 import sys
 import os
+import re
 import json
+import queue
+import threading
 
 from PySide6.QtUiTools import QUiLoader
 from PySide6.QtCore import QFile, QIODevice, QMetaObject
-from PySide6.QtCore import Qt, QCoreApplication, Signal, QRegularExpression
-from PySide6.QtGui import QIcon, QTextCursor, QTextDocument
+from PySide6.QtCore import Qt, QCoreApplication, Signal, QRegularExpression, QTimer, QUrl
+from PySide6.QtGui import QIcon, QPixmap, QTextCursor, QTextDocument, QImage, QPixmapCache
 from PySide6.QtWidgets import QApplication, QMainWindow, QTreeWidgetItem
 from PySide6.QtWidgets import QDialog, QFileDialog, QMessageBox
 
@@ -39,11 +42,209 @@ def loadUi(uifile, baseinstance=None):
     return ui
 
 from lib.ebook import EBook
-from lib.downloader import Downloader
+from lib.downloader import Downloader, CACHE_DIR
 from lib.multi_threads import MultiThreads
+from lib.profiler import Profiler
+from lib.journal import CrawlJournal
+from lib.project import Project
+from lib.epub_loader import EpubLoader
+from lib.extractor import TocExtractor, ChapterExtractor
+from lib.cleaner import ContentCleaner
+from lib.replacer import Replacer
+from lib.package import CompressionPolicy
+from lib.history import History, ContentChange, InsertItems, RemoveItems
+from lib.chapter_stats import StatsIndex, chapter_stats
+from lib.dedup import DuplicateDetector, chapter_signature
 
 from pyquery import PyQuery as pq
 from html import escape
+from lxml import etree
+
+
+class ChapterItem(QTreeWidgetItem):
+    # 章节目录节点，章节内容可以在首次访问时才从项目文件中读取；
+    # 章节内容插入或修改时同时更新章节统计索引 index；
+    # anchors 为目录中指向章节内书签的项目 [{'title': 标题, 'fragment': 书签}, ...]
+    def __init__(self, title='', content='', url='', loader=None, index=None, anchors=None):
+        super(ChapterItem, self).__init__()
+        self.setText(0, title)
+        self.url = url
+        self.anchors = anchors or []
+        self.loader = loader
+        self.index = index
+        self.__content = None if loader else content
+        self.__stats = None
+        self.__signature = None
+        if self.__content is not None:
+            self.__updateStats()
+
+    @property
+    def loaded(self):
+        return self.__content is not None
+
+    @property
+    def content(self):
+        if self.__content is None:
+            self.__content = self.loader.load() if self.loader else ''
+            self.__updateStats()
+        return self.__content
+
+    @content.setter
+    def content(self, value):
+        self.__content = value
+        self.__signature = None
+        if value is None:
+            # 内容改为从 loader 读取，统计在下次访问时重新计算
+            self.__stats = None
+            if self.index is not None:
+                self.index.remove(self)
+        else:
+            self.__updateStats()
+
+    @property
+    def stats(self):
+        # 内容还没有读取的章节只统计读取的内容，不将内容保留在内存中
+        if self.__stats is None:
+            if self.__content is None and self.loader:
+                self.__updateStats(self.loader.load())
+            else:
+                self.__updateStats()
+        return self.__stats
+
+    @property
+    def signature(self):
+        # 查找近似重复章节使用的正文签名，需要时才计算，修改内容后重新计算；正文太短时为 None
+        if self.__signature is None:
+            if self.__content is None and self.loader:
+                self.__signature = (chapter_signature(self.loader.load()),)
+            else:
+                self.__signature = (chapter_signature(self.__content),)
+        return self.__signature[0]
+
+    def __updateStats(self, content=None):
+        self.__stats = chapter_stats(self.__content if content is None else content)
+        if self.index is not None:
+            self.index.update(self, self.__stats)
+
+
+class ChapterDocument(QTextDocument):
+    # 章节内容预览文档，图片在后台线程中通过 fetch(url) 下载，下载完成后更新显示，
+    # 所有章节共用 QPixmapCache 中缓存的图片，再次显示时不需要重新下载及解码；
+    # Epub电子书中的图片按电子书区分缓存，不同电子书中相同路径的图片不会混用
+    imageLoaded = Signal(str, str, QImage)
+
+    def __init__(self, parent, fetch, workers=4):
+        super(ChapterDocument, self).__init__(parent)
+        self.fetch = fetch
+        # 下载图片的后台线程为守护线程，退出程序时不需要等待正在进行的下载
+        self.__tasks = queue.Queue()
+        self.__workers = workers
+        for i in range(workers):
+            threading.Thread(target=self.__worker, daemon=True).start()
+        self.__pending = set()
+        self.__failed = set()
+        self.__source = ''     # 当前图片来源电子书的标识
+        self.__placeholder = QPixmap(1, 1)
+        self.__placeholder.fill(Qt.GlobalColor.transparent)
+        # 多个图片下载完成时合并为一次重新排版
+        self.__relayout = QTimer(self)
+        self.__relayout.setSingleShot(True)
+        self.__relayout.setInterval(50)
+        self.__relayout.timeout.connect(lambda: self.markContentsDirty(0, self.characterCount()))
+        self.imageLoaded.connect(self.__imageLoaded)
+
+    @staticmethod
+    def chunks(content, size=64 * 1024):
+        # 将超过 size 的章节内容在段落边界拆分为多段HTML，逐段显示
+        if not content or len(content) <= size:
+            return [content]
+        parser = etree.HTMLParser()
+        try:
+            if re.search(r'<html[\s>]', content, re.I):
+                root = etree.fromstring(content, parser)
+            else:
+                root = etree.fromstring('<html><body>' + content + '</body></html>', parser)
+        except (etree.ParserError, etree.XMLSyntaxError, ValueError):
+            return [content]
+        container = root.find('body') if root is not None else None
+        if container is None:
+            return [content]
+        # 跳过只有一个子元素的外层元素
+        while len(container) == 1 and not (container.text or '').strip() \
+                and not (container[0].tail or '').strip():
+            container = container[0]
+        parts = [escape(container.text or '')]
+        length = len(parts[0])
+        for child in container:
+            html = etree.tostring(child, encoding='unicode', method='html', with_tail=True)
+            if length + len(html) > size and length > 0:
+                parts.append('')
+                length = 0
+            parts[-1] += html
+            length += len(html)
+        return parts if len(parts) > 1 else [content]
+
+    def loadResource(self, type, url):
+        if type != QTextDocument.ResourceType.ImageResource:
+            return super(ChapterDocument, self).loadResource(type, url)
+        key = url.toString()
+        cacheKey = self.__cacheKey(key)
+        pixmap = QPixmapCache.find(cacheKey)
+        if pixmap is None:
+            # 先显示占位图片，下载完成后再替换
+            pixmap = self.__placeholder
+            if cacheKey not in self.__pending and cacheKey not in self.__failed:
+                self.__pending.add(cacheKey)
+                self.__tasks.put((key, cacheKey))
+        self.addResource(type, url, pixmap)
+        return pixmap
+
+    def __cacheKey(self, key):
+        return self.__source + '|' + key if key.startswith('epub:') else key
+
+    def __worker(self):
+        while True:
+            task = self.__tasks.get()
+            if task is None:
+                return
+            self.__load(*task)
+
+    def __load(self, key, cacheKey):
+        # 在后台线程中下载并解码图片
+        try:
+            image = QImage.fromData(self.fetch(key))
+        except Exception:
+            image = QImage()
+        self.imageLoaded.emit(key, cacheKey, image)
+
+    def __imageLoaded(self, key, cacheKey, image):
+        self.__pending.discard(cacheKey)
+        if image.isNull():
+            self.__failed.add(cacheKey)
+            return
+        pixmap = QPixmap.fromImage(image)
+        QPixmapCache.insert(cacheKey, pixmap)
+        if cacheKey == self.__cacheKey(key):
+            # 更换电子书之前开始下载的图片只保存到缓存中，不再显示
+            self.addResource(QTextDocument.ResourceType.ImageResource, QUrl(key), pixmap)
+            self.__relayout.start()
+
+    def reset(self, source=''):
+        # 更换图片来源电子书，source 为电子书的标识；重新下载之前下载失败的图片
+        self.__source = source
+        self.__failed = set()
+        # 清除文档中已经加载的图片资源，重新显示时按新的来源加载
+        self.clear()
+
+    def shutdown(self):
+        # 取消还没有开始的下载并结束后台线程
+        while True:
+            try:
+                self.__tasks.get_nowait()
+            except queue.Empty:
+                break
+        for i in range(self.__workers):
+            self.__tasks.put(None)
 
 
 class DialogImporter(QDialog):
@@ -67,7 +268,13 @@ class DialogImporter(QDialog):
         self.currentChapter = target
         self.chapterList = []
 
-        self.downloader = Downloader().get
+        self.downloader = Downloader.shared().get
+        self.profiler = Profiler(enabled=False)
+        self.cleaner = None
+        self.dedup = None   # 近似重复章节检测器 (lib.dedup.DuplicateDetector)
+        self.journal_dir = './temp/journal'
+        self.journal = None
+        self.projectChapters = set()    # 继续导入时项目中已有章节的标识
 
         self.initUi()
         self.initSignal()
@@ -92,23 +299,10 @@ class DialogImporter(QDialog):
         if filePath:
             self.realUrl.setText('file://'+filePath)
 
-    def query(self, realUrl, referUrl, *args):
-        # 根据查询选择器查询网页中的指定元素
-        content = self.downloader(
-            realUrl, encoding=self.encoding.currentText())
-
-        doc = pq(content, parser='html').make_links_absolute(base_url=referUrl)
-        if len(args) == 0:
-            return doc
-
-        result = []
-        for arg in args:
-            if arg:
-                r = doc(arg)
-                result.append(r)
-            else:
-                result.append([])
-        return tuple(result) if len(result) > 1 else result[0]
+    def fetch(self, url):
+        # 获取网页内容
+        with self.profiler.phase('download', url):
+            return self.downloader(url, encoding=self.encoding.currentText())
 
     def updateProgress(self, title, url):
         self.chapterBrowser.append('已导入章节：'+title+' ('+url+')')
@@ -128,115 +322,123 @@ class DialogImporter(QDialog):
         return html
 
     def fetchChapterList(self):
-        groupSel = self.chapterGroupSelector.text().strip().lower()
-        linkSel = self.chapterLinkSelector.text().strip().lower()
-        pagSel = self.menuPaginationSelector.text().strip().lower()
-        if not linkSel.endswith('a') and linkSel:
-            linkSel = linkSel+' a'
-        if not pagSel.endswith('a') and pagSel:
-            pagSel = pagSel+' a'
-
-        self.chapterList = []
-        parent = self.chapterList
-        child = self.chapterList
+        extractor = TocExtractor(
+            group=self.chapterGroupSelector.text(),
+            link=self.chapterLinkSelector.text(),
+            pagination=self.menuPaginationSelector.text(),
+            profiler=self.profiler)
         realUrl = self.realUrl.text()
-        referUrl = self.referUrl.text()
-        flag = bool(groupSel or linkSel or pagSel)
-        itemSel = groupSel+','+linkSel if groupSel and linkSel else groupSel+linkSel
-        while flag:
-            flag = False
-            try:
-                items, group, links, paginations = self.query(
-                    realUrl, referUrl, itemSel, groupSel, linkSel, pagSel)
-            except Exception as e:
-                QMessageBox.critical(
-                    self, "错误", "无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n\r\n'+e.args[0], QMessageBox.StandardButton.Ok)
-                return
-            for item in items:
-                if item in group:
-                    url = item.attrib['href'] if 'href' in item.attrib else ''
-                    section = {
-                        'title': pq(item).text().strip(),
-                        'realUrl': url,
-                        'referUrl': url,
-                        'child': []
-                    }
-                    parent.append(section)
-                    child = section['child']
-                elif item in links:
-                    if 'href' in item.attrib:
-                        url = item.attrib['href']
-                        child.append({
-                            'title': pq(item).text().strip(),
-                            'realUrl': url,
-                            'referUrl': url,
-                            'child': None
-                        })
-            if paginations and 'href' in paginations[0]:
-                referUrl = paginations[0].attrib['href']
-                realUrl = referUrl
-                flag = True
+        try:
+            self.chapterList = extractor.chapter_list(self.fetch, realUrl, self.referUrl.text())
+        except Exception as e:
+            QMessageBox.critical(
+                self, "错误", "无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n\r\n'+str(e), QMessageBox.StandardButton.Ok)
+            return
         html = self.showChapterList(self.chapterList)
         self.chapterListBrowser.setHtml(html)
 
-    def saveChapter(self, target, data):
-        # 对象选择器
-        titleSel = self.chapterTitleSelector.text().strip().lower()
-        contentSel = self.chapterContentSelector.text().strip().lower()
-        pagSel = self.chapterPaginationSelector.text().strip().lower()
-        itemSel = titleSel+','+contentSel if titleSel and contentSel else titleSel+contentSel
+    def showFetching(self, url):
+        self.chapterBrowser.append('正在抓取网页：'+url)
+        print('正在抓取网页：'+url)
+        QApplication.processEvents()    # 处理窗口事件，避免失去响应
 
-        # 网页地址
+    def saveChapter(self, target, data, source='0'):
+        # 保存章节及其子章节，返回是否全部抓取成功
         title = data['title']
         realUrl = data['realUrl']
-        referUrl = data['referUrl']
-        content = pq('<p></p>')
         if 'child' in data and data['child']:
             print('开始插入新卷:', title)
             self.insertSiblingChapterSignal.emit(target, title, '', realUrl)
             target = self.currentChapter
-            for ch in data['child']:
-                self.saveChapter(target, ch)
-            return
-
-        count = 0
-        flag = True
-        while flag:
-            flag = False
-            try:
-                self.chapterBrowser.append('正在抓取网页：'+realUrl)
-                print('正在抓取网页：'+realUrl)
-                QApplication.processEvents()    # 处理窗口事件，避免失去响应
-                items, titles, contents, paginations = self.query(
-                    realUrl, referUrl, itemSel, titleSel, contentSel, pagSel)
-            except Exception as e:
-                print("无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n'+e.args[0])
-                QMessageBox.critical(
-                    self, "错误", "无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n\r\n'+e.args[0], QMessageBox.StandardButton.Ok)
-                return
-            for item in items:
-                if item in titles:
-                    if count > 0:
-                        print('保存章节：', title)
-                        self.insertChildChapterSignal.emit(
-                            target, title, content.html(), referUrl)
-                        self.insertOneChapter.emit(title or '未命名章节', realUrl)
-                    title = pq(item).text().strip()
-                    content = pq('<p></p>')
-                    count = 0
-                elif item in contents:
-                    content.append(item)
-                    count += 1
-            if paginations and 'href' in paginations[0]:
-                referUrl = paginations[0].attrib['href']
-                realUrl = referUrl
-                flag = True
-
-        if count > 0:
-            print('保存章节：', title)
-            self.insertChildChapterSignal.emit(
-                target, title, content.html(), data['referUrl'])
-            self.insertOneChapter.emit(title or '未命名章节', realUrl)
+            success = True
+            for i, ch in enumerate(data['child']):
+                success = self.saveChapter(target, ch, '{}/{}'.format(source, i)) and success
+            return success
+
+        if self.journal.is_done(source):
+            # 从抓取日志中恢复已完成的章节，上次导入时已经插入项目中的章节不再重复插入
+            chapters = self.journal.chapters(source)
+            if any(self.chapterKey(*chapter) in self.projectChapters for chapter in chapters):
+                self.chapterBrowser.append('已在项目中，跳过章节：'+(title or '未命名章节')+' ('+realUrl+')')
+                return True
+            for title, content, url in chapters:
+                self.insertChapter(target, title, content, url)
+            return True
+
+        extractor = ChapterExtractor(
+            title=self.chapterTitleSelector.text(),
+            content=self.chapterContentSelector.text(),
+            pagination=self.chapterPaginationSelector.text(),
+            profiler=self.profiler,
+            cleaner=self.cleaner)
+        self.journal.begin(source)
+        # 所有分页都抓取成功后才插入章节，抓取失败时不在项目中留下不完整的章节
+        chapters = []
+        try:
+            for title, content, url in extractor.chapters(self.fetch, data, on_page=self.showFetching):
+                print('保存章节：', title)
+                self.journal.add_chapter(source, title, content, url)
+                chapters.append((title, content, url))
+        except Exception as e:
+            print("无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n'+str(e))
+            QMessageBox.critical(
+                self, "错误", "无法获取、解析以下网页内容：\r\n"+realUrl+'\r\n\r\n'+str(e), QMessageBox.StandardButton.Ok)
+            return False
+        self.journal.finish(source)
+        for title, content, url in chapters:
+            self.insertChapter(target, title, content, url)
+        return True
+
+    def insertChapter(self, target, title, content, url):
+        # 插入提取的章节，与本次导入的之前章节近似重复时在导入信息中提示，dedup.skip 时不再插入
+        if self.dedup is not None:
+            name = title or '未命名章节'
+            match = self.dedup.add((len(self.dedup), name), chapter_signature(content))
+            if match is not None:
+                if self.dedup.skip:
+                    self.chapterBrowser.append('跳过与「'+match[1]+'」重复的章节：'+name+' ('+url+')')
+                    return
+                self.chapterBrowser.append('疑似与「'+match[1]+'」重复的章节：'+name+' ('+url+')')
+        self.insertChildChapterSignal.emit(target, title, content, url)
+        self.insertOneChapter.emit(title or '未命名章节', url)
+
+    @staticmethod
+    def chapterKey(title, content, url):
+        # 区分章节的标识：标题、网址及正文的哈希值
+        return (title or '未命名章节', url or '', chapter_stats(content).digest)
+
+    def findProjectChapters(self):
+        # 返回项目中所有章节的标识
+        item = self.root
+        while item.parent() is not None:
+            item = item.parent()
+        chapters = set()
+        items = [item]
+        while items:
+            item = items.pop()
+            if isinstance(item, ChapterItem):
+                chapters.add((item.text(0), item.url or '', item.stats.digest))
+            items.extend(item.child(i) for i in range(item.childCount()))
+        return chapters
+
+    def openJournal(self):
+        # 打开与当前章节列表及选择器对应的抓取日志，存在未完成的导入时询问是否继续
+        key = CrawlJournal.make_key(
+            self.chapterList, self.encoding.currentText(),
+            self.chapterTitleSelector.text().strip().lower(),
+            self.chapterContentSelector.text().strip().lower(),
+            self.chapterPaginationSelector.text().strip().lower(),
+            self.cleaner.signature if self.cleaner else None)
+        self.journal = CrawlJournal(os.path.join(self.journal_dir, key + '.jsonl'))
+        if self.journal.exists:
+            reply = QMessageBox.question(
+                self, '继续导入', '发现上次未完成的导入记录，是否从中断的位置继续导入？',
+                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No, QMessageBox.StandardButton.Yes)
+            if reply == QMessageBox.StandardButton.Yes:
+                self.journal.load()
+                self.projectChapters = self.findProjectChapters()
+            else:
+                self.journal.remove()
 
     def fetchChapter(self):
         if not self.chapterContentSelector.text().strip():
@@ -247,28 +449,44 @@ class DialogImporter(QDialog):
                 'realUrl': self.realUrl.text(),
                 'referUrl': self.referUrl.text(),
             }]
+        self.openJournal()
         count = 0
         total = len(self.chapterList)
         self.progressBar.show()
-        for item in self.chapterList:
-            self.saveChapter(self.root, item)
+        failed = 0
+        for i, item in enumerate(self.chapterList):
+            if not self.saveChapter(self.root, item, str(i)):
+                failed += 1
             count += 1
             self.progressBar.setValue(count*100/total)
-        QMessageBox.information(
-            self, '保存完毕', '所有章节已经保存，按确定关闭当前窗口。', QMessageBox.StandardButton.Ok)
+        if failed:
+            # 保留抓取日志，再次导入时从中断的位置继续
+            self.journal.close()
+            QMessageBox.warning(
+                self, '导入未完成', '有 %d 个章节抓取失败，已保留导入记录，再次导入时可以从中断的位置继续。' % failed,
+                QMessageBox.StandardButton.Ok)
+        else:
+            self.journal.remove()
+            QMessageBox.information(
+                self, '保存完毕', '所有章节已经保存，按确定关闭当前窗口。', QMessageBox.StandardButton.Ok)
         self.importFinishSignal.emit()
         self.cancel()
 
 
 class DialogSetStyle(QDialog):
+    # 保存项目样式表的信号
+    saveStyleSignal = Signal(str)
 
-    def __init__(self, styleFilePath):
+    def __init__(self, styleFilePath, css=None):
         super(DialogSetStyle, self).__init__()
 
         loadUi('ui/setStyle.ui', self)
         self.initSignal()
         self.style_file = styleFilePath
-        if os.path.isfile(self.style_file):
+        self.css = css
+        if self.css is not None:
+            self.styleEditor.setPlainText(self.css)
+        elif os.path.isfile(self.style_file):
             with open(self.style_file, 'r') as f:
                 self.styleEditor.setPlainText(f.read())
 
@@ -277,7 +495,9 @@ class DialogSetStyle(QDialog):
         self.btnCancel.clicked.connect(self.cancel)
 
     def saveStyle(self):
-        if os.path.isfile(self.style_file):
+        if self.css is not None:
+            self.saveStyleSignal.emit(self.styleEditor.toPlainText())
+        elif os.path.isfile(self.style_file):
             with open(self.style_file, 'w') as f:
                 f.write(self.styleEditor.toPlainText())
         self.close()
@@ -331,6 +551,8 @@ class DialogSetConfig(QDialog):
 
 
 class DialogFindReplace(QDialog):
+    # 全部替换完成的信号，参数为 [(章节, 原内容, 新内容), ...]
+    replaceAllSignal = Signal(list)
 
     def __init__(self, editor, epub_tree):
         super(DialogFindReplace, self).__init__()
@@ -343,6 +565,7 @@ class DialogFindReplace(QDialog):
         self.btnFindNext.clicked.connect(self.findNext)
         self.btnReplace.clicked.connect(self.replaceOne)
         self.btnReplaceAll.clicked.connect(self.replaceAll)
+        self.btnPreview.clicked.connect(self.previewReplace)
         self.btnClose.clicked.connect(self.close)
 
     def _collect_chapters(self, item=None):
@@ -395,67 +618,59 @@ class DialogFindReplace(QDialog):
             cursor.insertText(self.replaceText.text())
         self.findNext()
 
-    def _replace_in_html(self, html, search, replacement, use_regex):
-        """用离屏 QTextDocument 做 HTML 感知的查找替换，返回 (new_html, count)"""
-        doc = QTextDocument()
-        doc.setHtml(html)
-        count = 0
-        cursor = QTextCursor(doc)
-
-        if use_regex:
-            regex = QRegularExpression(search)
-            if not regex.isValid():
-                return html, 0
-            cursor = doc.find(regex, cursor)
-            while not cursor.isNull():
-                cursor.insertText(replacement)
-                count += 1
-                cursor = doc.find(regex, cursor)
-        else:
-            cursor = doc.find(search, cursor)
-            while not cursor.isNull():
-                cursor.insertText(replacement)
-                count += 1
-                cursor = doc.find(search, cursor)
-
-        if count > 0:
-            return doc.toHtml(), count
-        return html, 0
-
-    def replaceAll(self):
-        """在所有章节的 HTML 内容中查找并替换"""
+    def _compile_replacer(self):
+        """根据查找内容创建全书替换器，正则表达式有误时提示并返回 None"""
         search = self.findText.text()
         if not search:
+            return None
+        try:
+            return Replacer(search, self.replaceText.text(), self.useRegex.isChecked())
+        except re.error as e:
+            QMessageBox.critical(
+                self, "正则表达式错误", str(e), QMessageBox.StandardButton.Ok)
+            return None
+
+    def previewReplace(self):
+        """预览全部替换，列出每个章节的匹配次数，不修改章节内容"""
+        replacer = self._compile_replacer()
+        if replacer is None:
             return
+        chapters = self._collect_chapters()
+        counts = replacer.count(chapter.content for chapter in chapters)
+        hits = [(chapter, n) for chapter, n in zip(chapters, counts) if n > 0]
+        if not hits:
+            QMessageBox.information(
+                self, "替换预览", "未找到指定内容。",
+                QMessageBox.StandardButton.Ok)
+            return
+        box = QMessageBox(QMessageBox.Icon.Information, "替换预览",
+                          "共 %d 个章节中找到 %d 处。" % (len(hits), sum(n for chapter, n in hits)),
+                          QMessageBox.StandardButton.Ok, self)
+        box.setDetailedText('\n'.join(
+            '%s：%d 处' % (chapter.text(0) or '未命名章节', n) for chapter, n in hits))
+        box.exec()
 
-        use_regex = self.useRegex.isChecked()
-        if use_regex:
-            # 预先校验正则表达式
-            regex = QRegularExpression(search)
-            if not regex.isValid():
-                QMessageBox.critical(
-                    self, "正则表达式错误",
-                    regex.errorString(),
-                    QMessageBox.StandardButton.Ok)
-                return
+    def replaceAll(self):
+        """在所有章节 HTML 内容的文本节点中查找并替换"""
+        replacer = self._compile_replacer()
+        if replacer is None:
+            return
 
         chapters = self._collect_chapters()
+        results = replacer.replace(chapter.content for chapter in chapters)
         total_count = 0
+        changes = []
 
-        for chapter in chapters:
-            content = chapter.content
-            if not content:
-                continue
-
-            new_content, n = self._replace_in_html(
-                content, search, self.replaceText.text(), use_regex)
-
+        for chapter, (new_content, n) in zip(chapters, results):
             if n > 0:
+                changes.append((chapter, chapter.content, new_content))
                 chapter.content = new_content
                 total_count += n
                 # 如果是当前显示的章节，同步更新编辑器
                 if self.epub.currentItem() is chapter:
                     self.editor.setHtml(new_content)
+        if changes:
+            self.replaceAllSignal.emit(changes)
 
         if total_count == 0:
             QMessageBox.information(
@@ -468,6 +683,101 @@ class DialogFindReplace(QDialog):
                 QMessageBox.StandardButton.Ok)
 
 
+class DialogChapterStats(QDialog):
+    # 章节统计：列出所有章节的字数、段落数、图片数及大小，可以按任意列排序，
+    # 也可以只显示正文重复、近似重复或空白的章节，双击章节在主窗口中显示该章节
+    showChapterSignal = Signal(QTreeWidgetItem)
+
+    def __init__(self, epub_tree, index, similarity=0.7):
+        super(DialogChapterStats, self).__init__()
+        loadUi('ui/chapterStats.ui', self)
+        self.epub = epub_tree
+        self.index = index
+        self.similarity = similarity    # 判定为近似重复的最小相似度
+        self.rows = {}      # 统计列表中的行对应的章节 {行: 章节}
+        self.initSignal()
+        self.refresh()
+
+    def initSignal(self):
+        self.filterType.currentIndexChanged.connect(self.refresh)
+        self.chapters.itemDoubleClicked.connect(self.showChapter)
+        self.btnRefresh.clicked.connect(self.refresh)
+        self.btnClose.clicked.connect(self.close)
+
+    def collectChapters(self):
+        # 按目录顺序返回所有章节，内容还没有统计的章节在这里统计
+        result = []
+        stack = [self.epub.root]
+        while stack:
+            item = stack.pop()
+            for i in reversed(range(item.childCount())):
+                stack.append(item.child(i))
+            if isinstance(item, ChapterItem):
+                item.stats
+                result.append(item)
+        return result
+
+    def refresh(self):
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            chapters = self.collectChapters()
+        finally:
+            QApplication.restoreOverrideCursor()
+        filterType = self.filterType.currentIndex()
+        position = {item: n for n, item in enumerate(chapters)}
+        if filterType in (1, 3):
+            if filterType == 1:
+                # 删除后保留在撤销记录中的章节不在目录中，不再显示
+                groups = [[item for item in group if item.treeWidget() is self.epub]
+                          for group in self.index.duplicates()]
+                groups = [group for group in groups if len(group) > 1]
+            else:
+                groups = self.similarChapters(chapters)
+            groups = [sorted(group, key=position.get) for group in groups]
+            groups.sort(key=lambda group: position[group[0]])
+            rows = [(item, n + 1) for n, group in enumerate(groups) for item in group]
+        elif filterType == 2:
+            empties = set(self.index.empties())
+            rows = [(item, 0) for item in chapters if item in empties]
+        else:
+            rows = [(item, 0) for item in chapters]
+
+        self.chapters.setSortingEnabled(False)
+        self.chapters.clear()
+        self.rows = {}
+        for item, group in rows:
+            stats = item.stats
+            row = QTreeWidgetItem(self.chapters)
+            row.setData(0, Qt.ItemDataRole.DisplayRole, position[item] + 1)
+            row.setText(1, item.text(0))
+            values = [stats.chars, stats.paragraphs, stats.images, stats.size, group]
+            for column, value in enumerate(values, 2):
+                row.setData(column, Qt.ItemDataRole.DisplayRole, value)
+            self.rows[row] = item
+        if filterType in (1, 3):
+            # 重复章节按分组排列，同一分组中按目录顺序排列
+            self.chapters.header().setSortIndicator(6, Qt.SortOrder.AscendingOrder)
+        self.chapters.setSortingEnabled(True)
+        self.chapters.resizeColumnToContents(1)
+        self.summary.setText('共 %d 个章节，显示 %d 个，总字数 %d' % (
+            len(chapters), len(rows), sum(item.stats.chars for item in chapters)))
+
+    def similarChapters(self, chapters):
+        # 按签名查找全书中近似重复的章节分组，签名在章节中缓存，再次查找时不需要重新计算
+        detector = DuplicateDetector(similarity=self.similarity)
+        QApplication.setOverrideCursor(Qt.CursorShape.WaitCursor)
+        try:
+            for item in chapters:
+                detector.add(item, item.signature)
+        finally:
+            QApplication.restoreOverrideCursor()
+        return detector.groups()
+
+    def showChapter(self, row, column):
+        if row in self.rows:
+            self.showChapterSignal.emit(self.rows[row])
+
+
 class ApplicationWindow(QMainWindow):
     updateChapterSignal = Signal(QTreeWidgetItem)
 
@@ -477,18 +787,79 @@ class ApplicationWindow(QMainWindow):
         loadUi('ui/mainWindow.ui', self)
         self.cover_path = 'template/cover.jpg'
         self.style_path = 'template/style.css'
+        self.style_css = None       # 项目自带的样式表，为 None 时使用 style_path 模板
         self.config_path = 'config.json'
+        self.package_cache = './temp/package'   # 导出记录，重新导出时复制没有变化的文件
+        self.project = None
+        self.epubSource = None      # 打开的Epub电子书，导出时从中读取原有的图片
+        self.history = History()    # 批量操作的撤销及重做记录
+        self.chapterStats = StatsIndex()    # 所有章节的字数等统计，章节插入或修改时更新
+        self.renderSerial = 0       # 正在逐段显示的章节内容的序号，切换章节时停止显示之前的章节
+        # 章节内容中的图片在后台下载，解码后的图片缓存在内存中
+        QPixmapCache.setCacheLimit(64 * 1024)
+        self.chapterDocument = ChapterDocument(self.chapterContent, self.fetchResource)
+        self.chapterContent.setDocument(self.chapterDocument)
+        # 退出时取消还没有开始的图片下载，避免等待下载完成才能退出
+        QCoreApplication.instance().aboutToQuit.connect(self.chapterDocument.shutdown)
+        self.importedItems = None   # 正在导入时记录插入的章节 {id(章节): (父节点, 章节)}
         # 默认配置值
         self.config = {
             'httpProxyEnable': False,
             'httpProxy': {
                 'http': 'http://127.0.0.1:1080',
                 'https': 'http://127.0.0.1:1080'
+            },
+            # 性能分析：导出电子书时在文件旁边生成 .profile.txt 报告
+            'profile': {
+                'enable': False,
+                'cprofile': False,
+                'tracemalloc': False,
+                'top': 20
+            },
+            # 导入章节时清理内容：删除匹配选择器的元素及匹配通配符的属性，执行替换规则，
+            # filters 为 [{"pattern": 查找内容, "replace": 替换内容, "regex": 是否为正则表达式}, ...]；
+            # 清理会修改导入的章节内容，默认不启用
+            'cleaner': {
+                'enable': False,
+                'removeSelectors': 'script, style, iframe, ins, noscript, object, embed',
+                'stripAttributes': 'style, on*',
+                'filters': [],
+                'normalizeWhitespace': False,
+                'removeEmpty': True
+            },
+            # 导出电子书：deterministic 为可重复生成模式，标识符由书籍来源决定，
+            # 内容不变时生成完全相同的文件且不重新写入；compressLevel 为文本文件的压缩级别，
+            # storeMedia 为图片等已压缩的文件不再压缩，compressor 可选 zlib 或 zlib-ng
+            'build': {
+                'deterministic': False,
+                'compressLevel': 6,
+                'storeMedia': True,
+                'compressor': 'zlib'
+            },
+            # 下载缓存：memorySize 为内存中保留的最近使用文件的总大小(MB)，
+            # compress 为网页等文本文件的压缩方式，可选 zlib、zstd 或 none，
+            # backend 为 files 时每个网址一个缓存文件，为 pack 时追加保存到 temp/pack 中的打包文件，
+            # 可以使用 python -m lib.pack_cache compact 整理打包文件；directory 为缓存目录，为空时使用程序目录中的 temp
+            'cache': {
+                'directory': '',
+                'memorySize': 64,
+                'compress': 'zlib',
+                'backend': 'files'
+            },
+            # 导入章节时检测近似重复的章节：similarity 为判定为重复的最小相似度(0~1)，
+            # skip 为跳过与之前导入的章节重复的章节，否则只在导入信息中提示
+            'dedup': {
+                'enable': True,
+                'similarity': 0.7,
+                'skip': False
             }
         }
 
-        self.__downloader = Downloader()
+        # 所有窗口共用同一个下载器，导入时下载的网页及图片在导出时直接使用缓存
+        self.__downloader = Downloader.shared()
         self.downloader = self.__downloader.get
+        self.profiler = Profiler(enabled=False)
+        self.cleaner = None
 
         self.initUi()
         self.initSignal()
@@ -496,6 +867,7 @@ class ApplicationWindow(QMainWindow):
 
     def initUi(self):
         self.epub.clear()
+        self.chapterStats.clear()
         self.epub.root = QTreeWidgetItem(self.epub)
         self.epub.root.setText(0, self.bookTitle.text())
         self.cover.setIcon(QIcon(self.cover_path))
@@ -506,6 +878,8 @@ class ApplicationWindow(QMainWindow):
         # 菜单项事件信号绑定
         self.actionRemoveChapter.triggered.connect(self.removeChapter)
         self.actionRemoveAllChapters.triggered.connect(self.removeAllChapters)
+        self.actionUndo.triggered.connect(self.undo)
+        self.actionRedo.triggered.connect(self.redo)
         self.actionInsertSiblingChapter.triggered.connect(
             self.insertSiblingChapter)
         self.actionInsertChildChapter.triggered.connect(
@@ -516,9 +890,13 @@ class ApplicationWindow(QMainWindow):
         self.actionClearCache.triggered.connect(self.clearCache)
         self.actionImportChapter.triggered.connect(self.importChapter)
         self.actionSaveAs.triggered.connect(self.saveAs)
+        self.actionOpenProject.triggered.connect(self.openProject)
+        self.actionSaveProject.triggered.connect(self.saveProject)
+        self.actionOpenEpub.triggered.connect(self.openEpub)
         self.actionExit.triggered.connect(QCoreApplication.instance().quit)
         self.actionAboutThis.triggered.connect(self.aboutThis)
         self.actionFindReplace.triggered.connect(self.findReplace)
+        self.actionChapterStats.triggered.connect(self.showChapterStats)
 
         # 封面点击事件绑定
         self.cover.clicked.connect(self.changeCover)
@@ -536,6 +914,8 @@ class ApplicationWindow(QMainWindow):
         # 菜单项事件信号绑定
         self.actionRemoveChapter.triggered.disconnect()
         self.actionRemoveAllChapters.triggered.disconnect()
+        self.actionUndo.triggered.disconnect()
+        self.actionRedo.triggered.disconnect()
         self.actionInsertSiblingChapter.triggered.disconnect()
         self.actionInsertChildChapter.triggered.disconnect()
         self.actionSelectCover.triggered.disconnect()
@@ -544,9 +924,13 @@ class ApplicationWindow(QMainWindow):
         self.actionClearCache.triggered.disconnect()
         self.actionImportChapter.triggered.disconnect()
         self.actionSaveAs.triggered.disconnect()
+        self.actionOpenProject.triggered.disconnect()
+        self.actionSaveProject.triggered.disconnect()
+        self.actionOpenEpub.triggered.disconnect()
         self.actionExit.triggered.disconnect()
         self.actionAboutThis.triggered.disconnect()
         self.actionFindReplace.triggered.disconnect()
+        self.actionChapterStats.triggered.disconnect()
         self.cover.clicked.disconnect()
         self.bookTitle.textChanged.disconnect()
         self.chapterTitle.textChanged.disconnect()
@@ -563,7 +947,11 @@ class ApplicationWindow(QMainWindow):
     def updateConfig(self, config):
         for key, value in config.items():
             if key in self.config:
-                config[key] = value
+                if isinstance(value, dict) and isinstance(self.config[key], dict):
+                    # 合并分组配置，保留配置文件中缺少的新增配置项的默认值
+                    self.config[key].update(value)
+                else:
+                    self.config[key] = value
         self.saveConfig()
 
     def saveConfig(self):
@@ -573,24 +961,46 @@ class ApplicationWindow(QMainWindow):
             self.__downloader.proxies = self.config['httpProxy']
         else:
             self.__downloader.proxies = None
+        cache = self.config['cache']
+        self.__downloader.memory_size = int(cache.get('memorySize', 64) * 1024 * 1024)
+        self.__downloader.compress = cache.get('compress', 'zlib')
+        self.__downloader.backend = cache.get('backend', 'files')
+        self.__downloader.cache_dir = cache.get('directory') or CACHE_DIR
+        profile = self.config['profile']
+        self.profiler.stop()
+        self.profiler = Profiler(enabled=profile.get('enable', False),
+                                 cprofile=profile.get('cprofile', False),
+                                 memory=profile.get('tracemalloc', False),
+                                 top=profile.get('top', 20))
+        try:
+            self.cleaner = ContentCleaner.from_config(self.config['cleaner'])
+        except Exception as e:
+            self.cleaner = None
+            QMessageBox.warning(self, '警告', '内容清理规则有误，导入章节时将不清理内容：\r\n'+str(e),
+                                QMessageBox.StandardButton.Ok)
 
     def clearCache(self):
         reply = QMessageBox.question(self, '清除缓存', '是否清除所有下载的缓存文件（包括所有网页和图片）？',
                                      QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.Cancel, QMessageBox.StandardButton.Cancel)
         if reply == QMessageBox.StandardButton.Yes:
-            tempdir = 'temp/'
-            files = os.listdir(tempdir)
+            tempdir = self.__downloader.cache_dir
+            files = []
+            if os.path.isdir(tempdir):
+                # 使用 scandir 列出文件，判断文件类型时不需要再读取每个文件的信息
+                with os.scandir(tempdir) as entries:
+                    files = [entry.path for entry in entries if entry.is_file(follow_symlinks=False)]
             total = len(files)
             count = 0
             self.statusBar.hide()
             self.progressBar.setValue(0)
             self.progressBar.show()
             for file in files:
-                if os.path.isfile(os.path.join(tempdir, file)):
-                    os.remove(os.path.join(tempdir, file))
+                os.remove(file)
                 count += 1
-                self.progressBar.setValue(count*100/total)
-                QApplication.processEvents()
+                if count % 100 == 0 or count == total:
+                    self.progressBar.setValue(count*100/total)
+                    QApplication.processEvents()
+            self.__downloader.clear_cache()
             self.progressBar.hide()
             self.statusBar.show()
             QMessageBox.information(
@@ -609,12 +1019,55 @@ class ApplicationWindow(QMainWindow):
             self.insertSiblingChapterSlot)
         self.dialogImporter.insertChildChapterSignal.connect(
             self.insertChildChapterSlot)
-        self.dialogImporter.importFinishSignal.connect(self.expandAllChapters)
+        self.dialogImporter.importFinishSignal.connect(self.finishImport)
         self.updateChapterSignal.connect(
             self.dialogImporter.updateCurrentChapter)
         self.dialogImporter.downloader = self.downloader
+        self.importedItems = {}
+        self.dialogImporter.profiler = self.profiler
+        self.dialogImporter.cleaner = self.cleaner
+        self.dialogImporter.dedup = DuplicateDetector.from_config(self.config['dedup'])
         self.dialogImporter.show()
 
+    def finishImport(self):
+        # 导入完成后记录导入的章节，可以一次撤销整个导入操作
+        if self.importedItems:
+            self.history.push(InsertItems('导入章节', list(self.importedItems.values())))
+        self.importedItems = None
+        self.updateHistoryUi()
+        self.expandAllChapters()
+
+    def updateHistoryUi(self):
+        # 刷新撤销及重做菜单项的状态
+        self.actionUndo.setEnabled(self.history.can_undo)
+        self.actionUndo.setText('撤销' + self.history.undo_name)
+        self.actionRedo.setEnabled(self.history.can_redo)
+        self.actionRedo.setText('重做' + self.history.redo_name)
+
+    def clearHistory(self):
+        self.history.clear()
+        self.updateHistoryUi()
+
+    def undo(self):
+        self.refreshHistory(self.history.undo())
+
+    def redo(self):
+        self.refreshHistory(self.history.redo())
+
+    def refreshHistory(self, operation=None):
+        # 撤销或重做后当前章节可能已经从目录中移除，
+        # 只修改章节内容时不需要重新生成根节点显示的目录
+        chapter = self.epub.currentItem()
+        if chapter is None or chapter.treeWidget() is None:
+            self.epub.setCurrentItem(self.epub.root)
+        self.updateHistoryUi()
+        if not (isinstance(operation, ContentChange) and self.epub.currentItem() is self.epub.root):
+            self.refreshChapterUi()
+
+    def replaceAllFinished(self, changes):
+        self.history.change_contents('全部替换', changes)
+        self.updateHistoryUi()
+
     def titleChanged(self, title):
         # 修改电子书标题
         self.epub.root.setText(0, title)
@@ -644,29 +1097,41 @@ class ApplicationWindow(QMainWindow):
             self.cover.setIcon(QIcon(filePath))
 
     def setStyle(self):
-        self.dialogSetStyle = DialogSetStyle(self.style_path)
+        self.dialogSetStyle = DialogSetStyle(self.style_path, css=self.style_css)
+        self.dialogSetStyle.saveStyleSignal.connect(self.updateStyle)
         self.dialogSetStyle.show()
 
+    def updateStyle(self, css):
+        # 修改项目自带的样式表
+        self.style_css = css
+
     def setConfig(self):
         self.dialogSetConfig = DialogSetConfig(self.config)
         self.dialogSetConfig.saveConfigSignal.connect(self.saveConfig)
         self.dialogSetConfig.show()
 
-    def outputChapterList(self, chapter, target=[], root=False):
-        # 将所有章节内容生成为HTML列表
-        count = chapter.childCount()
+    def outputChapterList(self, chapter, target=None, root=False):
+        # 将所有章节内容生成为HTML列表，使用栈遍历所有层级，不受目录嵌套层数的限制
+        if target is None:
+            target = []
         if root:
             target.append('<ol>')
-            for i in range(count):
-                self.outputChapterList(chapter.child(i), target)
-            target.append('</ol>')
-            return target
-        target.append('<li>'+escape(chapter.text(0))+'</li>')
-        if count > 0:
-            target.append('<ol>')
-            for i in range(count):
-                self.outputChapterList(chapter.child(i), target)
-            target.append('</ol>')
+            stack = [(chapter, 0)]
+        else:
+            stack = [(chapter, -1)]
+        while stack:
+            item, index = stack.pop()
+            if index < 0:
+                # 输出章节标题，有子章节时开始下一级列表
+                target.append('<li>'+escape(item.text(0))+'</li>')
+                if item.childCount() > 0:
+                    target.append('<ol>')
+                    stack.append((item, 0))
+            elif index < item.childCount():
+                stack.append((item, index + 1))
+                stack.append((item.child(index), -1))
+            else:
+                target.append('</ol>')
         return target
 
     def chapterClicked(self, item, column):
@@ -674,15 +1139,51 @@ class ApplicationWindow(QMainWindow):
         self.refreshChapterUi()
 
     def chapterContentChanged(self):
-        # 修改章节内容
+        # 修改章节内容，编辑器中已经是修改后的内容，不需要重新显示
         chapter = self.epub.currentItem()
         if chapter is not self.epub.root:
             chapter.content = self.chapterContent.toHtml()
-        self.refreshChapterUi()
+
+    def fetchResource(self, url):
+        # 在后台线程中读取章节内容中的图片，打开的Epub电子书中的图片直接从压缩包读取
+        if self.epubSource and url.startswith('epub:'):
+            return self.epubSource.read(url)
+        return self.downloader(url)
+
+    def renderChapterContent(self, content):
+        # 逐段显示章节内容：超大章节先显示第一段，其余内容在事件循环中依次追加，
+        # 返回是否已经全部显示；全部显示之前编辑器为只读
+        self.renderSerial += 1
+        self.chapterDocument.setUndoRedoEnabled(True)
+        chunks = ChapterDocument.chunks(content)
+        self.chapterContent.setHtml(chunks[0])
+        if len(chunks) == 1:
+            return True
+        self.chapterDocument.setUndoRedoEnabled(False)
+        serial = self.renderSerial
+        QTimer.singleShot(0, lambda: self.appendChapterContent(serial, chunks, 1))
+        return False
+
+    def appendChapterContent(self, serial, chunks, index):
+        if serial != self.renderSerial:
+            return
+        self.chapterContent.blockSignals(True)
+        cursor = QTextCursor(self.chapterDocument)
+        cursor.movePosition(QTextCursor.MoveOperation.End)
+        cursor.insertBlock()
+        cursor.insertHtml(chunks[index])
+        self.chapterContent.blockSignals(False)
+        if index + 1 < len(chunks):
+            QTimer.singleShot(0, lambda: self.appendChapterContent(serial, chunks, index + 1))
+        else:
+            self.chapterDocument.setUndoRedoEnabled(True)
+            self.chapterContent.setReadOnly(False)
 
     def refreshChapterUi(self):
         # 刷新显示章节内容
         self.disableSignal()
+        self.renderSerial += 1
+        self.chapterDocument.setUndoRedoEnabled(True)
         chapter = self.epub.currentItem()
         if chapter:
             self.chapterTitle.setText(chapter.text(0))
@@ -695,10 +1196,10 @@ class ApplicationWindow(QMainWindow):
                 self.chapterContent.setReadOnly(True)
                 self.chapterURL.setReadOnly(True)
             else:
-                self.chapterContent.setHtml(chapter.content)
+                rendered = self.renderChapterContent(chapter.content)
                 self.chapterURL.setText(chapter.url)
                 self.chapterTitle.setReadOnly(False)
-                self.chapterContent.setReadOnly(False)
+                self.chapterContent.setReadOnly(not rendered)
                 self.chapterURL.setReadOnly(False)
         else:
             self.chapterTitle.setText('')
@@ -711,11 +1212,8 @@ class ApplicationWindow(QMainWindow):
 
     def newChapter(self, title=None, content=None, url=None):
         # 创建新的 TreeWidgetItem 章节
-        item = QTreeWidgetItem()
-        item.setText(0, title or '未命名章节')
-        item.content = content or ''
-        item.url = url or ''
-        return item
+        return ChapterItem(title=title or '未命名章节', content=content or '', url=url or '',
+                           index=self.chapterStats)
 
     def insertSiblingChapter(self):
         # 在当前节点插入兄弟章节
@@ -733,10 +1231,9 @@ class ApplicationWindow(QMainWindow):
         if not target:
             target = self.epub.root
         chapter = self.newChapter(title=title, content=content, url=url)
-        if not target.parent():
-            self.epub.root.addChild(chapter)
-        else:
-            target.parent().addChild(chapter)
+        parent = target.parent() or self.epub.root
+        parent.addChild(chapter)
+        self.recordImportedItem(parent, chapter)
         self.updateChapterSignal.emit(chapter)
 
     def insertChildChapter(self):
@@ -752,24 +1249,52 @@ class ApplicationWindow(QMainWindow):
             target = self.epub.root
         chapter = self.newChapter(title=title, content=content, url=url)
         target.addChild(chapter)
+        self.recordImportedItem(target, chapter)
+
+    def recordImportedItem(self, parent, chapter):
+        # 导入时只记录最上层插入的章节，子章节随父节点一起撤销
+        if self.importedItems is not None and id(parent) not in self.importedItems:
+            self.importedItems[id(chapter)] = (parent, chapter)
 
     def removeChapter(self):
         # 删除选择的 TreeWidgetItem 对象
         if self.epub.currentItem() is self.epub.root:
             self.removeAllChapters()
         else:
+            selected = set(id(item) for item in self.epub.selectedItems())
+            items = []
             for item in self.epub.selectedItems():
-                item.parent().removeChild(item)
+                # 父节点同时被删除的章节随父节点一起删除
+                parent = item.parent()
+                while parent is not None and id(parent) not in selected:
+                    parent = parent.parent()
+                if parent is None:
+                    items.append((self.chapterPath(item), item.parent(), item))
+            items.sort(key=lambda x: x[0])
+            self.removeItems('删除章节', [(parent, item) for path, parent, item in items])
+
+    def chapterPath(self, item):
+        # 返回章节在目录中的位置，用于按目录顺序排序
+        path = []
+        while item.parent() is not None:
+            path.insert(0, item.parent().indexOfChild(item))
+            item = item.parent()
+        return path
+
+    def removeItems(self, name, items):
+        # 删除章节并记录到撤销记录中，删除的章节对象保留在撤销记录中
+        operation = RemoveItems(name, items)
+        operation.redo()
+        self.history.push(operation)
+        self.refreshHistory(operation)
 
     def removeAllChapters(self):
         # 删除所有章节内容
         reply = QMessageBox.critical(
             self, "警告", "是否确定要删除所有的章节内容？", QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
         if reply == QMessageBox.StandardButton.Yes:
-            title = self.epub.root.text(0)
-            self.epub.clear()
-            self.epub.root = QTreeWidgetItem(self.epub)
-            self.epub.root.setText(0, title)
+            root = self.epub.root
+            self.removeItems('删除所有章节', [(root, root.child(i)) for i in range(root.childCount())])
 
     def outputChapters(self, chapter, target, root=False):
         # 循环迭代 TreeWidget 的所有 Item 对象
@@ -791,10 +1316,11 @@ class ApplicationWindow(QMainWindow):
                 content = pq(content, parser='html')
         else:
             content = None
+        anchors = getattr(chapter, 'anchors', None)
         if count == 0:
-            target.add_chapter(title=title, content=content, url=url)
+            target.add_chapter(title=title, content=content, url=url, anchors=anchors)
         else:
-            section = target.add_section(title=title, content=content, url=url)
+            section = target.add_section(title=title, content=content, url=url, anchors=anchors)
             for i in range(count):
                 self.outputChapters(chapter=chapter.child(i), target=section)
         return target
@@ -814,7 +1340,16 @@ class ApplicationWindow(QMainWindow):
             book = EBook(title=self.bookTitle.text())
 
             # 设置下载器
-            book.downloader = Downloader().get
+            book.downloader = self.downloader
+            if self.epubSource:
+                book.downloader = self.epubSource.fetcher(book.downloader)
+            book.profiler = self.profiler
+            build = self.config['build']
+            book.deterministic = build.get('deterministic', False)
+            book.compression = CompressionPolicy(level=build.get('compressLevel', 6),
+                                                 store_media=build.get('storeMedia', True),
+                                                 backend=build.get('compressor', 'zlib'))
+            book.package_cache = self.package_cache
 
             # 增加书籍作者
             for author in self.bookAuthor.text().split(','):
@@ -823,7 +1358,9 @@ class ApplicationWindow(QMainWindow):
 
             # 增加封面及页面样式
             book.set_cover(self.cover_path)
-            if os.path.isfile(self.style_path):
+            if self.style_css is not None:
+                book.set_css(self.style_css)
+            elif os.path.isfile(self.style_path):
                 book.set_css(self.style_path)
             self.progressBar.setValue(5)
 
@@ -831,21 +1368,209 @@ class ApplicationWindow(QMainWindow):
             self.outputChapters(chapter=self.epub.root, target=book, root=True)
 
             # 保存为文件
-            book.save_as(filePath)
+            written = book.save_as(filePath)
+            self.profiler.reset()
             self.progressBar.setValue(100)
 
-            QMessageBox.information(
-                self, '保存完毕', '当前书籍内容已保存至以下文件：\r\n'+filePath, QMessageBox.StandardButton.Ok)
+            if written:
+                QMessageBox.information(
+                    self, '保存完毕', '当前书籍内容已保存至以下文件：\r\n'+filePath, QMessageBox.StandardButton.Ok)
+            else:
+                QMessageBox.information(
+                    self, '保存完毕', '书籍内容没有变化，未重新写入以下文件：\r\n'+filePath, QMessageBox.StandardButton.Ok)
         except Exception as e:
             QMessageBox.critical(
                 self, '错误', '保存Epub书籍时出现错误:\r\n'+e.args[0], QMessageBox.StandardButton.Ok)
         self.progressBar.hide()
         self.statusBar.show()
 
+    def openProject(self):
+        # 打开项目文件，只读取目录结构，章节内容在选择章节时才读取
+        filePath, fileType = QFileDialog.getOpenFileName(
+            parent=self, caption="打开项目", filter="Epub Factory Project (*.efproj)")
+        if not filePath:
+            return
+        try:
+            project = Project(filePath)
+            meta = project.meta()
+            nodes = project.nodes()
+        except Exception as e:
+            QMessageBox.critical(
+                self, '错误', '无法打开项目文件:\r\n'+str(e), QMessageBox.StandardButton.Ok)
+            return
+
+        self.disableSignal()
+        self.bookTitle.setText(meta.get('title', ''))
+        self.bookAuthor.setText(meta.get('author', ''))
+        self.style_css = meta.get('css')
+        self.openEpubSource(meta.get('epub'))
+        cover = meta.get('cover', '')
+        if cover:
+            self.setCoverPath(cover)
+
+        self.clearHistory()
+        self.epub.clear()
+        self.chapterStats.clear()
+        self.epub.root = QTreeWidgetItem(self.epub)
+        self.epub.root.setText(0, self.bookTitle.text())
+        items = {}
+        for node_id, parent, title, url, content, anchors in nodes:
+            item = ChapterItem(title=title, url=url, loader=content, index=self.chapterStats, anchors=anchors)
+            (items[parent] if parent else self.epub.root).addChild(item)
+            items[node_id] = item
+        self.epub.expandItem(self.epub.root)
+        self.initSignal()
+
+        if self.project:
+            self.project.close()
+        self.project = project
+        self.refreshChapterUi()
+
+    def openEpubSource(self, path):
+        # 打开作为图片及章节内容来源的Epub电子书
+        if self.epubSource:
+            self.epubSource.close()
+            self.epubSource = None
+        if path and os.path.isfile(path):
+            self.epubSource = EpubLoader(path)
+        self.chapterDocument.reset(self.epubSourceKey())
+
+    def epubSourceKey(self):
+        # 打开的Epub电子书的标识，文件被替换后标识也不同
+        if not self.epubSource:
+            return ''
+        path = os.path.abspath(self.epubSource.path)
+        return '{}:{}'.format(path, os.stat(path).st_mtime_ns)
+
+    def setCoverPath(self, path):
+        # 设置封面图片，支持本地文件或打开的Epub电子书中的图片
+        if self.epubSource and path.startswith('epub:'):
+            pixmap = QPixmap()
+            pixmap.loadFromData(self.epubSource.read(path))
+            self.cover.setIcon(QIcon(pixmap))
+        elif os.path.isfile(path):
+            self.cover.setIcon(QIcon(path))
+        else:
+            return
+        self.cover_path = path
+
+    def openEpub(self):
+        # 打开已有的Epub电子书，章节内容在选择章节时才从电子书中读取
+        filePath, fileType = QFileDialog.getOpenFileName(
+            parent=self, caption="打开Epub电子书", filter="Epub Files (*.epub)")
+        if not filePath:
+            return
+        try:
+            loader = EpubLoader(filePath)
+            chapters = loader.chapters()
+        except Exception as e:
+            QMessageBox.critical(
+                self, '错误', '无法读取Epub电子书:\r\n'+str(e), QMessageBox.StandardButton.Ok)
+            return
+
+        self.disableSignal()
+        if self.epubSource:
+            self.epubSource.close()
+        self.epubSource = loader
+        self.chapterDocument.reset(self.epubSourceKey())
+        if self.project:
+            self.project.close()
+            self.project = None
+        self.bookTitle.setText(loader.title)
+        self.bookAuthor.setText(', '.join(loader.authors))
+        self.style_css = loader.css
+        if loader.cover:
+            self.setCoverPath(loader.cover)
+
+        self.clearHistory()
+        self.epub.clear()
+        self.chapterStats.clear()
+        self.epub.root = QTreeWidgetItem(self.epub)
+        self.epub.root.setText(0, self.bookTitle.text())
+        stack = [(self.epub.root, chapters)]
+        while stack:
+            parent, points = stack.pop()
+            for point in points:
+                item = ChapterItem(title=point['title'], url=point['url'], loader=point['content'],
+                                   index=self.chapterStats, anchors=point['anchors'])
+                parent.addChild(item)
+                stack.append((item, point['child']))
+        self.epub.expandItem(self.epub.root)
+        self.initSignal()
+        self.refreshChapterUi()
+
+    def projectNodes(self):
+        # 按目录顺序返回所有章节节点及对应的 (父节点序号, 标题, 网址, 内容, 书签)
+        nodes = []
+        items = []
+        root = self.epub.root
+        stack = [(root.child(i), None) for i in reversed(range(root.childCount()))]
+        while stack:
+            item, parent = stack.pop()
+            index = len(nodes)
+            content = item.content if item.loaded or not item.loader else item.loader
+            nodes.append((parent, item.text(0), item.url, content, item.anchors))
+            items.append(item)
+            for i in reversed(range(item.childCount())):
+                stack.append((item.child(i), index))
+        return nodes, items
+
+    def saveProject(self):
+        # 将当前电子书保存为项目文件
+        filePath, fileType = QFileDialog.getSaveFileName(
+            parent=self, caption="保存项目", dir=self.project.path if self.project else '',
+            filter="Epub Factory Project (*.efproj)")
+        if not filePath:
+            return
+        css = self.style_css
+        if css is None and os.path.isfile(self.style_path):
+            with open(self.style_path, 'r') as f:
+                css = f.read()
+        meta = {
+            'title': self.bookTitle.text(),
+            'author': self.bookAuthor.text(),
+            'cover': self.cover_path,
+            'css': css or '',
+            'epub': self.epubSource.path if self.epubSource else '',
+        }
+        try:
+            if self.project and os.path.realpath(self.project.path) == os.path.realpath(filePath):
+                project = self.project
+            else:
+                project = Project(filePath)
+            nodes, items = self.projectNodes()
+            contents = project.save(meta, nodes)
+        except Exception as e:
+            QMessageBox.critical(
+                self, '错误', '保存项目文件时出现错误:\r\n'+str(e), QMessageBox.StandardButton.Ok)
+            return
+        # 未读取的章节内容改为从新保存的项目文件中读取
+        for item, content in zip(items, contents):
+            item.loader = content
+        if self.project and self.project is not project:
+            self.project.close()
+        self.project = project
+        self.style_css = css
+        QMessageBox.information(
+            self, '保存完毕', '项目已保存至以下文件：\r\n'+filePath, QMessageBox.StandardButton.Ok)
+
     def findReplace(self):
         self.dialogFindReplace = DialogFindReplace(self.chapterContent, self.epub)
+        self.dialogFindReplace.replaceAllSignal.connect(self.replaceAllFinished)
         self.dialogFindReplace.show()
 
+    def showChapterStats(self):
+        self.dialogChapterStats = DialogChapterStats(
+            self.epub, self.chapterStats, self.config['dedup'].get('similarity', 0.7))
+        self.dialogChapterStats.showChapterSignal.connect(self.showChapter)
+        self.dialogChapterStats.show()
+
+    def showChapter(self, chapter):
+        # 在目录中选择并显示指定的章节
+        self.epub.setCurrentItem(chapter)
+        self.epub.scrollToItem(chapter)
+        self.refreshChapterUi()
+
     def aboutThis(self):
         # self.statusBar.showMessage('关于本软件的说明。',4000)
         QMessageBox.about(self,
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import re
+import html
+from hashlib import sha1
+
+# 统计时忽略的头部、样式及脚本内容
+IGNORED_PATTERN = re.compile(r'<(head|style|script)\b.*?</\1\s*>', re.I | re.S)
+TAG_PATTERN = re.compile(r'<[^>]*>')
+SPACE_PATTERN = re.compile(r'\s+')
+PARAGRAPH_PATTERN = re.compile(r'<p\b', re.I)
+IMAGE_PATTERN = re.compile(r'<img\b', re.I)
+
+
+class ChapterStats():
+    # 章节内容的统计：字数（不含空白字符）、段落数、图片数、HTML字节数及正文文本的哈希值，
+    # 只是格式或空白不同的章节哈希值相同
+    def __init__(self, chars=0, paragraphs=0, images=0, size=0, digest=''):
+        self.chars = chars
+        self.paragraphs = paragraphs
+        self.images = images
+        self.size = size
+        self.digest = digest
+
+    @property
+    def empty(self):
+        return self.chars == 0 and self.images == 0
+
+
+def chapter_text(content):
+    # 返回章节内容中去掉标签及所有空白字符的正文文本
+    return _body_text(IGNORED_PATTERN.sub('', content or ''))
+
+
+def _body_text(body):
+    return SPACE_PATTERN.sub('', html.unescape(TAG_PATTERN.sub('', body)))
+
+
+def chapter_stats(content):
+    # 使用正则表达式统计章节内容，不需要解析整个 HTML 文档
+    content = content or ''
+    body = IGNORED_PATTERN.sub('', content)
+    text = _body_text(body)
+    return ChapterStats(
+        chars=len(text),
+        paragraphs=len(PARAGRAPH_PATTERN.findall(body)),
+        images=len(IMAGE_PATTERN.findall(body)),
+        size=len(content.encode('utf-8')),
+        digest=sha1(text.encode('utf-8')).hexdigest() if text else ''
+    )
+
+
+class StatsIndex():
+    # 章节统计索引，章节插入或修改时更新对应章节的统计，
+    # 同时按正文哈希值分组记录章节，查找重复及空白章节时不需要读取章节内容
+    def __init__(self):
+        self.__stats = {}
+        self.__groups = {}
+        self.__empties = set()
+
+    def __len__(self):
+        return len(self.__stats)
+
+    def __contains__(self, key):
+        return key in self.__stats
+
+    def get(self, key):
+        return self.__stats.get(key)
+
+    def update(self, key, stats):
+        self.remove(key)
+        self.__stats[key] = stats
+        if stats.empty:
+            self.__empties.add(key)
+        elif stats.digest:
+            self.__groups.setdefault(stats.digest, set()).add(key)
+
+    def remove(self, key):
+        stats = self.__stats.pop(key, None)
+        if stats is None:
+            return
+        self.__empties.discard(key)
+        group = self.__groups.get(stats.digest)
+        if group is not None:
+            group.discard(key)
+            if not group:
+                del self.__groups[stats.digest]
+
+    def clear(self):
+        self.__stats = {}
+        self.__groups = {}
+        self.__empties = set()
+
+    def duplicates(self):
+        # 返回正文内容相同的章节分组 [[章节, ...], ...]
+        return [list(group) for group in self.__groups.values() if len(group) > 1]
+
+    def empties(self):
+        return list(self.__empties)
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import re
+import fnmatch
+from lxml import etree
+
+from cssselect import SelectorError
+
+from lib.extractor import compile_selector, compile_self_selector
+
+# 不包含任何文本也不能删除的元素
+_media_tags = {'img', 'image', 'svg', 'video', 'audio', 'source', 'track', 'picture', 'canvas',
+               'object', 'embed', 'iframe', 'hr', 'math'}
+# 没有内容时可以删除的段落及排版元素，表格单元格、链接锚点等其它元素即使为空也保留
+_empty_tags = {'p', 'div', 'span', 'font'}
+_spaces = re.compile(r'\s+')
+# 正则表达式中按编号引用分组的位置，合并规则后分组编号会改变
+_numbered_reference = re.compile(r'\\[1-9]|\(\?\(\d')
+
+
+class ContentCleaner():
+    # 章节内容清理器，在导入章节时对每个章节的内容只执行一次，依次：
+    #   1. 删除匹配黑名单选择器的元素（广告、脚本、样式等），保留元素之后的文本
+    #   2. 删除匹配名称通配符的属性（内联样式、事件处理等）
+    #   3. 对所有文本节点执行替换规则（水印文字等），连续的规则合并为一个正则表达式一次匹配
+    #   4. 压缩连续的空白字符
+    #   5. 删除没有文本及图片的空段落（p、div、span、font），带有 id 或 name 的元素可能是链接目标，不删除
+    # 选择器、属性通配符及替换规则都在创建时预先编译。
+    def __init__(self, remove_selectors='', strip_attributes='', filters=None,
+                 normalize_whitespace=False, remove_empty=True):
+        # filters 为 [{'pattern': 查找内容, 'replace': 替换内容, 'regex': 是否为正则表达式}, ...]
+        remove_selectors = remove_selectors.strip()
+        # 清理规则的描述，用于区分不同清理规则下的抓取日志
+        self.signature = [remove_selectors, strip_attributes, filters or [], normalize_whitespace, remove_empty]
+        self.__remove = compile_selector(remove_selectors) if remove_selectors else None
+        try:
+            # 内容元素位于黑名单元素之中时也需要删除
+            self.__removed = compile_self_selector(
+                remove_selectors, 'ancestor-or-self') if remove_selectors else None
+        except (SelectorError, NotImplementedError):
+            self.__removed = None
+        patterns = [fnmatch.translate(name.strip().lower())
+                    for name in strip_attributes.split(',') if name.strip()]
+        self.__attributes = re.compile('|'.join(patterns)) if patterns else None
+        self.__filters = []
+        for item in filters or []:
+            pattern = item.get('pattern', '')
+            if not pattern:
+                continue
+            replace = item.get('replace', '')
+            if not item.get('regex', False):
+                pattern = re.escape(pattern)
+                replace = replace.replace('\\', r'\\')
+            self.__filters.append((re.compile(pattern), replace))
+        self.__steps = self.__combine(self.__filters)
+        self.normalize_whitespace = normalize_whitespace
+        self.remove_empty = remove_empty
+
+    @classmethod
+    def from_config(cls, config):
+        # 根据配置文件中的 cleaner 配置创建清理器，未启用时返回 None
+        if not config or not config.get('enable', False):
+            return None
+        return cls(remove_selectors=config.get('removeSelectors', ''),
+                   strip_attributes=config.get('stripAttributes', ''),
+                   filters=config.get('filters', []),
+                   normalize_whitespace=config.get('normalizeWhitespace', False),
+                   remove_empty=config.get('removeEmpty', True))
+
+    @staticmethod
+    def __combine(filters):
+        # 将连续的替换规则合并为一个正则表达式，每个规则对应一个命名分组，返回 [(正则表达式, 替换内容), ...]。
+        # 合并后分组的编号会改变，使用编号引用分组（\1、(?(1)...)）的规则单独执行替换；
+        # 规则之间有冲突（例如重复的分组名称）时逐个规则执行替换
+        steps = []
+        batch = []
+
+        def flush():
+            if len(batch) > 1:
+                try:
+                    regex = re.compile('|'.join('(?P<_f%d>%s)' % (i, item[0].pattern)
+                                                for i, item in enumerate(batch)))
+                    steps.append((regex, ContentCleaner.__replacer(list(batch))))
+                except re.error:
+                    steps.extend(batch)
+            else:
+                steps.extend(batch)
+            batch.clear()
+
+        for item in filters:
+            if item[0].groups and _numbered_reference.search(item[0].pattern):
+                flush()
+                steps.append(item)
+            else:
+                batch.append(item)
+        flush()
+        return steps
+
+    @staticmethod
+    def __replacer(filters):
+        def replace(match):
+            # 找到匹配的规则，在原位置重新匹配以正确展开替换内容中的分组引用
+            regex, replace = filters[int(match.lastgroup[2:])]
+            return regex.match(match.string, match.start()).expand(replace)
+        return replace
+
+    def clean_text(self, text):
+        if not text:
+            return text
+        for regex, replace in self.__steps:
+            text = regex.sub(replace, text)
+        if self.normalize_whitespace:
+            text = _spaces.sub(' ', text)
+        return text
+
+    def is_empty(self, el):
+        # 没有文本、图片等媒体元素及链接目标的段落为空元素
+        if el.tag not in _empty_tags or el.text_content().strip():
+            return False
+        for node in el.iter():
+            if node.tag in _media_tags or node.get('id') is not None or node.get('name') is not None:
+                return False
+        return True
+
+    def clean(self, el):
+        # 清理元素及其所有子元素，直接修改元素本身并返回该元素，
+        # 元素本身需要删除（匹配黑名单或为空元素）时返回 None
+        if self.__removed is not None and self.__removed(el):
+            return None
+        if self.__remove is not None:
+            for child in self.__remove(el):
+                if child is el:
+                    return None
+                if child.getparent() is not None:
+                    child.drop_tree()
+        # 删除注释及处理指令，保留之后的文本
+        for node in list(el.iterdescendants(etree.Comment, etree.ProcessingInstruction)):
+            node.drop_tree()
+        filters = self.__filters or self.normalize_whitespace
+        for node in el.iter():
+            if self.__attributes is not None:
+                for name in node.attrib.keys():
+                    if self.__attributes.match(name.lower()):
+                        del node.attrib[name]
+            if filters and node.tag != 'pre':
+                node.text = self.clean_text(node.text)
+                node.tail = self.clean_text(node.tail)
+        if self.remove_empty:
+            # 从最深的元素开始删除，删除子元素后父元素也可能变为空元素
+            for node in reversed(list(el.iterdescendants())):
+                if self.is_empty(node):
+                    node.drop_tree()
+            if self.is_empty(el):
+                return None
+        return el
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import zlib
+from array import array
+from bisect import bisect_left
+
+from lib.chapter_stats import chapter_text
+
+# 正文少于 MIN_CHARS 个字符的章节签名不可靠，不参与近似重复检测
+MIN_CHARS = 50
+# 签名分为 BANDS 段，每段 ROWS 个最小哈希值
+BANDS = 32
+ROWS = 4
+SIGNATURE_SIZE = BANDS * ROWS
+HASH_BITS = 32
+HASH_MASK = (1 << HASH_BITS) - 1
+BIN_SHIFT = HASH_BITS - (SIGNATURE_SIZE.bit_length() - 1)
+
+
+def minhash(text, shingle=3):
+    # 计算正文的 MinHash 签名：每 shingle 个连续字符作为一个特征，
+    # 特征哈希值的高位决定所在的分箱，签名为每个分箱中最小的哈希值（单次哈希的 MinHash），
+    # 两个签名中相同值的比例接近两段正文特征集合的 Jaccard 相似度。
+    # 排序及二分查找都在 C 代码中完成，每个特征只需要计算一次哈希值；签名保存为紧凑的 32 位整数数组
+    features = {text[i:i + shingle] for i in range(max(len(text) - shingle + 1, 1))}
+    hashes = sorted(_mix(h) for h in map(zlib.crc32, (feature.encode('utf-8') for feature in features)))
+    signature = [None] * SIGNATURE_SIZE
+    for i in range(SIGNATURE_SIZE):
+        index = bisect_left(hashes, i << BIN_SHIFT)
+        if index < len(hashes) and hashes[index] >> BIN_SHIFT == i:
+            signature[i] = hashes[index] & ((1 << BIN_SHIFT) - 1)
+    # 短文本的空分箱使用右侧第一个非空分箱的值，加上距离以免与该分箱相同
+    filled = [i for i, value in enumerate(signature) if value is not None]
+    if not filled:
+        return array('I', [0] * SIGNATURE_SIZE)
+    for i in range(SIGNATURE_SIZE):
+        if signature[i] is None:
+            j = filled[bisect_left(filled, i) % len(filled)]
+            signature[i] = signature[j] + ((j - i) % SIGNATURE_SIZE << BIN_SHIFT)
+    return array('I', signature)
+
+
+def _mix(value):
+    # CRC32 的各位分布不够均匀，乘法散列后再混合高低位
+    value = (value * 0x9e3779b1) & HASH_MASK
+    return value ^ (value >> 16)
+
+
+def text_signature(text):
+    # 返回正文的签名，正文太短时返回 None
+    return minhash(text) if len(text) >= MIN_CHARS else None
+
+
+def chapter_signature(content):
+    # 返回章节内容HTML的签名，只使用去掉标签及空白字符后的正文
+    return text_signature(chapter_text(content))
+
+
+def similarity(a, b):
+    # 两个签名估算的 Jaccard 相似度
+    return sum(x == y for x, y in zip(a, b)) / SIGNATURE_SIZE
+
+
+class DuplicateDetector():
+    # 近似重复章节检测，similarity 为判定为重复的最小相似度。
+    # 签名按 LSH 分段建立索引，至少有一段完全相同的章节才计算相似度，
+    # 检测全书的时间与章节数接近线性。
+    # skip 为导入时是否跳过与之前章节重复的章节，否则只记录重复的章节
+    def __init__(self, similarity=0.7, skip=False):
+        self.similarity = similarity
+        self.skip = skip
+        self.__tables = [{} for i in range(BANDS)]
+        self.__signatures = {}
+        self.__parents = {}
+
+    @classmethod
+    def from_config(cls, config):
+        # 根据配置文件中的 dedup 配置创建检测器，未启用时返回 None
+        if not config or not config.get('enable', False):
+            return None
+        return cls(similarity=config.get('similarity', 0.7), skip=config.get('skip', False))
+
+    def __len__(self):
+        return len(self.__signatures)
+
+    @staticmethod
+    def __bands(signature):
+        return [signature[i * ROWS:(i + 1) * ROWS].tobytes() for i in range(BANDS)]
+
+    def matches(self, signature):
+        # 返回与签名近似的所有章节 [(相似度, 章节), ...]，按添加顺序排列
+        seen = set()
+        result = []
+        for table, band in zip(self.__tables, self.__bands(signature)):
+            for key in table.get(band, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                value = similarity(signature, self.__signatures[key])
+                if value >= self.similarity:
+                    result.append((value, key))
+        return result
+
+    def add(self, key, signature):
+        # 添加章节，返回之前添加的最相似的章节，没有近似章节或签名为 None 时返回 None
+        if signature is None or key in self.__signatures:
+            return None
+        matches = self.matches(signature)
+        self.__signatures[key] = signature
+        for table, band in zip(self.__tables, self.__bands(signature)):
+            table.setdefault(band, []).append(key)
+        self.__parents[key] = key
+        for value, other in matches:
+            self.__union(other, key)
+        return max(matches, key=lambda match: match[0])[1] if matches else None
+
+    def __find(self, key):
+        parents = self.__parents
+        while parents[key] != key:
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def __union(self, a, b):
+        a, b = self.__find(a), self.__find(b)
+        if a != b:
+            self.__parents[b] = a
+
+    def groups(self):
+        # 返回近似重复的章节分组 [[章节, ...], ...]，每组按添加顺序排列
+        groups = {}
+        for key in self.__signatures:
+            groups.setdefault(self.__find(key), []).append(key)
+        return [group for group in groups.values() if len(group) > 1]
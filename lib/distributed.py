@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import zlib
+import socket
+import sqlite3
+import argparse
+import traceback
+import multiprocessing
+
+from lib.downloader import Downloader
+from lib.scheduler import BookJob
+
+
+class TaskQueue():
+    # 保存在 SQLite 数据库中的章节抓取任务队列，多个抓取进程从中领取章节任务，
+    # 提取的章节内容压缩后写回数据库，由一个汇总进程按目录顺序生成电子书。
+    # 领取任务时在写事务中标记任务及租约到期时间，抓取进程中断后租约到期的任务可以被重新领取。
+    # 默认只用于同一台机器上的多个进程，使用 WAL 日志模式（需要进程间共享内存）；
+    # 多台机器通过网络文件系统共享数据库文件时需要指定 shared，改用 DELETE 日志模式，
+    # 此时依赖网络文件系统的文件锁，文件锁不可靠的文件系统（例如部分 NFS 配置）上仍可能损坏数据库。
+    def __init__(self, path, lease=300, max_attempts=3, shared=False):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.shared = shared
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        if shared:
+            self.db.execute('PRAGMA journal_mode=DELETE')
+            self.db.execute('PRAGMA synchronous=FULL')
+        else:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS books ('
+                            'id INTEGER PRIMARY KEY, name TEXT, spec TEXT, chapter_list TEXT, '
+                            "state TEXT DEFAULT 'crawling', error TEXT DEFAULT '')")
+            self.db.execute('CREATE TABLE IF NOT EXISTS tasks ('
+                            'id INTEGER PRIMARY KEY, book INTEGER, source TEXT, item TEXT, '
+                            "state TEXT DEFAULT 'pending', worker TEXT, lease REAL DEFAULT 0, "
+                            "attempts INTEGER DEFAULT 0, result BLOB, error TEXT DEFAULT '')")
+            self.db.execute('CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tasks_book ON tasks (book)')
+
+    def __transaction(self, func, *args):
+        # 在写事务中执行，同一时间只有一个进程修改队列
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(*args)
+            self.db.execute('COMMIT')
+            return result
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def submit(self, job):
+        # 提交已经抓取目录的书籍，按目录顺序为每个章节创建一个任务，返回书籍编号
+        def submit():
+            cursor = self.db.execute('INSERT INTO books (name, spec, chapter_list) VALUES (?, ?, ?)', (
+                job.name, json.dumps(dict(job.spec, output=job.output), ensure_ascii=False),
+                json.dumps(job.chapter_list, ensure_ascii=False)))
+            book = cursor.lastrowid
+            self.db.executemany('INSERT INTO tasks (book, source, item) VALUES (?, ?, ?)', [
+                (book, source, json.dumps(item, ensure_ascii=False)) for source, item in job.chapter_tasks()])
+            return book
+        return self.__transaction(submit)
+
+    def claim(self, worker):
+        # 领取一个等待中或租约已经到期的任务，返回 (任务编号, 书籍编号, 章节数据) 或 None；
+        # 租约到期且已经达到最大尝试次数的任务（例如每次都使抓取进程崩溃的章节）标记为失败
+        def claim():
+            now = time.time()
+            self.db.execute("UPDATE tasks SET state = 'failed', lease = 0, "
+                            "error = CASE WHEN error = '' THEN '租约到期，超过最大尝试次数' ELSE error END "
+                            "WHERE state = 'running' AND lease < ? AND attempts >= ?", (now, self.max_attempts))
+            row = self.db.execute(
+                "SELECT id, book, item FROM tasks WHERE state = 'pending' "
+                "OR (state = 'running' AND lease < ? AND attempts < ?) ORDER BY id LIMIT 1",
+                (now, self.max_attempts)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE tasks SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1 "
+                            'WHERE id = ?', (worker, now + self.lease, row[0]))
+            return row[0], row[1], json.loads(row[2])
+        return self.__transaction(claim)
+
+    def renew(self, task, worker):
+        # 延长任务的租约，任务已经被其它进程重新领取时返回 False
+        with self.db:
+            cursor = self.db.execute("UPDATE tasks SET lease = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                                     (time.time() + self.lease, task, worker))
+        return cursor.rowcount > 0
+
+    def complete(self, task, worker, chapters):
+        data = zlib.compress(json.dumps(chapters, ensure_ascii=False).encode('utf-8'), 6)
+        with self.db:
+            self.db.execute("UPDATE tasks SET state = 'done', result = ?, error = '' "
+                            "WHERE id = ? AND worker = ? AND state = 'running'", (data, task, worker))
+
+    def fail(self, task, worker, error):
+        # 抓取失败的任务重新等待领取，超过最大尝试次数时标记为失败
+        with self.db:
+            self.db.execute("UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                            "lease = 0, error = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                            (self.max_attempts, error, task, worker))
+
+    def book(self, book):
+        # 返回书籍任务 BookJob，章节列表为提交时的目录
+        name, spec, chapter_list = self.db.execute(
+            'SELECT name, spec, chapter_list FROM books WHERE id = ?', (book,)).fetchone()
+        job = BookJob(json.loads(spec))
+        job.chapter_list = json.loads(chapter_list)
+        return job
+
+    def progress(self):
+        # 返回正在抓取的书籍的 {书籍编号: {状态: 任务数}}
+        result = {}
+        for book, state, count in self.db.execute(
+                "SELECT tasks.book, tasks.state, COUNT(*) FROM tasks JOIN books ON books.id = tasks.book "
+                "WHERE books.state = 'crawling' GROUP BY tasks.book, tasks.state"):
+            result.setdefault(book, {})[state] = count
+        for (book,) in self.db.execute("SELECT id FROM books WHERE state = 'crawling'"):
+            result.setdefault(book, {})
+        return result
+
+    def results(self, book):
+        # 返回书籍所有章节的 {章节编号: [(标题, 内容HTML, 网址), ...]}
+        results = {}
+        for source, data in self.db.execute(
+                "SELECT source, result FROM tasks WHERE book = ? AND state = 'done'", (book,)):
+            results[source] = [tuple(chapter) for chapter in json.loads(zlib.decompress(data).decode('utf-8'))]
+        return results
+
+    def errors(self, book):
+        return [error for (error,) in self.db.execute(
+            "SELECT error FROM tasks WHERE book = ? AND state = 'failed'", (book,))]
+
+    def finish_book(self, book, state, error=''):
+        # 记录书籍结果并删除章节内容，数据库不随抓取的书籍数量增长
+        with self.db:
+            self.db.execute('UPDATE books SET state = ?, error = ? WHERE id = ?', (state, error, book))
+            self.db.execute('UPDATE tasks SET result = NULL WHERE book = ?', (book,))
+
+    def books(self):
+        return [{'id': book, 'name': name, 'state': state, 'error': error} for book, name, state, error in
+                self.db.execute('SELECT id, name, state, error FROM books ORDER BY id')]
+
+    @property
+    def active(self):
+        # 是否还有正在抓取的书籍
+        return self.db.execute("SELECT 1 FROM books WHERE state = 'crawling' LIMIT 1").fetchone() is not None
+
+    def close(self):
+        self.db.close()
+
+
+class CrawlWorker():
+    # 抓取进程，从队列中领取章节任务，抓取并提取章节内容后写回队列；
+    # 每个分页开始抓取前延长任务的租约，任务被其它进程重新领取后放弃当前任务
+    def __init__(self, queue, downloader=None, name=None):
+        self.queue = queue
+        self.downloader = downloader or Downloader.shared()
+        self.name = name or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.__jobs = {}
+
+    def __job(self, book):
+        if book not in self.__jobs:
+            self.__jobs[book] = self.queue.book(book)
+        return self.__jobs[book]
+
+    def run_once(self):
+        # 执行一个任务，没有可以领取的任务时返回 False
+        claimed = self.queue.claim(self.name)
+        if claimed is None:
+            return False
+        task, book, item = claimed
+
+        def on_page(url):
+            if not self.queue.renew(task, self.name):
+                raise RuntimeError('任务已经被其它抓取进程领取')
+        try:
+            job = self.__job(book)
+            chapters = job.extract_chapter(
+                lambda url: self.downloader.get(url, encoding=job.encoding), item, on_page=on_page)
+        except Exception as e:
+            traceback.print_exc()
+            self.queue.fail(task, self.name, '{}: {}'.format(type(e).__name__, e))
+            return True
+        self.queue.complete(task, self.name, chapters)
+        return True
+
+    def run(self, idle_exit=True, poll=1.0):
+        # 循环执行任务；idle_exit 为 True 时所有书籍都已经抓取完成后退出
+        while True:
+            if self.run_once():
+                continue
+            if idle_exit and not self.queue.active:
+                return
+            time.sleep(poll)
+
+
+class Assembler():
+    # 汇总进程，书籍的所有章节任务都结束后按目录顺序生成电子书，有失败的章节时书籍标记为失败
+    def __init__(self, queue, downloader=None):
+        self.queue = queue
+        self.downloader = downloader or Downloader.shared()
+
+    def run_once(self):
+        # 生成所有已经抓取完成的书籍，返回本次处理的书籍数量
+        count = 0
+        for book, states in self.queue.progress().items():
+            if states.get('pending') or states.get('running'):
+                continue
+            job = self.queue.book(book)
+            errors = self.queue.errors(book)
+            if errors:
+                self.queue.finish_book(book, 'failed', '{} 个章节抓取失败: {}'.format(len(errors), errors[0]))
+            else:
+                try:
+                    job.build(self.queue.results(book), downloader=self.downloader.get)
+                    self.queue.finish_book(book, 'done')
+                except Exception as e:
+                    traceback.print_exc()
+                    self.queue.finish_book(book, 'failed', '{}: {}'.format(type(e).__name__, e))
+            count += 1
+        return count
+
+    def run(self, poll=1.0):
+        while self.queue.active:
+            if not self.run_once():
+                time.sleep(poll)
+
+
+def submit_jobs(path, specs, output_dir='.', downloader=None, shared=False):
+    # 抓取每本书的目录并提交章节任务，返回提交的书籍数量
+    downloader = downloader or Downloader.shared()
+    queue = TaskQueue(path, shared=shared)
+    count = 0
+    for spec in specs:
+        job = BookJob(spec, output_dir)
+        try:
+            job.fetch_chapter_list(lambda url: downloader.get(url, encoding=job.encoding))
+        except Exception as e:
+            print('无法获取目录：{} ({})'.format(job.name, e))
+            continue
+        queue.submit(job)
+        count += 1
+    queue.close()
+    return count
+
+
+def run_worker(path, poll=1.0, shared=False):
+    # 抓取进程的入口，每个进程使用自己的数据库连接
+    queue = TaskQueue(path, shared=shared)
+    try:
+        CrawlWorker(queue).run(poll=poll)
+    finally:
+        queue.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='多进程或多台机器(--shared)分布式抓取章节')
+    parser.add_argument('command', choices=['submit', 'worker', 'assemble', 'run', 'status'],
+                        help='submit 提交任务文件中的书籍，worker 启动抓取进程，assemble 生成电子书，'
+                             'run 在本机提交并启动多个抓取进程，status 显示书籍状态')
+    parser.add_argument('jobs', nargs='?', help='任务文件(JSON格式的书籍任务列表)，submit 及 run 需要')
+    parser.add_argument('--queue', default='./temp/queue.sqlite', help='任务队列数据库')
+    parser.add_argument('--output-dir', default='.', help='未指定 output 的书籍保存目录')
+    parser.add_argument('--workers', type=int, default=4, help='run 启动的抓取进程数量')
+    parser.add_argument('--poll', type=float, default=1.0, help='没有任务时的等待时间(秒)')
+    parser.add_argument('--shared', action='store_true',
+                        help='任务队列数据库位于多台机器共享的网络文件系统上，所有进程都需要指定')
+    args = parser.parse_args(argv)
+
+    if args.command in ('submit', 'run'):
+        if not args.jobs:
+            parser.error('需要指定任务文件')
+        with open(args.jobs, mode='r', encoding='utf-8') as f:
+            print('已提交 {} 本书籍'.format(submit_jobs(args.queue, json.load(f), args.output_dir,
+                                                         shared=args.shared)))
+    if args.command == 'worker':
+        run_worker(args.queue, args.poll, args.shared)
+    elif args.command == 'assemble':
+        Assembler(TaskQueue(args.queue, shared=args.shared)).run(args.poll)
+    elif args.command == 'run':
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_worker, args=(args.queue, args.poll, args.shared))
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        Assembler(TaskQueue(args.queue, shared=args.shared)).run(args.poll)
+        for worker in workers:
+            worker.join()
+    if args.command in ('run', 'status', 'assemble'):
+        for book in TaskQueue(args.queue, shared=args.shared).books():
+            print('{:<10}{}  {}'.format(book['state'], book['name'], book['error']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
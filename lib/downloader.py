@@ -3,20 +3,98 @@
 
 import time
 import os
+import zlib
+import threading
 import requests
 import chardet
 from hashlib import md5
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from lib.pack_cache import PackCache
+
+try:
+    # 可选的 zstd 压缩库，压缩及解压缩速度比 zlib 快很多
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 压缩保存的缓存文件的文件头，之后一个字节为压缩方式；没有文件头的缓存文件为原始内容
+CACHE_MAGIC = b'\x00EFC'
+# 本身已经压缩过的文件开头的特征字节，这些文件不再压缩
+_COMPRESSED_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'RIFF', b'PK\x03\x04', b'\x1f\x8b',
+                          b'ID3', b'OggS', b'wOFF', b'wOF2', b'%PDF')
+_TEXT_TYPES = ('text/', 'html', 'xml', 'json', 'javascript', 'css')
+# 缓存文件损坏时解压缩产生的异常，按没有缓存处理
+_DECOMPRESS_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard else (zlib.error,)
+
+
+def compress_entry(content, content_type=None, codec='zlib'):
+    # 按内容类型压缩缓存内容：网页等文本文件压缩保存，图片等已经压缩过的文件按原样保存，
+    # 不知道类型时试压缩开头的部分数据，压缩效果不明显时按原样保存；
+    # 指定 zstd 但没有安装 zstandard 时使用 zlib 压缩
+    if codec not in ('zlib', 'zstd') or len(content) < 256 or content.startswith(CACHE_MAGIC):
+        return content
+    if content_type:
+        content_type = content_type.lower()
+        if not any(name in content_type for name in _TEXT_TYPES):
+            return content
+    elif content.startswith(_COMPRESSED_SIGNATURES):
+        return content
+    else:
+        sample = content[:64 * 1024]
+        if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+            return content
+    if codec == 'zstd' and zstandard is not None:
+        return CACHE_MAGIC + b's' + zstandard.ZstdCompressor(level=3).compress(content)
+    return CACHE_MAGIC + b'z' + zlib.compress(content, 6)
+
+
+def decompress_entry(data):
+    # 还原缓存内容，使用未安装的压缩库压缩的内容返回 None
+    if not data.startswith(CACHE_MAGIC):
+        return data
+    codec = data[len(CACHE_MAGIC):len(CACHE_MAGIC) + 1]
+    payload = memoryview(data)[len(CACHE_MAGIC) + 1:]
+    if codec == b'z':
+        return zlib.decompress(payload)
+    if codec == b's' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    return None
+
+
+# 默认的缓存目录为程序目录中的 temp，不随当前工作目录变化
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'temp')
 
 
 class Downloader():
-    def __init__(self, timeout=5, retry=5, retry_interval=2, proxies=None, cookies=None, cache=True, cache_dir='./temp'):
+    __shared = None
+    __shared_lock = threading.Lock()
+
+    def __init__(self, timeout=5, retry=5, retry_interval=2, proxies=None, cookies=None, cache=True, cache_dir=CACHE_DIR,
+                 memory_size=64 * 1024 * 1024, pool_size=16):
         self.timeout = timeout
         self.retry = retry
         self.retry_interval = retry_interval
         self.proxies = proxies
         self.session = requests.Session()
+        # 多个线程同时下载时复用同一个连接池中的连接
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.cache = cache
         self.cache_dir = cache_dir
+        # 网页等文本文件压缩后保存在缓存中：zlib、zstd(需要安装 zstandard)或 none
+        self.compress = 'zlib'
+        # 缓存保存方式：files 为每个地址一个缓存文件，pack 为追加保存到 cache_dir/pack 中的打包文件
+        self.backend = 'files'
+        self.__pack = None
+        # 内存中按最近使用顺序保留不超过 memory_size 字节的文件，重复读取时不再访问缓存文件；
+        # 单个文件超过内存容量的 1/4 时不保留在内存中
+        self.memory_size = memory_size
+        self.__memory = OrderedDict()
+        self.__memory_bytes = 0
+        self.__memory_lock = threading.Lock()
+        self.__cookies = None
         if cookies:
             if type(cookies) is requests.cookies.RequestsCookieJar:
                 self.__cookies = cookies
@@ -28,6 +106,14 @@ class Downloader():
             else:
                 raise ValueError('Unknow cookies type!')
 
+    @classmethod
+    def shared(cls):
+        # 进程内共享的下载器，导入章节、预览及导出电子书时使用同一个会话连接池、代理、Cookie 及内存缓存
+        with cls.__shared_lock:
+            if cls.__shared is None:
+                cls.__shared = cls()
+            return cls.__shared
+
     @staticmethod
     def md5_hash(s):
         m = md5()
@@ -60,29 +146,121 @@ class Downloader():
         with open(os.path.join(path, name), 'wb') as f:
             f.write(data)
 
+    def __recall(self, url):
+        with self.__memory_lock:
+            data = self.__memory.get(url)
+            if data is not None:
+                self.__memory.move_to_end(url)
+            return data
+
+    def __remember(self, url, data):
+        size = len(data) if data else 0
+        if not size or size > self.memory_size // 4:
+            return
+        with self.__memory_lock:
+            old = self.__memory.pop(url, None)
+            if old is not None:
+                self.__memory_bytes -= len(old)
+            self.__memory[url] = data
+            self.__memory_bytes += size
+            while self.__memory_bytes > self.memory_size:
+                key, value = self.__memory.popitem(last=False)
+                self.__memory_bytes -= len(value)
+
+    def __forget(self, url):
+        with self.__memory_lock:
+            old = self.__memory.pop(url, None)
+            if old is not None:
+                self.__memory_bytes -= len(old)
+
+    @property
+    def memory_usage(self):
+        # 返回 (内存中的文件数, 占用字节数)
+        with self.__memory_lock:
+            return len(self.__memory), self.__memory_bytes
+
+    def clear_memory(self):
+        # 清除内存中的缓存，删除缓存文件时需要同时清除
+        with self.__memory_lock:
+            self.__memory.clear()
+            self.__memory_bytes = 0
+
+    @property
+    def pack_cache(self):
+        # 打包保存的缓存，backend 不为 pack 时返回 None
+        if self.backend != 'pack':
+            return None
+        directory = os.path.join(self.cache_dir, 'pack')
+        with self.__memory_lock:
+            if self.__pack is None or self.__pack.directory != directory:
+                self.__pack = PackCache(directory)
+            return self.__pack
+
+    def clear_cache(self):
+        # 清除内存中的缓存及打包保存的缓存，每个地址一个的缓存文件由调用者删除
+        self.clear_memory()
+        if self.pack_cache is not None:
+            self.pack_cache.clear()
+
     def get_cache(self, url):
+        data = self.__recall(url)
+        if data is not None:
+            return data
+        pack = self.pack_cache
+        if pack is not None:
+            try:
+                data = pack.get(url)
+                data = decompress_entry(data) if data is not None else None
+            except _DECOMPRESS_ERRORS:
+                return None
+            if data is not None:
+                self.__remember(url, data)
+            return data
         name = self.md5_hash(url)
         path = os.path.join(self.cache_dir, name)
-        if os.path.isfile(path):
+        try:
             with open(path, 'rb') as f:
-                return f.read()
-        else:
+                data = decompress_entry(f.read())
+        except (FileNotFoundError, IsADirectoryError, ValueError) + _DECOMPRESS_ERRORS:
             return None
+        if data is not None:
+            self.__remember(url, data)
+        return data
 
     def is_cached(self, url):
+        with self.__memory_lock:
+            if url in self.__memory:
+                return True
+        if self.pack_cache is not None:
+            return url in self.pack_cache
         name = self.md5_hash(url)
         path = os.path.join(self.cache_dir, name)
         return os.path.isfile(path)
 
-    def cache_it(self, url, content):
+    def cache_it(self, url, content, content_type=None):
+        if self.pack_cache is not None:
+            self.pack_cache.put(url, compress_entry(content, content_type, self.compress))
+            self.__forget(url)
+            self.__remember(url, content)
+            return
         if not os.path.isdir(self.cache_dir):
             os.makedirs(self.cache_dir)
         name = self.md5_hash(url)
         path = os.path.join(self.cache_dir, name)
-        with open(path, 'wb') as f:
-            f.write(content)
+        # 先写入临时文件再替换，读取中的旧文件内容保持不变
+        # 多个抓取进程共用缓存目录时临时文件名包含进程号，避免互相覆盖
+        temp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(compress_entry(content, content_type, self.compress))
+        os.replace(temp_path, path)
+        self.__forget(url)
+        self.__remember(url, content)
 
     def get_img(self, url):
+        # 内存中有缓存时不访问文件系统，cache 为 False 时不使用任何缓存
+        data = self.__recall(url) if self.cache else None
+        if data is not None:
+            return data
         if url.startswith('file://') or os.path.isfile(url):
             url = url[7:] if url.startswith('file://') else url
             if os.path.isfile(url):
@@ -102,7 +280,7 @@ class Downloader():
                 if r.status_code == 200:
                     if 'image' in r.headers['Content-Type']:
                         if self.cache:
-                            self.cache_it(url, r.content)
+                            self.cache_it(url, r.content, r.headers.get('Content-Type'))
                         return r.content
                     return ValueError('获取图片格式不正确:{}'.format(r.headers['Content-Type']))
                 else:
@@ -118,12 +296,16 @@ class Downloader():
     def decode(self, content, encoding=None, errors='ignore'):
         if type(content) is bytes and encoding:
             if encoding.lower() == 'auto':
-                encoding = chardet.detect(content)['encoding']
-                return content.decode(encoding=encoding, errors=errors)
+                encoding = chardet.detect(content)['encoding'] or 'utf-8'
+            return content.decode(encoding=encoding, errors=errors)
         else:
             return content
 
     def get(self, url, encoding=None):
+        # 内存中有缓存时不访问文件系统，cache 为 False 时不使用任何缓存
+        data = self.__recall(url) if self.cache else None
+        if data is not None:
+            return self.decode(data, encoding) if encoding else data
         if url.startswith('file://') or os.path.isfile(url):
             url = url[7:] if url.startswith('file://') else url
             if os.path.isfile(url):
@@ -148,7 +330,7 @@ class Downloader():
                     url, proxies=self.proxies, timeout=self.timeout)
                 if r.status_code == 200:
                     if self.cache:
-                        self.cache_it(url, r.content)
+                        self.cache_it(url, r.content, r.headers.get('Content-Type'))
                     if encoding:
                         return self.decode(r.content, encoding)
                     else:
@@ -3,15 +3,40 @@
 
 import os
 import uuid
-import requests
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from lxml import etree
 from pyquery import PyQuery as pq
 from ebooklib import epub
 from urllib.parse import urlparse, urlunparse
+from lib.profiler import Profiler
+from lib.downloader import Downloader
+from lib.package import FIXED_MTIME, stable_identifier, CompressionPolicy, PackageWriter
+
+class _EntryWriter(epub.EpubWriter):
+    # 只生成Epub中的所有文件 [(文件名, 内容), ...]，由 PackageWriter 写入压缩包
+    class _Collector():
+        def __init__(self):
+            self.entries = []
+
+        def writestr(self, name, data, compress_type=None):
+            self.entries.append((name, data))
+
+    def entries(self):
+        self.out = self._Collector()
+        self.out.writestr('mimetype', 'application/epub+zip')
+        self._write_container()
+        self._write_opf()
+        self._write_items()
+        return self.out.entries
+
 
 class EBook():
     def __init__(self, author=None, title=None, lang='zh-CN'):
         self.__book = epub.EpubBook()
         self.__book.set_identifier(str(uuid.uuid4()))
+        self.__identifier = None
         self.__book.set_language(lang)
         if title:
             self.__book.set_title(title)
@@ -23,10 +48,38 @@ class EBook():
         self.__links = {}
         self.__chapters = []
         self.__chapters_count = 0
+        # 阅读顺序随章节的增加同步更新：在目录最后位置增加章节时直接追加到阅读顺序中，
+        # __tail 为目录最后位置上的所有章节分组（从外到内），在其它位置插入时才重新生成阅读顺序
+        self.__spine = []
+        self.__spine_valid = True
+        self.__tail = []
         self.__images = {}
         self.__images_count = 0
+        self.__parts = {}
+        self.__anchors = {}
+        self.__owners = {}
+        self.__toc_links = {}
+        # 超过该大小(字节)的章节按段落拆分为多个文件，设置为 None 时不拆分
+        self.split_size = 256 * 1024
+        # 可重复生成模式：固定标识符、时间及压缩参数，内容相同时生成完全相同的文件，
+        # 文件内容没有变化时不重新写入；source 为生成固定标识符时使用的书籍来源
+        self.deterministic = False
+        self.source = None
+        # 按文件类型选择压缩方式，见 CompressionPolicy
+        self.compression = CompressionPolicy()
+        # 保存导出记录的目录，重新导出到同一文件时直接复制没有变化的文件的压缩数据
+        self.package_cache = None
+        self.package = None
         self.__cover = True
-        self.downloader = lambda url: requests.get(url).content
+        # 下载图片及封面的函数 downloader(url) 返回文件内容，也可以是 async 函数；
+        # 默认使用进程内共享的下载器（连接池、超时重试及下载缓存）
+        self.downloader = Downloader.shared().get
+        # 批量下载章节中的图片：fetch_many(urls) 返回与 urls 顺序相同的内容列表（下载失败的为 None），
+        # 可以是普通函数或 async 函数；为 None 时使用 image_workers 个线程同时调用 downloader
+        self.fetch_many = None
+        self.image_workers = 8
+        self.__fetched = {}
+        self.profiler = Profiler(enabled=False)
         self.__css = ['''
 @namespace epub "http://www.idpf.org/2007/ops";
 body {
@@ -80,6 +133,15 @@ nav[epub|type~='toc'] > ol > li > ol > li {
     def title(self, value):
         self.__book.set_title(value)
 
+    def set_identifier(self, identifier):
+        # 指定书籍标识符，可重复生成模式下不再根据书籍来源生成标识符
+        self.__identifier = identifier
+        self.__book.set_identifier(identifier)
+
+    @property
+    def identifier(self):
+        return self.__book.uid
+
     @property
     def toc(self):
         return self.__chapters
@@ -91,7 +153,7 @@ nav[epub|type~='toc'] > ol > li > ol > li {
             with open(cover, 'rb') as f:
                 self.__book.set_cover('cover.jpg', f.read())
         else:
-            self.__book.set_cover('cover.jpg', self.downloader(cover))
+            self.__book.set_cover('cover.jpg', self.__download(cover))
 
     def set_css(self, css):
         if os.path.isfile(css):
@@ -110,18 +172,21 @@ nav[epub|type~='toc'] > ol > li > ol > li {
     def add_item(self, item, display=False):
         self.__book.add_item(item)
         if display:
-            self.__chapters.append(item)
+            self._append_toc(None, item)
 
     def add_image(self, path, display=False):
         # 增加图片对象，并返回书本中的图片引用地址
         if path in self.__images:
             return self.__images[path]
 
-        if os.path.isfile(path):
-            with open(path, 'rb') as f:
-                content = f.read()
-        else:
-            content = self.downloader(path)
+        with self.profiler.phase('add_image'):
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    content = f.read()
+            else:
+                content = self.__fetched.pop(path, None)
+                if content is None:
+                    content = self.__download(path)
 
         ext = os.path.splitext(os.path.basename(path))[-1]
         self.__images_count += 1
@@ -135,7 +200,62 @@ nav[epub|type~='toc'] > ol > li > ol > li {
         self.__images[path] = img_path
         return img_path
 
-    def add_chapter(self, title='', content='', url=None, display=True):
+    @staticmethod
+    def __run(coroutine):
+        # 在新的事件循环中运行直到完成；调用者所在线程已经有正在运行的事件循环时
+        # 不能再调用 asyncio.run，改为在其它线程的事件循环中运行
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
+
+    @staticmethod
+    def __wait(result):
+        # async 函数返回的结果在新的事件循环中等待完成
+        if not inspect.isawaitable(result):
+            return result
+
+        async def wait():
+            return await result
+        return EBook.__run(wait())
+
+    def __download(self, url):
+        return self.__wait(self.downloader(url))
+
+    def __fetch_many(self, urls):
+        if self.fetch_many is not None:
+            return list(self.__wait(self.fetch_many(urls)))
+        if inspect.iscoroutinefunction(self.downloader):
+            async def gather():
+                return await asyncio.gather(*[self.downloader(url) for url in urls], return_exceptions=True)
+            results = self.__run(gather())
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.image_workers, len(urls))) as executor:
+                futures = [executor.submit(self.downloader, url) for url in urls]
+                results = []
+                for future in futures:
+                    try:
+                        results.append(future.result())
+                    except Exception as e:
+                        results.append(e)
+        return [None if isinstance(result, BaseException) else result for result in results]
+
+    def prefetch_images(self, paths):
+        # 同时下载多个还没有加入书籍的图片，add_image 时直接使用下载的内容；
+        # 下载失败的图片在 add_image 时重新下载并报告错误
+        urls = [path for path in dict.fromkeys(paths)
+                if path not in self.__images and path not in self.__fetched and not os.path.isfile(path)]
+        if not urls or (len(urls) < 2 and self.fetch_many is None):
+            return
+        with self.profiler.phase('fetch_images'):
+            for url, content in zip(urls, self.__fetch_many(urls)):
+                if content is not None:
+                    self.__fetched[url] = content
+
+    def add_chapter(self, title='', content='', url=None, display=True, anchors=None):
+        # anchors 为目录中指向章节内书签的项目 [{'title': 标题, 'fragment': 书签}, ...]，作为章节的下级目录
         self.__chapters_count += 1
         chapter_id = 'Chapter_%05d' % (self.__chapters_count)
         chapter_name = 'ch_%05d' % (self.__chapters_count)
@@ -143,64 +263,194 @@ nav[epub|type~='toc'] > ol > li > ol > li {
         if not title:
             title = chapter_id
 
-        if not content:
-            content = pq('<p></p>')
-        if type(content) is not pq:
-            content = pq(content)
         if url:
             up = list(urlparse(url))
             up[5] = ''
             url = urlunparse(tuple(up))
-            content.make_links_absolute(base_url=url)
-            self.__links[url] = chapter_path
-        for img in content('img'):
-            if 'src' in img.attrib:
-                src = img.attrib['src']
-                img.attrib['src'] = self.add_image(src)
-
-        chapter = epub.EpubHtml(
-            uid=chapter_id, file_name=chapter_path, title=title, content=content.outer_html())
-        chapter.add_link(href='style/main.css',
-                         rel='stylesheet', type='text/css')
-        self.add_item(chapter)
+        # 性能统计中的章节使用章节网址，与导入章节时下载及提取的统计合并
+        key = url or chapter_path
+
+        with self.profiler.phase('parse', key):
+            if not content:
+                content = pq('<p></p>')
+            if type(content) is not pq:
+                content = pq(content)
+            if url:
+                content.make_links_absolute(base_url=url)
+                self.__links[url] = chapter_path
+        with self.profiler.phase('images', key):
+            self.prefetch_images([img.attrib['src'] for img in content('img') if 'src' in img.attrib])
+            for img in content('img'):
+                if 'src' in img.attrib:
+                    src = img.attrib['src']
+                    img.attrib['src'] = self.add_image(src)
+
+        with self.profiler.phase('serialize', key):
+            html = content.outer_html()
+            parts = [html]
+            if self.split_size and len(html.encode('utf-8')) > self.split_size and len(content):
+                parts = self.__split(content[0]) or parts
+
+        items = []
+        for i, html in enumerate(parts):
+            if i == 0:
+                item = epub.EpubHtml(
+                    uid=chapter_id, file_name=chapter_path, title=title, content=html)
+            else:
+                item = epub.EpubHtml(
+                    uid='%s_%03d' % (chapter_id, i + 1), file_name='%s_%03d.xhtml' % (chapter_name, i + 1),
+                    title=title, content=html)
+            item.add_link(href='style/main.css',
+                          rel='stylesheet', type='text/css')
+            self.add_item(item)
+            items.append(item)
+        chapter = items[0]
+        if len(items) > 1:
+            # 记录拆分后的文件及各书签所在的文件，用于生成阅读顺序及更新链接
+            self.__parts[chapter_path] = items[1:]
+            positions = {}
+            for item in items:
+                self.__owners[item.file_name] = chapter_path
+                for el in pq(item.content)('[id],a[name]'):
+                    positions.setdefault(el.get('id') or el.get('name'), item.file_name)
+            self.__anchors[chapter_path] = positions
+        links = []
+        for i, anchor in enumerate(anchors or []):
+            fragment = anchor.get('fragment', '')
+            target = self.__anchors.get(chapter_path, {}).get(fragment, chapter_path)
+            links.append(epub.Link(target + ('#' + fragment if fragment else ''),
+                                   anchor.get('title', '') or title, '%s_link_%03d' % (chapter_id, i + 1)))
+        if links:
+            self.__toc_links[chapter_path] = links
         if display:
-            self.__chapters.append(chapter)
+            self._append_toc(None, chapter)
         return chapter
 
+    def _anchor_links(self, chapter):
+        # 返回章节中书签的目录项
+        return list(self.__toc_links.get(chapter.file_name, []))
+
+    def __split(self, element):
+        # 在段落边界将超大的章节内容拆分为多个部分，返回各部分的HTML，无法拆分时返回 None
+        chain = [element]
+        while len(chain[-1]) == 1 and not (chain[-1].text or '').strip() \
+                and not (chain[-1][0].tail or '').strip():
+            chain.append(chain[-1][0])
+        container = chain[-1]
+        groups = []
+        size = 0
+        for child in list(container):
+            length = len(etree.tostring(child, encoding='utf-8'))
+            if not groups or (size + length > self.split_size and size > 0):
+                groups.append([])
+                size = 0
+            groups[-1].append(child)
+            size += length
+        if len(groups) < 2:
+            return None
+
+        parts = []
+        for i, children in enumerate(groups):
+            # 每个部分都保留外层元素的标签及属性
+            root = parent = None
+            for el in chain:
+                attrib = dict(el.attrib)
+                if i > 0:
+                    attrib.pop('id', None)
+                copy = el.makeelement(el.tag, attrib)
+                if parent is None:
+                    root = copy
+                else:
+                    parent.append(copy)
+                parent = copy
+            if i == 0:
+                parent.text = container.text
+            for child in children:
+                parent.append(child)
+            parts.append(pq(root).outer_html())
+        return parts
+
     def add_section(self, *arg, **kwarg):
         section = self.EBookSection(self, *arg, **kwarg)
-        self.__chapters.append(section.toc)
+        self._append_toc(None, section)
         return section
 
+    def _append_toc(self, section, item):
+        # 在目录中增加章节或章节分组，section 为所在的章节分组，None 表示目录的第一级
+        if isinstance(item, self.EBookSection):
+            entry = item.toc
+        elif self._anchor_links(item):
+            entry = (item, self._anchor_links(item))
+        else:
+            entry = item
+        if section is None:
+            self.__chapters.append(entry)
+            index = 0
+        else:
+            section.toc[1].append(entry)
+            index = section.tail_index
+        if index is None:
+            # 插入到已经结束的章节分组中，之后需要时重新生成阅读顺序
+            self.__spine_valid = False
+        else:
+            # 位于目录最后位置，之后增加的内容只能在该位置之后
+            if section is not None:
+                index += 1
+            for closed in self.__tail[index:]:
+                closed.tail_index = None
+            del self.__tail[index:]
+            if self.__spine_valid:
+                self.__extend_spine(entry)
+        if isinstance(item, self.EBookSection):
+            if index is None:
+                item.tail_index = None
+            else:
+                item.tail_index = len(self.__tail)
+                self.__tail.append(item)
+
+    def __extend_spine(self, entry):
+        # 新增的章节分组只有标题章节，子章节之后依次增加
+        if type(entry) is tuple:
+            entry = entry[0]
+        if type(entry) is epub.EpubHtml:
+            self.__spine.append(entry)
+            self.__spine.extend(self.__parts.get(entry.file_name, []))
+
     class EBookSection():
-        def __init__(self, book, title, content=None, url=None):
+        def __init__(self, book, title, content=None, url=None, anchors=None):
             self.__book = book
+            self.__chapters = []
             if content:
                 chapter = self.__book.add_chapter(
-                    title, content=content, url=url, display=False)
+                    title, content=content, url=url, display=False, anchors=anchors)
                 self.__title = chapter
+                self.__chapters.extend(self.__book._anchor_links(chapter))
             else:
                 self.__title = epub.Section(title)
-            self.__chapters = []
+            self.__toc = (self.__title, self.__chapters)
+            # 在目录最后位置上时为所在的层级(从0开始)，否则为 None
+            self.tail_index = None
 
         def add_chapter(self, *arg, **kwarg):
             chapter = self.__book.add_chapter(*arg, **kwarg, display=False)
-            self.__chapters.append(chapter)
+            self.__book._append_toc(self, chapter)
             return chapter
 
         def add_section(self, *arg, **kwarg):
             section = self.__book.EBookSection(self.__book, *arg, **kwarg)
-            self.__chapters.append(section.toc)
+            self.__book._append_toc(self, section)
             return section
 
         @property
         def toc(self):
-            return (self.__title, self.__chapters)
+            return self.__toc
 
     def update_links(self):
         # 更新所有网页链接，替换为本地URL地址并保留fragment书签
         for item in self.__book.get_items():
-            if type(item) is epub.EpubHtml:
+            if type(item) is not epub.EpubHtml:
+                continue
+            with self.profiler.phase('update_links', item.file_name):
                 content = pq(item.content)
                 # 更新网页超链接
                 for link in content('a'):
@@ -211,13 +461,24 @@ nav[epub|type~='toc'] > ol > li > ol > li {
                         up[5] = ''
                         url = urlunparse(tuple(up))
                         if url in self.__links:
-                            up = list(urlparse(self.__links[url]))
-                            up[5] = fragment
-                            link.attrib['href'] = urlunparse(tuple(up))
+                            target = self.__links[url]
+                        elif not url and fragment and item.file_name in self.__owners:
+                            # 拆分后章节内部的书签可能位于其它文件中
+                            target = self.__owners[item.file_name]
+                        else:
+                            continue
+                        if fragment in self.__anchors.get(target, {}):
+                            target = self.__anchors[target][fragment]
+                        if not url and target == item.file_name:
+                            continue
+                        up = list(urlparse(target))
+                        up[5] = fragment
+                        link.attrib['href'] = urlunparse(tuple(up))
                 item.content = content.outer_html()
 
     def save_as(self, file_path=None):
-        self.update_links()
+        with self.profiler.phase('update_links_total'):
+            self.update_links()
         css = epub.EpubItem(uid="main_css",
                             file_name="style/main.css",
                             media_type="text/css",
@@ -231,18 +492,48 @@ nav[epub|type~='toc'] > ol > li > ol > li {
         if not file_path:
             file_path = "{} - {}.epub".format(
                 self.author if self.author else "未知作者", self.title if self.title else "未命名书籍")
-        epub.write_epub(file_path, self.__book)
+        with self.profiler.phase('write_epub'):
+            written = self.__write(file_path)
+        if self.profiler.enabled:
+            # 将性能统计报告保存在电子书文件旁边
+            self.profiler.save(os.path.splitext(file_path)[0] + '.profile.txt')
+        return written
+
+    def __write(self, file_path):
+        # 生成Epub文件，返回是否写入了文件（可重复生成模式下内容没有变化时不写入）
+        if self.deterministic and not self.__identifier:
+            # 标识符由书名、作者及所有章节的来源网址决定
+            self.__book.set_identifier(stable_identifier(
+                self.title, self.author, self.source or '', *self.__links))
+        options = {'mtime': FIXED_MTIME} if self.deterministic else {}
+        writer = _EntryWriter(file_path, self.__book, options)
+        writer.process()
+        self.package = PackageWriter(file_path, policy=self.compression,
+                                     deterministic=self.deterministic, cache_dir=self.package_cache)
+        written = self.package.write(writer.entries())
+        self.profiler.note('Epub压缩统计', self.package.report())
+        return written
 
     @property
     def spine(self):
-        return self.__get_spine(self.__chapters)
+        # 返回按阅读顺序排列的所有章节文件，返回的列表不能修改
+        if not self.__spine_valid:
+            self.__spine = self.__get_spine(self.__chapters)
+            self.__spine_valid = True
+        return self.__spine
 
     def __get_spine(self, chapters):
+        # 使用栈按目录顺序遍历所有层级，不受章节分组嵌套层数的限制
         spine = []
-        for chapter in chapters:
-            if type(chapter) in [list, tuple]:
-                spine = spine+self.__get_spine(chapter)
+        stack = [iter(chapters)]
+        while stack:
+            chapter = next(stack[-1], stack)
+            if chapter is stack:
+                stack.pop()
+            elif type(chapter) in [list, tuple]:
+                stack.append(iter(chapter))
             elif type(chapter) is epub.EpubHtml:
                 spine.append(chapter)
+                spine.extend(self.__parts.get(chapter.file_name, []))
         return spine
 
@@ -13,7 +13,7 @@ if __name__ == '__main__':
     book.set_cover(
         'https://ae01.alicdn.com/kf/Hd0ca7616ad0c4b06931df9f8d4406fbfC.jpg')
     # 设置书籍的络文件下载器
-    book.downloader = Downloader().get
+    book.downloader = Downloader.shared().get
 
     # 读取本地html文件
     with open('test.html', mode='r', encoding='utf-8') as f:
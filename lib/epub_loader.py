@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import re
+import zipfile
+import posixpath
+from lxml import etree, html
+from urllib.parse import urlparse, urlunparse, unquote
+
+NAMESPACES = {
+    'container': 'urn:oasis:names:tc:opendocument:xmlns:container',
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'ncx': 'http://www.daisy.org/z3986/2005/ncx/',
+    'xhtml': 'http://www.w3.org/1999/xhtml',
+    'epub': 'http://www.idpf.org/2007/ops',
+}
+
+# 电子书内部文件的引用地址前缀，例如 epub:OEBPS/images/cover.jpg
+SCHEME = 'epub:'
+
+
+def merged_anchor(path):
+    # 合并到前一个章节中的正文文件开头位置的书签名称
+    return 'epub-' + re.sub(r'[^A-Za-z0-9_-]', '_', path)
+
+
+class EpubContent():
+    # 电子书中一个或多个章节文件的正文内容，需要时才从压缩包中读取，
+    # 之后的文件开头增加书签，指向这些文件的链接改为指向书签
+    def __init__(self, loader, paths):
+        self.loader = loader
+        self.paths = paths
+
+    def load(self):
+        return ''.join(('<a id="%s"></a>' % merged_anchor(path) if i else '') + self.loader.read_body(path)
+                       for i, path in enumerate(self.paths))
+
+
+class EpubLoader():
+    # 读取已有的Epub电子书，获取书籍信息、目录结构、样式表及图片，
+    # 章节正文在需要时才从压缩包中读取，图片按原始数据读取不做重新编码。
+    def __init__(self, path):
+        self.path = path
+        self.__zip = zipfile.ZipFile(path)
+        container = etree.fromstring(self.__zip.read('META-INF/container.xml'))
+        self.opf_path = container.find('.//container:rootfile', NAMESPACES).get('full-path')
+        self.__opf = etree.fromstring(self.__zip.read(self.opf_path))
+        self.__manifest = {}
+        self.__nav = None
+        self.__merged = {}      # 合并到其它章节中的正文文件 {文件路径: 所在章节的文件路径}
+        for item in self.__opf.iterfind('opf:manifest/opf:item', NAMESPACES):
+            path = self.__resolve(self.opf_path, item.get('href'))
+            self.__manifest[item.get('id')] = {
+                'path': path,
+                'media_type': item.get('media-type', ''),
+                'properties': item.get('properties', '').split(),
+            }
+            if 'nav' in self.__manifest[item.get('id')]['properties']:
+                self.__nav = path
+        self.__spine = [self.__manifest[ref.get('idref')]['path']
+                        for ref in self.__opf.iterfind('opf:spine/opf:itemref', NAMESPACES)
+                        if ref.get('idref') in self.__manifest]
+
+    @staticmethod
+    def __resolve(base, href):
+        # 将相对于 base 文件的引用地址转换为压缩包内的完整路径
+        path = unquote(urlparse(href).path)
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base), path))
+
+    def __metadata(self, name):
+        return [el.text.strip() for el in self.__opf.iterfind('opf:metadata/dc:' + name, NAMESPACES)
+                if el.text and el.text.strip()]
+
+    @property
+    def title(self):
+        titles = self.__metadata('title')
+        return titles[0] if titles else ''
+
+    @property
+    def authors(self):
+        return self.__metadata('creator')
+
+    @property
+    def spine(self):
+        return self.__spine
+
+    @property
+    def cover(self):
+        # 返回封面图片的引用地址，没有封面时返回 None
+        for item in self.__manifest.values():
+            if 'cover-image' in item['properties']:
+                return SCHEME + item['path']
+        meta = self.__opf.find('opf:metadata/opf:meta[@name="cover"]', NAMESPACES)
+        if meta is not None and meta.get('content') in self.__manifest:
+            return SCHEME + self.__manifest[meta.get('content')]['path']
+        return None
+
+    @property
+    def css(self):
+        # 合并电子书中所有的样式表
+        return '\r\n'.join(self.read(item['path']).decode('utf-8', errors='ignore')
+                           for item in self.__manifest.values() if item['media_type'] == 'text/css')
+
+    def read(self, path):
+        # 读取压缩包中文件的原始数据
+        if path.startswith(SCHEME):
+            path = path[len(SCHEME):]
+        return self.__zip.read(path)
+
+    def fetcher(self, fallback):
+        # 返回下载器函数，电子书内部的文件直接从压缩包读取，其它地址使用 fallback 下载
+        def fetch(url, *args, **kwargs):
+            if url.startswith(SCHEME):
+                return self.read(url)
+            return fallback(url, *args, **kwargs)
+        return fetch
+
+    def __absolute(self, base, href):
+        # 将章节中的相对引用转换为 epub: 开头的完整引用地址，外部链接保持不变；
+        # 指向已合并到其它章节中的文件时改为指向该章节中对应的位置
+        up = urlparse(href)
+        if up.scheme or up.netloc or not up.path:
+            return href
+        path = self.__resolve(base, href)
+        fragment = up.fragment
+        if path in self.__merged:
+            fragment = fragment or merged_anchor(path)
+            path = self.__merged[path]
+        return urlunparse(('', '', SCHEME + path, '', '', fragment))
+
+    def read_body(self, path):
+        # 读取章节正文的HTML内容，图片及章节链接改为 epub: 开头的完整引用地址
+        doc = html.fromstring(self.read(path))
+        body = doc.find('.//body')
+        if body is None:
+            return ''
+        for el in body.iter():
+            if not isinstance(el.tag, str):
+                continue
+            for attr in ('src', 'href', '{http://www.w3.org/1999/xlink}href'):
+                if attr in el.attrib:
+                    el.attrib[attr] = self.__absolute(path, el.attrib[attr])
+        return (body.text or '') + ''.join(
+            html.tostring(child, encoding='unicode') for child in body)
+
+    def __nav_points(self):
+        # 读取目录结构，返回 [{'title': 标题, 'path': 文件路径, 'child': [...]}, ...]
+        if self.__nav:
+            doc = html.fromstring(self.read(self.__nav))
+            for nav in doc.iter('nav'):
+                if 'toc' in nav.get('{%s}type' % NAMESPACES['epub'], nav.get('epub:type', '')).split():
+                    ol = nav.find('ol')
+                    if ol is not None:
+                        return self.__parse_nav(ol)
+        toc = self.__opf.find('opf:spine', NAMESPACES).get('toc')
+        if toc in self.__manifest:
+            ncx_path = self.__manifest[toc]['path']
+            ncx = etree.fromstring(self.read(ncx_path))
+            nav_map = ncx.find('ncx:navMap', NAMESPACES)
+            if nav_map is not None:
+                return self.__parse_ncx(nav_map, ncx_path)
+        return []
+
+    def __parse_nav(self, ol):
+        result = []
+        stack = [(ol, result)]
+        while stack:
+            node, target = stack.pop()
+            for li in node.iterfind('li'):
+                link = li.find('a')
+                if link is None:
+                    link = li.find('span')
+                href = link.get('href') if link is not None else None
+                point = {
+                    'title': link.text_content().strip() if link is not None else '',
+                    'path': self.__resolve(self.__nav, href) if href else None,
+                    'fragment': urlparse(href).fragment if href else '',
+                    'child': [],
+                }
+                target.append(point)
+                sub = li.find('ol')
+                if sub is not None:
+                    stack.append((sub, point['child']))
+        return result
+
+    def __parse_ncx(self, nav_map, ncx_path):
+        result = []
+        stack = [(nav_map, result)]
+        while stack:
+            node, target = stack.pop()
+            for point in node.iterfind('ncx:navPoint', NAMESPACES):
+                label = point.find('ncx:navLabel/ncx:text', NAMESPACES)
+                content = point.find('ncx:content', NAMESPACES)
+                src = content.get('src') if content is not None else None
+                item = {
+                    'title': label.text.strip() if label is not None and label.text else '',
+                    'path': self.__resolve(ncx_path, src) if src else None,
+                    'fragment': urlparse(src).fragment if src else '',
+                    'child': [],
+                }
+                target.append(item)
+                stack.append((point, item['child']))
+        return result
+
+    def chapters(self):
+        # 按目录顺序返回章节结构 [{'title', 'url', 'content': EpubContent, 'anchors', 'child': [...]}, ...]，
+        # 不在目录中的正文文件合并到目录中前一个章节的内容中；
+        # 同一文件中之后的目录项（没有子目录时）作为书签 anchors [{'title', 'fragment'}, ...] 保留在该章节中
+        points = self.__nav_points()
+        order = [path for path in self.__spine if path != self.__nav]
+        listed = set()
+        stack = [points]
+        while stack:
+            for point in stack.pop():
+                if point['path']:
+                    listed.add(point['path'])
+                stack.append(point['child'])
+        # 每个目录文件之后直到下一个目录文件之前的正文文件
+        following = {}
+        previous = None
+        leading = []
+        for path in order:
+            if path in listed:
+                previous = path
+                following.setdefault(path, [])
+            elif previous:
+                following.setdefault(previous, []).append(path)
+            else:
+                leading.append(path)
+        self.__merged = {path: owner for owner, paths in following.items() for path in paths}
+        self.__merged.update((path, leading[0]) for path in leading[1:])
+
+        seen = {}
+        anchors = {}
+
+        def convert(points):
+            result = []
+            for point in points:
+                path = point['path']
+                child = convert(point['child'])
+                if path and path not in seen:
+                    seen[path] = {
+                        'title': point['title'],
+                        'url': SCHEME + path,
+                        'content': EpubContent(self, [path] + following.get(path, [])),
+                        'anchors': anchors.setdefault(path, []),
+                        'child': child,
+                    }
+                    result.append(seen[path])
+                elif child or not path:
+                    result.append({'title': point['title'], 'url': '', 'content': None, 'anchors': [],
+                                   'child': child})
+                else:
+                    anchors.setdefault(path, []).append({'title': point['title'], 'fragment': point['fragment']})
+            return result
+
+        chapters = convert(points)
+        if leading:
+            chapters.insert(0, {
+                'title': posixpath.basename(leading[0]),
+                'url': SCHEME + leading[0],
+                'content': EpubContent(self, leading),
+                'anchors': [],
+                'child': [],
+            })
+        return chapters
+
+    def close(self):
+        self.__zip.close()
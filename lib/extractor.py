@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import re
+from lxml import etree, html
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape
+from cssselect import parse as parse_selector, SelectorError
+from cssselect.parser import Element, Hash, Class, Attrib, Negation, CombinedSelector
+from pyquery.cssselectpatch import JQueryTranslator
+
+from lib.profiler import Profiler
+
+_translator = JQueryTranslator(xhtml=False)
+_spaces = re.compile(r'\s+')
+
+
+def compile_selector(css, prefix='descendant-or-self::'):
+    # 将CSS选择器(支持与PyQuery相同的jQuery扩展语法)编译为XPath对象
+    return etree.XPath(_translator.css_to_xpath(css, prefix))
+
+
+# 流式解析时祖先元素的查找方向，只支持只依赖祖先元素的组合器
+_ancestor_axes = {' ': 'ancestor', '>': 'parent'}
+
+
+def _self_step(tree, axis):
+    # 将选择器转换为从当前元素向祖先方向匹配的XPath步骤，
+    # 例如 "#list dd > a" 转换为 self::a[parent::dd[ancestor::*[@id = 'list']]]
+    if isinstance(tree, CombinedSelector):
+        if tree.combinator not in _ancestor_axes:
+            raise SelectorError('不支持流式匹配的组合器: %s' % tree.combinator)
+        outer = _self_step(tree.selector, _ancestor_axes[tree.combinator])
+        return _simple_step(tree.subselector, axis, outer)
+    return _simple_step(tree, axis)
+
+
+def _simple_step(tree, axis, outer=None):
+    # 只允许不依赖元素内容及兄弟元素的简单选择器(标签、ID、类名、属性及其否定)
+    node = tree
+    while not isinstance(node, Element):
+        if isinstance(node, Negation):
+            _simple_step(node.subselector, axis)
+        elif not isinstance(node, (Hash, Class, Attrib)):
+            raise SelectorError('不支持流式匹配的选择器: %r' % node)
+        node = node.selector
+    expr = _translator.xpath(tree)
+    step = '%s::%s' % (axis, expr.element)
+    if expr.condition:
+        step += '[%s]' % expr.condition
+    if outer:
+        step += '[%s]' % outer
+    return step
+
+
+def compile_self_selector(css, axis='self'):
+    # 将CSS选择器编译为判断当前元素是否匹配的XPath对象，只需要元素本身的属性及其祖先元素，
+    # 可以在流式解析到元素开始标签时立即判断；选择器不支持时抛出 SelectorError。
+    # axis 为 ancestor-or-self 时判断当前元素或其任意祖先元素是否匹配
+    steps = []
+    for selector in parse_selector(css):
+        if selector.pseudo_element:
+            raise SelectorError('不支持流式匹配的伪元素: %s' % selector.pseudo_element)
+        steps.append(_self_step(selector.parsed_tree, axis))
+    return etree.XPath('boolean(%s)' % ' | '.join(steps))
+
+
+def element_text(el):
+    # 与 PyQuery.text() 相同，返回压缩空白字符后的文本内容
+    return _spaces.sub(' ', el.text_content()).strip()
+
+
+def element_html(el):
+    # 与 PyQuery 中 append 后再取 html() 的结果相同，包含元素之后的文本
+    return etree.tostring(el, encoding='unicode', with_tail=True)
+
+
+class PageExtractor():
+    # 页面元素提取器，选择器只编译一次，解析页面后按文档顺序一次遍历为每个元素标记角色，
+    # 避免对查询结果列表反复进行线性的成员检查。
+    # 超过 stream_size 的页面使用流式解析，只保留匹配的元素，其它内容解析完即丢弃，
+    # 单页全文小说等巨大页面的内存占用不随页面大小增长。
+    stream_size = 1024 * 1024
+    chunk_size = 64 * 1024
+
+    def __init__(self, **selectors):
+        # selectors 为 {角色: CSS选择器}，同一元素匹配多个角色时以先指定的角色为准
+        self.__xpaths = [(role, compile_selector(css)) for role, css in selectors.items() if css]
+        try:
+            self.__self_xpaths = [(role, compile_self_selector(css))
+                                  for role, css in selectors.items() if css]
+        except (SelectorError, NotImplementedError):
+            # 选择器依赖元素内容或兄弟元素，只能解析完整页面后查询
+            self.__self_xpaths = None
+
+    @property
+    def streamable(self):
+        return self.__self_xpaths is not None
+
+    @property
+    def roles(self):
+        return [role for role, xpath in self.__xpaths]
+
+    def parse(self, content):
+        # 解析网页内容，内容为空时返回 None
+        if isinstance(content, str):
+            content = content.strip()
+        if not content:
+            return None
+        try:
+            return html.document_fromstring(content)
+        except etree.ParserError:
+            return None
+
+    def extract(self, content, base_url=None):
+        # 返回按文档顺序排列的 [(角色, 元素), ...]，只将匹配元素中的链接转换为绝对地址
+        if isinstance(content, etree._Element):
+            result = self.__extract_tree(content)
+        elif self.streamable and content and len(content) >= self.stream_size:
+            result = self.extract_stream(content)
+        else:
+            result = self.__extract_tree(self.parse(content))
+        if base_url:
+            def absolute(link):
+                return urljoin(base_url, link.strip())
+            for role, el in result:
+                el.rewrite_links(absolute, resolve_base_href=False)
+        return result
+
+    def __extract_tree(self, doc):
+        if doc is None:
+            return []
+        roles = {}
+        for role, xpath in self.__xpaths:
+            for el in xpath(doc):
+                if isinstance(el, etree._Element) and el not in roles:
+                    roles[el] = role
+        if not roles:
+            return []
+        result = []
+        for el in doc.iter():
+            if el in roles:
+                result.append((roles[el], el))
+                if len(result) == len(roles):
+                    break
+        return result
+
+    def extract_stream(self, content):
+        # 流式解析页面，在元素开始标签处判断是否匹配，返回按文档顺序排列的 [(角色, 元素), ...]。
+        # 不匹配且不包含匹配元素的元素在解析到下一个标签时从文档中删除，只保留打开的祖先元素。
+        parser = etree.HTMLPullParser(events=('start', 'end'))
+        parser.set_element_class_lookup(html.HtmlElementClassLookup())
+        result = []
+        # 打开的元素栈，每项为 [是否匹配, 是否保留]
+        stack = []
+        state = {'inside': 0, 'pending': None}
+
+        def handle(events):
+            for event, el in events:
+                pending = state['pending']
+                if pending is not None:
+                    parent = pending.getparent()
+                    if parent is not None:
+                        parent.remove(pending)
+                    state['pending'] = None
+                if event == 'start':
+                    role = None
+                    for name, xpath in self.__self_xpaths:
+                        if xpath(el):
+                            role = name
+                            break
+                    if role:
+                        result.append((role, el))
+                        state['inside'] += 1
+                        for item in reversed(stack):
+                            if item[1]:
+                                break
+                            item[1] = True
+                    stack.append([role is not None, role is not None])
+                elif stack:
+                    matched, keep = stack.pop()
+                    if matched:
+                        state['inside'] -= 1
+                    elif not keep and not state['inside']:
+                        state['pending'] = el
+
+        if isinstance(content, str):
+            content = content.strip()
+        try:
+            for i in range(0, len(content), self.chunk_size):
+                parser.feed(content[i:i + self.chunk_size])
+                handle(parser.read_events())
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        handle(parser.read_events())
+        return result
+
+
+def _next_page(items, visited):
+    # 返回第一个分页链接的地址，已经访问过的地址返回 None 以避免循环抓取
+    for role, el in items:
+        if role == 'pagination':
+            url = el.get('href')
+            if url and url not in visited:
+                return url
+            return None
+    return None
+
+
+class TocExtractor():
+    # 章节目录提取器，遍历所有目录分页生成章节列表
+    def __init__(self, group='', link='', pagination='', profiler=None):
+        group = group.strip().lower()
+        link = link.strip().lower()
+        pagination = pagination.strip().lower()
+        if link and not link.endswith('a'):
+            link = link + ' a'
+        if pagination and not pagination.endswith('a'):
+            pagination = pagination + ' a'
+        self.enabled = bool(group or link or pagination)
+        self.profiler = profiler or Profiler(enabled=False)
+        self.__extractor = PageExtractor(group=group, link=link, pagination=pagination)
+
+    def chapter_list(self, fetch, realUrl, referUrl):
+        # fetch(url) 返回网页内容；返回 [{'title', 'realUrl', 'referUrl', 'child'}, ...]
+        chapterList = []
+        parent = chapterList
+        child = chapterList
+        visited = set()
+        while self.enabled and realUrl:
+            visited.add(realUrl)
+            content = fetch(realUrl)
+            with self.profiler.phase('extract', realUrl):
+                items = self.__extractor.extract(content, referUrl)
+                for role, el in items:
+                    if role == 'group':
+                        url = el.get('href', '')
+                        section = {
+                            'title': element_text(el),
+                            'realUrl': url,
+                            'referUrl': url,
+                            'child': []
+                        }
+                        parent.append(section)
+                        child = section['child']
+                    elif role == 'link' and el.get('href'):
+                        child.append({
+                            'title': element_text(el),
+                            'realUrl': el.get('href'),
+                            'referUrl': el.get('href'),
+                            'child': None
+                        })
+            referUrl = realUrl = _next_page(items, visited)
+        return chapterList
+
+
+class ChapterExtractor():
+    # 章节内容提取器，遍历章节的所有分页，按章节标题拆分内容，
+    # 指定 cleaner (lib.cleaner.ContentCleaner) 时在提取时清理每个内容元素
+    def __init__(self, title='', content='', pagination='', profiler=None, cleaner=None):
+        title = title.strip().lower()
+        content = content.strip().lower()
+        pagination = pagination.strip().lower()
+        self.profiler = profiler or Profiler(enabled=False)
+        self.cleaner = cleaner
+        self.__extractor = PageExtractor(title=title, content=content, pagination=pagination)
+
+    def __content_html(self, el):
+        if self.cleaner is None:
+            return element_html(el)
+        with self.profiler.phase('clean'):
+            cleaned = self.cleaner.clean(el)
+        if cleaned is None:
+            # 元素本身被删除时保留元素之后的文本
+            return escape(self.cleaner.clean_text(el.tail or '').strip())
+        return element_html(cleaned)
+
+    def chapters(self, fetch, data, on_page=None):
+        # 依次返回提取的章节 (标题, 内容HTML, 网址)，on_page(url) 在抓取每个分页前调用
+        title = data['title']
+        realUrl = data['realUrl']
+        referUrl = data['referUrl']
+        parts = []
+        visited = set()
+        while realUrl:
+            visited.add(realUrl)
+            if on_page:
+                on_page(realUrl)
+            content = fetch(realUrl)
+            with self.profiler.phase('extract', realUrl):
+                items = self.__extractor.extract(content, referUrl)
+                chapters = []
+                for role, el in items:
+                    if role == 'title':
+                        if parts:
+                            chapters.append((title, ''.join(parts), referUrl))
+                        title = element_text(el)
+                        parts = []
+                    elif role == 'content':
+                        parts.append(self.__content_html(el))
+            for chapter in chapters:
+                yield chapter
+            referUrl = realUrl = _next_page(items, visited)
+        if parts:
+            yield (title, ''.join(parts), data['referUrl'])
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import zlib
+from hashlib import sha1
+
+
+class ContentStore():
+    # 按内容哈希去重保存的章节内容快照，内容压缩后保存并记录引用次数，
+    # 多次操作中相同的章节内容只保存一份，不再被任何操作引用时释放
+    def __init__(self, level=1):
+        self.level = level
+        self.__items = {}
+
+    def put(self, content):
+        # 保存内容并返回其哈希值
+        data = (content or '').encode('utf-8')
+        key = sha1(data).hexdigest()
+        item = self.__items.get(key)
+        if item:
+            item[1] += 1
+        else:
+            self.__items[key] = [zlib.compress(data, self.level), 1]
+        return key
+
+    def get(self, key):
+        return zlib.decompress(self.__items[key][0]).decode('utf-8')
+
+    def release(self, key):
+        item = self.__items.get(key)
+        if item:
+            item[1] -= 1
+            if item[1] <= 0:
+                del self.__items[key]
+
+    @property
+    def size(self):
+        # 所有快照压缩后占用的字节数
+        return sum(len(item[0]) for item in self.__items.values())
+
+    def clear(self):
+        self.__items = {}
+
+
+class StoredContent():
+    # 保存在 ContentStore 中的章节内容，需要时才解压缩
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+
+    def load(self):
+        return self.store.get(self.key)
+
+
+class ContentChange():
+    # 批量修改章节内容的操作，每个章节只保存修改前后的内容快照，
+    # 撤销及重做时只将章节的内容替换为快照的引用，不需要解压缩全部章节
+    def __init__(self, name, store, changes):
+        # changes 为 [(章节, 原内容, 新内容), ...]，章节需要有 loader 及 content 属性
+        self.name = name
+        self.store = store
+        self.__changes = [(item, store.put(old), store.put(new)) for item, old, new in changes]
+
+    def __len__(self):
+        return len(self.__changes)
+
+    def __restore(self, index):
+        for change in self.__changes:
+            change[0].loader = StoredContent(self.store, change[index])
+            change[0].content = None
+
+    def undo(self):
+        self.__restore(1)
+
+    def redo(self):
+        self.__restore(2)
+
+    def release(self):
+        for item, old, new in self.__changes:
+            self.store.release(old)
+            self.store.release(new)
+        self.__changes = []
+
+
+class InsertItems():
+    # 插入章节的操作，撤销时将插入的章节从目录中移除但保留章节对象，重做时放回原来的位置，
+    # 章节需要提供 QTreeWidgetItem 的 indexOfChild、insertChild、removeChild 方法
+    def __init__(self, name, items):
+        # items 为按插入顺序排列的 [(父节点, 章节), ...]
+        self.name = name
+        self.__items = [(parent, parent.indexOfChild(item), item) for parent, item in items]
+
+    def __len__(self):
+        return len(self.__items)
+
+    def undo(self):
+        for parent, index, item in reversed(self.__items):
+            parent.removeChild(item)
+
+    def redo(self):
+        for parent, index, item in self.__items:
+            parent.insertChild(index, item)
+
+    def release(self):
+        self.__items = []
+
+
+class RemoveItems(InsertItems):
+    # 删除章节的操作，items 为删除前的 [(父节点, 章节), ...]，撤销时按原来的位置放回
+    def undo(self):
+        InsertItems.redo(self)
+
+    def redo(self):
+        InsertItems.undo(self)
+
+
+class History():
+    # 批量操作的撤销及重做记录，最多保留 depth 个操作
+    def __init__(self, depth=50):
+        self.depth = depth
+        self.store = ContentStore()
+        self.__undo = []
+        self.__redo = []
+
+    def push(self, operation):
+        # 记录已经完成的操作，同时清除可以重做的操作
+        if not len(operation):
+            return
+        for item in self.__redo:
+            item.release()
+        self.__redo = []
+        self.__undo.append(operation)
+        while len(self.__undo) > self.depth:
+            self.__undo.pop(0).release()
+
+    def change_contents(self, name, changes):
+        # 记录批量修改章节内容的操作，changes 为 [(章节, 原内容, 新内容), ...]
+        self.push(ContentChange(name, self.store, changes))
+
+    @property
+    def can_undo(self):
+        return bool(self.__undo)
+
+    @property
+    def can_redo(self):
+        return bool(self.__redo)
+
+    @property
+    def undo_name(self):
+        return self.__undo[-1].name if self.__undo else ''
+
+    @property
+    def redo_name(self):
+        return self.__redo[-1].name if self.__redo else ''
+
+    def undo(self):
+        if not self.__undo:
+            return None
+        operation = self.__undo.pop()
+        operation.undo()
+        self.__redo.append(operation)
+        return operation
+
+    def redo(self):
+        if not self.__redo:
+            return None
+        operation = self.__redo.pop()
+        operation.redo()
+        self.__undo.append(operation)
+        return operation
+
+    def clear(self):
+        for item in self.__undo + self.__redo:
+            item.release()
+        self.__undo = []
+        self.__redo = []
+        self.store.clear()
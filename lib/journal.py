@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+from hashlib import md5
+
+
+class CrawlJournal():
+    # 只追加写入的抓取日志（JSONL格式），记录每个已提取完成的章节，
+    # 程序崩溃或网络中断后可以从日志中恢复，不需要重新抓取和解析已完成的章节。
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self.__file = None
+        self.__chapters = {}
+        self.__done = set()
+
+    @staticmethod
+    def make_key(*args):
+        # 根据导入参数生成日志的唯一标识
+        m = md5()
+        m.update(json.dumps(args, ensure_ascii=False, sort_keys=True).encode('utf-8'))
+        return m.hexdigest()
+
+    @property
+    def exists(self):
+        return os.path.isfile(self.path) and os.path.getsize(self.path) > 0
+
+    def load(self):
+        # 读取日志内容，只保留已经完整结束的抓取任务，忽略崩溃时写入不完整的最后一行
+        self.__chapters = {}
+        self.__done = set()
+        if not os.path.isfile(self.path):
+            return self
+        with open(self.path, mode='r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                source = record.get('source')
+                if record.get('type') == 'begin':
+                    # 重新开始的任务丢弃之前未完成时记录的章节
+                    self.__chapters[source] = []
+                elif record.get('type') == 'chapter':
+                    self.__chapters.setdefault(source, []).append(
+                        (record['title'], record['content'], record['url']))
+                elif record.get('type') == 'done':
+                    self.__done.add(source)
+        for source in list(self.__chapters):
+            if source not in self.__done:
+                del self.__chapters[source]
+        return self
+
+    def is_done(self, source):
+        return source in self.__done
+
+    def chapters(self, source):
+        # 返回已完成任务的所有章节 [(标题, 内容, 网址), ...]
+        return self.__chapters.get(source, [])
+
+    def __write(self, record):
+        if self.__file is None:
+            path = os.path.dirname(os.path.realpath(self.path))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.__file = open(self.path, mode='a', encoding='utf-8')
+            if self.__file.tell() > 0:
+                # 崩溃时最后一行可能没有写完整，另起一行避免与新记录连在一起
+                with open(self.path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.__file.write('\n')
+        self.__file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.__file.flush()
+        if self.sync:
+            os.fsync(self.__file.fileno())
+
+    def begin(self, source):
+        # 标记开始抓取任务
+        self.__write({'type': 'begin', 'source': source})
+
+    def add_chapter(self, source, title, content, url):
+        self.__write({'type': 'chapter', 'source': source,
+                      'title': title, 'content': content, 'url': url})
+
+    def finish(self, source):
+        # 标记抓取任务已经完成
+        self.__write({'type': 'done', 'source': source})
+        self.__done.add(source)
+
+    def close(self):
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+
+    def remove(self):
+        # 导入完成后删除日志文件
+        self.close()
+        self.__chapters = {}
+        self.__done = set()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import sqlite3
+import argparse
+import threading
+
+
+class PackCache():
+    # 打包保存的下载缓存，所有缓存内容依次追加到少量的大文件(pack_00001.dat ...)中，
+    # 由 SQLite 索引记录每个地址所在的文件、位置及长度，不再为每个地址创建一个缓存文件。
+    # 多个线程或进程可以同时读取，写入时由 SQLite 的写事务保证同一时间只有一个写入者；
+    # 查询索引后只需要一次 pread 读取缓存内容。
+    # 覆盖或删除的内容仍然占用文件空间，使用 compact() 重新整理。
+    # 缓存文件的编号保存在 meta 表中并且只增不减，清除或整理后也不会重新使用旧编号，
+    # 其它进程中仍然打开的已删除旧文件不会被当作新文件读取。
+    def __init__(self, directory, pack_size=1024 * 1024 * 1024):
+        self.directory = directory
+        self.pack_size = pack_size
+        os.makedirs(directory, exist_ok=True)
+        self.__local = threading.local()
+        self.__files = {}
+        self.__files_lock = threading.Lock()
+        db = self.__db()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                       'key TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, length INTEGER)')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+            # 没有编号记录的旧缓存目录从已有的最大编号开始
+            row = db.execute('SELECT MAX(pack) FROM entries').fetchone()
+            db.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('pack', ?)",
+                       (max([row[0] or 1] + self.__packs()),))
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.sqlite')
+
+    def pack_path(self, pack):
+        return os.path.join(self.directory, 'pack_%05d.dat' % pack)
+
+    def __db(self):
+        # 每个线程使用自己的数据库连接
+        db = getattr(self.__local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.__local.db = db
+        return db
+
+    def __file(self, pack):
+        # 打开的缓存文件在所有线程间共用，pread 不改变文件位置
+        with self.__files_lock:
+            fd = self.__files.get(pack)
+            if fd is None:
+                fd = os.open(self.pack_path(pack), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+                self.__files[pack] = fd
+            return fd
+
+    def __pread(self, pack, offset, length):
+        fd = self.__file(pack)
+        if hasattr(os, 'pread'):
+            return os.pread(fd, length, offset)
+        # Windows 没有 pread，读取时锁定文件位置
+        with self.__files_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
+
+    def close_files(self):
+        # 关闭打开的缓存文件，整理或清除缓存后旧文件已经删除
+        with self.__files_lock:
+            for fd in self.__files.values():
+                os.close(fd)
+            self.__files = {}
+
+    def get(self, key):
+        row = self.__db().execute(
+            'SELECT pack, offset, length FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            data = self.__pread(*row)
+        except OSError:
+            # 读取时缓存正在整理，按没有缓存处理
+            return None
+        return data if len(data) == row[2] else None
+
+    def __contains__(self, key):
+        return self.__db().execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.__db().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    @staticmethod
+    def __current_pack(db):
+        return db.execute("SELECT value FROM meta WHERE name = 'pack'").fetchone()[0]
+
+    @staticmethod
+    def __set_pack(db, pack):
+        db.execute("UPDATE meta SET value = ? WHERE name = 'pack'", (pack,))
+
+    def put(self, key, data):
+        # 在写事务中追加内容并更新索引，同一时间只有一个线程或进程写入
+        db = self.__db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            pack = self.__current_pack(db)
+            path = self.pack_path(pack)
+            if os.path.exists(path) and os.path.getsize(path) + len(data) > self.pack_size \
+                    and os.path.getsize(path) > 0:
+                pack += 1
+                path = self.pack_path(pack)
+                self.__set_pack(db, pack)
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            db.execute('INSERT OR REPLACE INTO entries (key, pack, offset, length) VALUES (?, ?, ?, ?)',
+                       (key, pack, offset, len(data)))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def delete(self, key):
+        db = self.__db()
+        with db:
+            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def __packs(self):
+        return sorted(int(name[5:-4]) for name in os.listdir(self.directory)
+                      if name.startswith('pack_') and name.endswith('.dat') and name[5:-4].isdigit())
+
+    def stats(self):
+        # 返回 (缓存数量, 有效内容字节数, 缓存文件总字节数)
+        count, size = self.__db().execute('SELECT COUNT(*), TOTAL(length) FROM entries').fetchone()
+        total = sum(os.path.getsize(self.pack_path(pack)) for pack in self.__packs())
+        return count, int(size), total
+
+    def compact(self):
+        # 将所有有效内容按顺序复制到新的缓存文件中并删除旧文件，返回释放的字节数。
+        # 整理期间持有写事务，其它写入者等待整理完成
+        db = self.__db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            old_packs = self.__packs()
+            before = sum(os.path.getsize(self.pack_path(pack)) for pack in old_packs)
+            pack = max([self.__current_pack(db)] + old_packs) + 1
+            out = open(self.pack_path(pack), 'wb')
+            updates = []
+            try:
+                rows = db.execute('SELECT key, pack, offset, length FROM entries ORDER BY pack, offset').fetchall()
+                for key, old, offset, length in rows:
+                    if out.tell() > 0 and out.tell() + length > self.pack_size:
+                        out.close()
+                        pack += 1
+                        out = open(self.pack_path(pack), 'wb')
+                    updates.append((pack, out.tell(), key))
+                    out.write(self.__pread(old, offset, length))
+            finally:
+                out.close()
+            db.executemany('UPDATE entries SET pack = ?, offset = ? WHERE key = ?', updates)
+            self.__set_pack(db, pack)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self.close_files()
+        for old in old_packs:
+            os.remove(self.pack_path(old))
+        after = sum(os.path.getsize(self.pack_path(pack)) for pack in self.__packs())
+        return before - after
+
+    def clear(self):
+        db = self.__db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM entries')
+            # 之后写入新的缓存文件，不重新使用已删除文件的编号
+            old_packs = self.__packs()
+            self.__set_pack(db, max([self.__current_pack(db)] + old_packs) + 1)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        self.close_files()
+        for pack in old_packs:
+            os.remove(self.pack_path(pack))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='打包保存的下载缓存管理')
+    parser.add_argument('command', choices=['stats', 'compact', 'clear'], help='统计、整理或清除缓存')
+    parser.add_argument('directory', nargs='?', default='./temp/pack', help='缓存目录')
+    args = parser.parse_args(argv)
+    if not os.path.isfile(os.path.join(args.directory, 'index.sqlite')):
+        print('缓存目录不存在：' + args.directory)
+        return 1
+    cache = PackCache(args.directory)
+    if args.command == 'compact':
+        print('整理完成，释放 {:.1f} MB'.format(cache.compact() / 1024 / 1024))
+    elif args.command == 'clear':
+        cache.clear()
+        print('缓存已经清除')
+    count, size, total = cache.stats()
+    print('缓存数量: {}，有效内容: {:.1f} MB，文件大小: {:.1f} MB'.format(
+        count, size / 1024 / 1024, total / 1024 / 1024))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
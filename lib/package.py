@@ -0,0 +1,290 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import uuid
+import zlib
+import struct
+import zipfile
+import datetime
+from hashlib import md5, sha1, sha256
+
+try:
+    # 可选的 zlib-ng 压缩库，与 zlib 兼容但压缩速度更快
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
+# 可重复生成的电子书中所有文件使用的固定时间（ZIP格式支持的最早时间）
+FIXED_DATE = (1980, 1, 1, 0, 0, 0)
+FIXED_MTIME = datetime.datetime(*FIXED_DATE)
+# 大小、位置或文件数达到以下限制时使用 ZIP64 格式，原字段写入全部为 1 的值
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+
+def zip32(value):
+    # 返回写入 32 位字段的值，达到限制时为 0xFFFFFFFF，实际的值保存在 ZIP64 扩展字段中
+    return 0xFFFFFFFF if value >= ZIP64_LIMIT else value
+
+
+def stable_identifier(*sources):
+    # 根据书籍来源生成固定的标识符，相同来源的书籍每次生成的标识符都相同
+    name = '\n'.join(str(source) for source in sources)
+    return 'urn:uuid:' + str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+
+def file_digest(path):
+    sha = sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# 本身已经压缩过、再次压缩没有效果的媒体文件
+MEDIA_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.m4a', '.ogg',
+                    '.woff', '.woff2', '.zip'}
+# 按压缩级别压缩的文本文件
+TEXT_EXTENSIONS = {'.xhtml', '.html', '.htm', '.css', '.opf', '.ncx', '.xml', '.svg', '.js', '.txt'}
+
+
+class CompressionPolicy():
+    # 按文件类型选择压缩方式：已经压缩过的媒体文件直接保存，文本文件按 level 压缩，
+    # 其它文件先试压缩开头的部分数据，压缩效果不明显时直接保存；
+    # backend 为 zlib-ng 且已安装 zlib-ng 时使用更快的压缩库，未安装时使用 zlib 并记录在 fallback 中
+    SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self, level=6, store_media=True, backend='zlib'):
+        self.level = level
+        self.store_media = store_media
+        self.fallback = backend == 'zlib-ng' and zlib_ng is None
+        if self.fallback:
+            backend = 'zlib'
+        self.backend = backend
+        self.__zlib = zlib_ng if backend == 'zlib-ng' else zlib
+
+    @staticmethod
+    def category(name):
+        # 返回文件类型：mimetype、media、text 或 other
+        if name == 'mimetype':
+            return 'mimetype'
+        ext = os.path.splitext(name)[-1].lower()
+        if ext in MEDIA_EXTENSIONS:
+            return 'media'
+        if ext in TEXT_EXTENSIONS:
+            return 'text'
+        return 'other'
+
+    def __call__(self, name, data):
+        # 返回文件的 (压缩方式, 压缩级别)，mimetype 文件必须不压缩
+        category = self.category(name)
+        if category == 'mimetype' or (category == 'media' and self.store_media):
+            return zipfile.ZIP_STORED, 0
+        if category == 'other' and self.store_media and len(data) > self.SAMPLE_SIZE:
+            sample = data[:self.SAMPLE_SIZE]
+            if len(self.__zlib.compress(sample, 1)) > len(sample) * 0.95:
+                return zipfile.ZIP_STORED, 0
+        return zipfile.ZIP_DEFLATED, self.level
+
+    def compress(self, data, method, level):
+        if method == zipfile.ZIP_STORED:
+            return data
+        compressor = self.__zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+
+class PackageWriter():
+    # Epub压缩包写入器，按顺序写入 [(文件名, 内容), ...]。
+    # 指定 cache_dir 时在其中记录每个文件内容的哈希值，重新导出时内容及压缩参数都没有变化的文件
+    # 直接从上次生成的Epub文件中复制压缩后的数据，只压缩修改过的章节及目录文件。
+    LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+    CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+    END_RECORD = struct.Struct('<IHHHHIIH')
+    ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+    ZIP64_LOCATOR = struct.Struct('<IIQI')
+    ZIP64_EXTRA = struct.Struct('<HH')
+
+    def __init__(self, path, policy=None, deterministic=False, cache_dir=None):
+        self.path = path
+        self.policy = policy or CompressionPolicy()
+        self.deterministic = deterministic
+        self.cache_dir = cache_dir
+        self.reused = 0
+        self.compressed = 0
+        self.stats = {}
+
+    @property
+    def cache_path(self):
+        if not self.cache_dir:
+            return None
+        key = md5(os.path.abspath(self.path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def __load_cache(self):
+        # 读取上次导出时记录的文件哈希值，Epub文件在导出后被修改过时不使用缓存
+        path = self.cache_path
+        if not path or not os.path.isfile(path) or not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(path, mode='r', encoding='utf-8') as f:
+                cache = json.load(f)
+            stat = os.stat(self.path)
+            if cache.get('size') != stat.st_size or cache.get('mtime') != stat.st_mtime_ns:
+                return {}
+            with zipfile.ZipFile(self.path) as z:
+                infos = {info.filename: info for info in z.infolist()}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            return {}
+        entries = {}
+        for name, item in cache.get('entries', {}).items():
+            if name in infos:
+                entries[name] = (item, infos[name])
+        return entries
+
+    def __save_cache(self, entries):
+        path = self.cache_path
+        if not path:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stat = os.stat(self.path)
+        with open(path, mode='w', encoding='utf-8') as f:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'entries': entries}, f)
+
+    def __read_raw(self, f, info):
+        # 读取压缩包中文件压缩后的原始数据
+        f.seek(info.header_offset)
+        header = f.read(self.LOCAL_HEADER.size)
+        fields = self.LOCAL_HEADER.unpack(header)
+        if fields[0] != 0x04034b50:
+            raise zipfile.BadZipFile('文件头错误: ' + info.filename)
+        f.seek(info.header_offset + self.LOCAL_HEADER.size + fields[9] + fields[10])
+        return f.read(info.compress_size)
+
+    def __count(self, category, size, compressed, seconds):
+        stat = self.stats.setdefault(category, {'count': 0, 'size': 0, 'compressed': 0, 'seconds': 0.0})
+        stat['count'] += 1
+        stat['size'] += size
+        stat['compressed'] += compressed
+        stat['seconds'] += seconds
+
+    def report(self):
+        # 按文件类型统计压缩耗时及压缩率，reused 为直接复制的文件
+        lines = ['压缩方式: {} 级别 {}{}'.format(
+            self.policy.backend, self.policy.level, '，媒体文件不压缩' if self.policy.store_media else '')]
+        if self.policy.fallback:
+            lines.append('未安装 zlib-ng，已使用 zlib 压缩')
+        lines.append('{:<10}{:>8}{:>14}{:>14}{:>10}{:>12}{:>12}'.format(
+            '类型', '文件数', '原始(KB)', '压缩后(KB)', '压缩率', '耗时(ms)', 'MB/秒'))
+        for category, stat in sorted(self.stats.items()):
+            ratio = stat['compressed'] / stat['size'] if stat['size'] else 1
+            speed = stat['size'] / 1024 / 1024 / stat['seconds'] if stat['seconds'] else 0
+            lines.append('{:<10}{:>8}{:>14.1f}{:>14.1f}{:>10.1%}{:>12.1f}{:>12.1f}'.format(
+                category, stat['count'], stat['size'] / 1024, stat['compressed'] / 1024,
+                ratio, stat['seconds'] * 1000, speed))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, entries):
+        # 写入所有文件，返回是否写入了Epub文件（可重复生成模式下内容没有变化时不写入）
+        previous = self.__load_cache()
+        date_time = FIXED_DATE if self.deterministic else time.localtime()[:6]
+        dos_time = date_time[3] << 11 | date_time[4] << 5 | date_time[5] // 2
+        dos_date = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+        temp_path = self.path + '.tmp'
+        out = open(temp_path, 'wb')
+        sha = sha256()
+
+        def emit(data):
+            # 直接写入临时文件，同时计算整个文件的哈希值，不在内存中保存整个压缩包
+            out.write(data)
+            sha.update(data)
+
+        central = []
+        cache = {}
+        self.reused = self.compressed = 0
+        self.stats = {}
+        old = open(self.path, 'rb') if previous else None
+        try:
+            for name, data in entries:
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                method, level = self.policy(name, data)
+                digest = sha1(data).hexdigest()
+                item = {'sha1': digest, 'method': method, 'level': level, 'backend': self.policy.backend}
+                raw = None
+                if name in previous and previous[name][0] == item:
+                    info = previous[name][1]
+                    if info.compress_type == method and info.file_size == len(data):
+                        raw = self.__read_raw(old, info)
+                        crc = info.CRC
+                        self.reused += 1
+                        self.__count('reused', len(data), len(raw), 0.0)
+                if raw is None:
+                    start = time.perf_counter()
+                    raw = self.policy.compress(data, method, level)
+                    crc = zlib.crc32(data)
+                    self.compressed += 1
+                    self.__count(self.policy.category(name), len(data), len(raw), time.perf_counter() - start)
+                cache[name] = item
+
+                encoded = name.encode('utf-8')
+                flags = 0 if encoded.isascii() else 0x800
+                offset = out.tell()
+                # 超过 4GB 的大小或位置保存在 ZIP64 扩展字段中，原字段写入 0xFFFFFFFF
+                large = len(raw) >= ZIP64_LIMIT or len(data) >= ZIP64_LIMIT
+                local_extra = self.ZIP64_EXTRA.pack(0x0001, 16) + struct.pack('<QQ', len(data), len(raw)) \
+                    if large else b''
+                version = 45 if large else 20
+                emit(self.LOCAL_HEADER.pack(
+                    0x04034b50, version, flags, method, dos_time, dos_date, crc,
+                    0xFFFFFFFF if large else len(raw), 0xFFFFFFFF if large else len(data),
+                    len(encoded), len(local_extra)))
+                emit(encoded)
+                emit(local_extra)
+                emit(raw)
+                fields = [value for value in (len(data), len(raw), offset) if value >= ZIP64_LIMIT]
+                central_extra = self.ZIP64_EXTRA.pack(0x0001, len(fields) * 8) + \
+                    struct.pack('<%dQ' % len(fields), *fields) if fields else b''
+                version = 45 if fields else 20
+                central.append(self.CENTRAL_HEADER.pack(
+                    0x02014b50, 3 << 8 | version, version, flags, method, dos_time, dos_date, crc,
+                    zip32(len(raw)), zip32(len(data)), len(encoded),
+                    len(central_extra), 0, 0, 0, 0o100644 << 16, zip32(offset))
+                    + encoded + central_extra)
+            start = out.tell()
+            for record in central:
+                emit(record)
+            size = out.tell() - start
+            count = len(central)
+            large_count = count >= ZIP_MAX_ENTRIES
+            if large_count or size >= ZIP64_LIMIT or start >= ZIP64_LIMIT:
+                # 文件数或压缩包大小超过 ZIP 格式的限制时增加 ZIP64 结束记录及定位记录
+                position = out.tell()
+                emit(self.ZIP64_END_RECORD.pack(
+                    0x06064b50, self.ZIP64_END_RECORD.size - 12, 3 << 8 | 45, 45, 0, 0,
+                    count, count, size, start))
+                emit(self.ZIP64_LOCATOR.pack(0x07064b50, 0, position, 1))
+            emit(self.END_RECORD.pack(
+                0x06054b50, 0, 0, 0xFFFF if large_count else count, 0xFFFF if large_count else count,
+                zip32(size), zip32(start), 0))
+            length = out.tell()
+        except BaseException:
+            out.close()
+            os.remove(temp_path)
+            raise
+        finally:
+            if old:
+                old.close()
+        out.close()
+        # 可重复生成模式下内容没有变化时不替换原文件，保留原文件的修改时间以便同步工具跳过该文件
+        if self.deterministic and os.path.isfile(self.path) and os.path.getsize(self.path) == length \
+                and file_digest(self.path) == sha.hexdigest():
+            os.remove(temp_path)
+            written = False
+        else:
+            os.replace(temp_path, self.path)
+            written = True
+        self.__save_cache(cache)
+        return written
@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import io
+import time
+import pstats
+import cProfile
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+class Profiler():
+    # 记录电子书生成各阶段的耗时，可选同时采集 cProfile 及 tracemalloc 数据
+    def __init__(self, enabled=True, cprofile=False, memory=False, top=20):
+        self.enabled = enabled
+        self.top = top
+        self.__cprofile = cprofile
+        self.__memory = memory
+        self.__profile = None
+        self.reset()
+
+    def reset(self):
+        # 清除已经记录的数据并重新开始采集
+        self.__phases = {}
+        self.__chapters = {}
+        self.__notes = []
+        self.__frames = []     # 正在统计内存的阶段 [开始时的内存, 峰值]
+        self.__started = time.perf_counter()
+        if not self.enabled:
+            return
+        if self.__cprofile:
+            if self.__profile:
+                self.__profile.disable()
+            self.__profile = cProfile.Profile()
+            self.__profile.enable()
+        if self.__memory:
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+
+    def phase(self, name, key=None):
+        # 返回统计指定阶段耗时的上下文管理器，key 为对应章节的网址（没有网址时为章节文件名）
+        if not self.enabled:
+            return nullcontext()
+        return self.__measure(name, key)
+
+    @contextmanager
+    def __measure(self, name, key):
+        if self.__memory:
+            # 每个阶段开始时重置 tracemalloc 的峰值，重置前将峰值计入外层的阶段
+            current, peak = tracemalloc.get_traced_memory()
+            for frame in self.__frames:
+                frame[1] = max(frame[1], peak)
+            tracemalloc.reset_peak()
+            frame = [current, current]
+            self.__frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stat = self.__phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0, 'memory': 0})
+            stat['count'] += 1
+            stat['seconds'] += elapsed
+            stat['max'] = max(stat['max'], elapsed)
+            if self.__memory:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                self.__frames = [outer for outer in self.__frames if outer is not frame]
+                for outer in self.__frames:
+                    outer[1] = max(outer[1], peak)
+                stat['memory'] = max(stat['memory'], peak - frame[0])
+            if key is not None:
+                chapter = self.__chapters.setdefault(key, {})
+                chapter[name] = chapter.get(name, 0.0) + elapsed
+
+    def note(self, title, text):
+        # 在报告中附加其它统计信息
+        if self.enabled:
+            self.__notes.append((title, text))
+
+    @property
+    def phases(self):
+        return self.__phases
+
+    def slowest_chapters(self, count=None):
+        # 按总耗时倒序返回最慢的章节 [(章节, 总耗时, {阶段: 耗时}), ...]
+        result = sorted(((key, sum(stat.values()), stat) for key, stat in self.__chapters.items()),
+                        key=lambda x: x[1], reverse=True)
+        return result[:count or self.top]
+
+    def report(self):
+        # 生成文本格式的统计报告
+        out = io.StringIO()
+        total = time.perf_counter() - self.__started
+        out.write('总耗时: {:.3f} 秒\n\n'.format(total))
+
+        out.write('{:<20}{:>8}{:>12}{:>12}{:>12}{:>14}\n'.format(
+            '阶段', '次数', '总耗时(s)', '平均(ms)', '最长(ms)', '内存峰值(KB)'))
+        for name, stat in sorted(self.__phases.items(), key=lambda x: x[1]['seconds'], reverse=True):
+            out.write('{:<20}{:>8}{:>12.3f}{:>12.2f}{:>12.2f}{:>14}\n'.format(
+                name, stat['count'], stat['seconds'], stat['seconds'] / stat['count'] * 1000,
+                stat['max'] * 1000, '{:.1f}'.format(stat['memory'] / 1024) if self.__memory else '-'))
+
+        chapters = self.slowest_chapters()
+        if chapters:
+            out.write('\n最慢的 {} 个章节:\n'.format(len(chapters)))
+            for key, seconds, stat in chapters:
+                detail = ', '.join('{} {:.1f}ms'.format(name, value * 1000) for name, value in stat.items())
+                out.write('{:>10.2f}ms  {}  ({})\n'.format(seconds * 1000, key, detail))
+
+        for title, text in self.__notes:
+            out.write('\n{}:\n{}'.format(title, text))
+
+        if self.__profile:
+            self.__profile.disable()
+            out.write('\ncProfile (按累计耗时排序):\n')
+            stats = pstats.Stats(self.__profile, stream=out)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            self.__profile.enable()
+
+        if self.__memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            out.write('\ntracemalloc: 当前 {:.1f} KB, 峰值 {:.1f} KB\n'.format(current / 1024, peak / 1024))
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:self.top]:
+                out.write('{}\n'.format(stat))
+        return out.getvalue()
+
+    def save(self, file_path):
+        with open(file_path, mode='w', encoding='utf-8') as f:
+            f.write(self.report())
+
+    def stop(self):
+        # 停止 cProfile 及 tracemalloc 的数据采集
+        if self.__profile:
+            self.__profile.disable()
+            self.__profile = None
+        if self.__memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
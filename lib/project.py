@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import json
+import sqlite3
+
+
+class LazyContent():
+    # 保存在项目文件中的章节内容引用，需要时才从项目文件中读取
+    def __init__(self, project, content_id):
+        self.project = project
+        self.content_id = content_id
+
+    def load(self):
+        return self.project.load_content(self.content_id)
+
+
+class Project():
+    # 电子书项目文件，使用SQLite保存目录结构、书籍信息、样式表及章节内容，
+    # 打开项目时只读取目录结构，章节内容在需要时按需读取。
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS nodes (
+            id INTEGER PRIMARY KEY,
+            parent INTEGER,
+            title TEXT,
+            url TEXT,
+            content_id INTEGER,
+            anchors TEXT
+        );
+        CREATE TABLE IF NOT EXISTS contents (
+            id INTEGER PRIMARY KEY,
+            content TEXT
+        );
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.__conn = sqlite3.connect(path)
+        self.__conn.executescript(self.SCHEMA)
+        # 旧版本的项目文件没有章节书签
+        columns = [row[1] for row in self.__conn.execute('PRAGMA table_info(nodes)')]
+        if 'anchors' not in columns:
+            with self.__conn:
+                self.__conn.execute('ALTER TABLE nodes ADD COLUMN anchors TEXT')
+
+    def meta(self):
+        # 返回书籍信息字典
+        return dict(self.__conn.execute('SELECT key, value FROM meta'))
+
+    def nodes(self):
+        # 按目录顺序返回所有节点 [(节点ID, 父节点ID, 标题, 网址, LazyContent, 书签), ...]，
+        # 父节点ID为 None 表示顶层章节
+        cursor = self.__conn.execute(
+            'SELECT id, parent, title, url, content_id, anchors FROM nodes ORDER BY id')
+        return [(node_id, parent, title, url, LazyContent(self, content_id), json.loads(anchors or '[]'))
+                for node_id, parent, title, url, content_id, anchors in cursor]
+
+    def load_content(self, content_id):
+        row = self.__conn.execute(
+            'SELECT content FROM contents WHERE id = ?', (content_id,)).fetchone()
+        return row[0] if row else ''
+
+    def save(self, meta, nodes):
+        # 保存书籍信息及所有节点，nodes 为按目录顺序排列的 (父节点序号, 标题, 网址, 内容, 书签) 列表，
+        # 父节点序号是其在列表中的位置，None 表示顶层章节；内容可以是字符串或带有 load 方法的对象，
+        # 尚未读取的本项目内容不会重复写入。返回每个节点对应的 LazyContent 列表。
+        result = []
+        with self.__conn:
+            self.__conn.execute('DELETE FROM meta')
+            self.__conn.executemany(
+                'INSERT INTO meta (key, value) VALUES (?, ?)', meta.items())
+            self.__conn.execute('DELETE FROM nodes')
+            for node_id, (parent, title, url, content, anchors) in enumerate(nodes, 1):
+                if isinstance(content, LazyContent) and content.project is self:
+                    content_id = content.content_id
+                else:
+                    if hasattr(content, 'load'):
+                        content = content.load()
+                    content_id = self.__conn.execute(
+                        'INSERT INTO contents (content) VALUES (?)', (content or '',)).lastrowid
+                self.__conn.execute(
+                    'INSERT INTO nodes (id, parent, title, url, content_id, anchors) VALUES (?, ?, ?, ?, ?, ?)',
+                    (node_id, None if parent is None else parent + 1, title, url, content_id,
+                     json.dumps(anchors, ensure_ascii=False) if anchors else None))
+                result.append(LazyContent(self, content_id))
+            # 删除不再被引用的章节内容
+            self.__conn.execute(
+                'DELETE FROM contents WHERE id NOT IN (SELECT content_id FROM nodes)')
+        return result
+
+    def close(self):
+        self.__conn.close()
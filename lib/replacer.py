@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+
+# 需要替换的文本节点，不包括脚本、样式及网页标题中的文本
+_text_nodes = etree.XPath(
+    '//text()[not(ancestor::script or ancestor::style or ancestor::head)]', smart_strings=True)
+_document = re.compile(r'<html[\s>]', re.I)
+_parser = etree.HTMLParser()
+
+
+def compile_pattern(search, regex=False):
+    # 编译查找内容，普通文本与 QTextDocument.find 相同不区分大小写，正则表达式区分大小写，
+    # 正则表达式有误时抛出 re.error
+    if regex:
+        return re.compile(search)
+    return re.compile(re.escape(search), re.I)
+
+
+def _parse(content):
+    # 解析章节内容，返回 (文档根元素, 是否为完整网页)；章节片段放在 body 元素中解析
+    if _document.search(content):
+        return etree.fromstring(content, _parser), True
+    return etree.fromstring('<html><body>' + content + '</body></html>', _parser), False
+
+
+def _serialize(root, document):
+    if document:
+        doctype = root.getroottree().docinfo.doctype
+        return etree.tostring(root, method='html', encoding='unicode', doctype=doctype or None)
+    body = root.find('body')
+    if body is None:
+        return ''
+    # 与导入章节时相同按XML格式输出，只去掉外层的 body 标签
+    text = etree.tostring(body, encoding='unicode')
+    if text.endswith('/>'):
+        return ''
+    return text[text.index('>') + 1:text.rindex('</body>')]
+
+
+def _may_match(content, pattern, literal):
+    # 普通文本的查找内容不在网页源码中出现时，文本节点中也不可能出现，不需要解析网页
+    return not literal or '&' in content or pattern.search(content) is not None
+
+
+def _matched_nodes(content, pattern, literal):
+    # 返回 (文档根元素, 是否为完整网页, [包含匹配内容的文本节点, ...])
+    if not content or not _may_match(content, pattern, literal):
+        return None, False, []
+    try:
+        root, document = _parse(content)
+    except (etree.ParserError, etree.XMLSyntaxError, ValueError):
+        return None, False, []
+    if root is None:
+        return None, False, []
+    return root, document, [text for text in _text_nodes(root) if pattern.search(text)]
+
+
+def replace_html(content, pattern, replacement, literal=False):
+    # 只替换章节HTML内容的文本节点中的匹配内容，替换内容按原样插入，返回 (新内容, 替换次数)，
+    # 没有匹配时返回原内容不重新生成HTML
+    root, document, nodes = _matched_nodes(content, pattern, literal)
+    if not nodes:
+        return content, 0
+    total = 0
+    for text in nodes:
+        value, count = pattern.subn(lambda m: replacement, text)
+        total += count
+        if text.is_tail:
+            text.getparent().tail = value
+        else:
+            text.getparent().text = value
+    return _serialize(root, document), total
+
+
+def count_html(content, pattern, literal=False):
+    # 统计章节HTML内容的文本节点中的匹配次数
+    root, document, nodes = _matched_nodes(content, pattern, literal)
+    return sum(sum(1 for _ in pattern.finditer(text)) for text in nodes)
+
+
+def _replace_batch(args):
+    contents, pattern, replacement, literal = args
+    return [replace_html(content, pattern, replacement, literal) for content in contents]
+
+
+def _count_batch(args):
+    contents, pattern, literal = args
+    return [count_html(content, pattern, literal) for content in contents]
+
+
+class Replacer():
+    # 全书查找替换，整本书只编译一次查找内容，直接在章节HTML的文本节点上替换，
+    # 章节内容总量超过 parallel_size 时分批交给多个进程并行处理
+    parallel_size = 4 * 1024 * 1024
+    batch_size = 64
+
+    def __init__(self, search, replacement='', regex=False, workers=None):
+        self.pattern = compile_pattern(search, regex)
+        self.replacement = replacement
+        self.literal = not regex
+        self.workers = workers or os.cpu_count() or 1
+
+    def __map(self, func, contents, *args):
+        batches = [contents[i:i + self.batch_size] for i in range(0, len(contents), self.batch_size)]
+        if self.workers > 1 and len(batches) > 1 and \
+                sum(len(content) for content in contents) >= self.parallel_size:
+            # 使用 spawn 方式创建子进程，避免复制GUI程序的线程状态
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(batches)), mp_context=context) as executor:
+                results = executor.map(func, [(batch,) + args for batch in batches])
+                return [item for batch in results for item in batch]
+        return [item for batch in batches for item in func((batch,) + args)]
+
+    def count(self, contents):
+        # 预览替换结果，返回每个章节的匹配次数列表，不修改章节内容
+        return self.__map(_count_batch, list(contents), self.pattern, self.literal)
+
+    def replace(self, contents):
+        # 返回每个章节的 (新内容, 替换次数) 列表
+        return self.__map(_replace_batch, list(contents), self.pattern, self.replacement, self.literal)
@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import itertools
+import threading
+import traceback
+from urllib.parse import urlparse
+
+from lib.ebook import EBook
+from lib.cleaner import ContentCleaner
+from lib.downloader import Downloader
+from lib.extractor import TocExtractor, ChapterExtractor
+from lib.journal import CrawlJournal
+from lib.dedup import DuplicateDetector, chapter_signature
+
+
+class BookJob():
+    # 一本书的抓取任务，由任务文件中的一项配置生成：
+    #   {"name": 任务名称, "title": 书名, "author": 作者, "url": 目录网址, "referUrl": 来源网址,
+    #    "encoding": 网页编码, "priority": 优先级(越大越先执行), "cover": 封面, "output": Epub文件,
+    #    "selectors": {"group", "link", "menuPagination", "title", "content", "pagination"},
+    #    "cleaner": 与配置文件中相同的内容清理规则,
+    #    "dedup": 与配置文件中相同的近似重复章节检测规则}
+    def __init__(self, spec, output_dir='.'):
+        self.spec = spec
+        self.title = spec.get('title', '')
+        self.author = spec.get('author', '')
+        self.name = spec.get('name') or self.title or spec['url']
+        self.url = spec['url']
+        self.refer_url = spec.get('referUrl') or self.url
+        self.encoding = spec.get('encoding', 'auto')
+        self.priority = spec.get('priority', 0)
+        self.cover = spec.get('cover')
+        self.output = spec.get('output') or os.path.join(
+            output_dir, '{} - {}.epub'.format(self.author or '未知作者', self.title or '未命名书籍'))
+        self.selectors = spec.get('selectors', {})
+        self.cleaner = ContentCleaner.from_config(spec.get('cleaner'))
+        self.dedup = spec.get('dedup')
+        self.duplicates = []    # 生成电子书时发现的近似重复章节 [(章节标题, 网址, 相似的章节标题), ...]
+        self.lock = threading.Lock()
+        self.state = 'pending'
+        self.error = ''
+        self.chapter_list = []
+        self.results = {}
+        self.tasks = 0
+        self.finished_tasks = 0
+        self.held = 0
+        self.started = None
+        self.finished = None
+        self.journal = None
+
+    @property
+    def alive(self):
+        return self.state not in ('done', 'failed')
+
+    def fetch_chapter_list(self, fetch):
+        # 抓取目录生成章节列表，没有目录选择器或没有找到章节时整个网址作为一个章节
+        selectors = self.selectors
+        extractor = TocExtractor(group=selectors.get('group', ''), link=selectors.get('link', ''),
+                                 pagination=selectors.get('menuPagination', ''))
+        self.chapter_list = extractor.chapter_list(fetch, self.url, self.refer_url)
+        if not self.chapter_list:
+            self.chapter_list = [{'title': self.title, 'realUrl': self.url, 'referUrl': self.refer_url}]
+        return self.chapter_list
+
+    def chapter_tasks(self, items=None, prefix=''):
+        # 按目录顺序返回所有章节的 [(编号, 章节数据), ...]，卷标题没有内容不需要抓取
+        tasks = []
+        for i, item in enumerate(self.chapter_list if items is None else items):
+            source = '{}{}'.format(prefix, i)
+            if item.get('child'):
+                tasks.extend(self.chapter_tasks(item['child'], source + '/'))
+            else:
+                tasks.append((source, item))
+        return tasks
+
+    def journal_key(self):
+        # 输出文件不同的任务即使抓取参数相同也使用各自的日志
+        selectors = self.selectors
+        return CrawlJournal.make_key(os.path.abspath(self.output), self.chapter_list, self.encoding,
+                                     selectors.get('title', ''), selectors.get('content', ''),
+                                     selectors.get('pagination', ''),
+                                     self.cleaner.signature if self.cleaner else None)
+
+    def extract_chapter(self, fetch, item, on_page=None):
+        # 抓取一个章节的所有分页，返回 [(标题, 内容HTML, 网址), ...]
+        selectors = self.selectors
+        extractor = ChapterExtractor(title=selectors.get('title', ''), content=selectors.get('content', ''),
+                                     pagination=selectors.get('pagination', ''), cleaner=self.cleaner)
+        return list(extractor.chapters(fetch, item, on_page=on_page))
+
+    def __add_items(self, target, items, results, detector, prefix=''):
+        for i, item in enumerate(items):
+            source = '{}{}'.format(prefix, i)
+            if item.get('child'):
+                section = target.add_section(title=item['title'])
+                self.__add_items(section, item['child'], results, detector, source + '/')
+            else:
+                for title, content, url in results.get(source, []):
+                    if detector is not None:
+                        # 按目录顺序与之前的章节比较，近似重复的章节只记录或跳过
+                        match = detector.add((len(detector), title), chapter_signature(content))
+                        if match is not None:
+                            self.duplicates.append((title, url, match[1]))
+                            if detector.skip:
+                                continue
+                    target.add_chapter(title=title, content=content or '<p></p>', url=url)
+
+    def build(self, results, downloader=None, fetch_many=None):
+        # 按目录顺序生成电子书，results 为 {章节编号: [(标题, 内容HTML, 网址), ...]}
+        book = EBook(title=self.title, author=self.author or None)
+        if downloader:
+            book.downloader = downloader
+        if fetch_many:
+            book.fetch_many = fetch_many
+        book.source = self.url
+        if self.cover:
+            book.set_cover(self.cover)
+        self.duplicates = []
+        self.__add_items(book, self.chapter_list, results, DuplicateDetector.from_config(self.dedup))
+        os.makedirs(os.path.dirname(os.path.abspath(self.output)), exist_ok=True)
+        book.save_as(self.output)
+        return self.output
+
+    def status(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'priority': self.priority,
+            'chapters': self.tasks,
+            'finished': self.finished_tasks,
+            'duplicates': len(self.duplicates),
+            'output': self.output,
+            'error': self.error,
+            'started': self.started,
+            'finished_at': self.finished,
+        }
+
+
+class HostLimiter():
+    # 限制每个网站每秒的请求次数，rate 为 0 时不限制
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self.__next = {}
+        self.__lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        if not self.interval or not host:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            slot = max(now, self.__next.get(host, 0))
+            self.__next[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BatchScheduler():
+    # 多本书的批量抓取调度器，所有书籍的目录、章节及图片下载任务放在同一个优先级队列中交替执行：
+    #   connections  同时进行的网络请求总数
+    #   host_rate    每个网站每秒的请求次数
+    #   cpu_workers  同时解析网页、生成及压缩Epub文件的任务数
+    #   memory_limit 正在抓取的书籍已提取章节内容的总大小(字节)，超过时暂停开始新的书籍
+    #   max_jobs     同时抓取的书籍数量，默认与连接数相同
+    # 每本书的任务失败时只标记该书籍失败，不影响其它书籍；每本书的状态保存在 status_dir 中的JSON文件，
+    # 已完成的章节记录在抓取日志中，重新运行时从中断的位置继续。
+    def __init__(self, connections=8, host_rate=2.0, cpu_workers=None, memory_limit=1024 * 1024 * 1024,
+                 max_jobs=None, status_dir='./temp/status', journal_dir='./temp/journal', downloader=None):
+        self.connections = connections
+        self.max_jobs = max_jobs or connections
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.memory_limit = memory_limit
+        self.status_dir = status_dir
+        self.journal_dir = journal_dir
+        self.downloader = downloader or Downloader.shared()
+        self.limiter = HostLimiter(host_rate)
+        self.jobs = []
+        self.__connections = threading.Semaphore(connections)
+        self.__cpu = threading.Semaphore(self.cpu_workers)
+        self.__queue = queue.PriorityQueue()
+        self.__order = itertools.count()
+        self.__lock = threading.Lock()
+        self.__waiting = []
+        self.__running = []
+        self.__held = 0
+        self.__saved = {}
+        self.__status_lock = threading.Lock()
+
+    def add(self, job):
+        if not isinstance(job, BookJob):
+            job = BookJob(job)
+        # 输出到同一个文件的任务会互相覆盖电子书及抓取日志
+        output = os.path.abspath(job.output)
+        if any(os.path.abspath(other.output) == output for other in self.jobs):
+            raise ValueError('重复的输出文件：' + job.output)
+        self.jobs.append(job)
+        return job
+
+    def fetch(self, url, encoding=None):
+        # 在全局连接数及网站请求频率限制下下载网页或图片
+        self.limiter.wait(url)
+        with self.__connections:
+            return self.downloader.get(url, encoding=encoding) if encoding else self.downloader.get(url)
+
+    def fetch_many(self, urls):
+        # EBook 批量下载图片，与章节下载任务使用同一组限制
+        results = [None] * len(urls)
+        threads = []
+
+        def fetch(i, url):
+            try:
+                results[i] = self.fetch(url)
+            except Exception:
+                results[i] = None
+        for i, url in enumerate(urls):
+            thread = threading.Thread(target=fetch, args=(i, url), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def __parsing_fetch(self, encoding=None):
+        # 解析网页及生成电子书时占用解析名额，其中下载网页或图片时暂时释放名额
+        def fetch(url):
+            self.__cpu.release()
+            try:
+                return self.fetch(url, encoding)
+            finally:
+                self.__cpu.acquire()
+        return fetch
+
+    def __parsing_fetch_many(self, urls):
+        self.__cpu.release()
+        try:
+            return self.fetch_many(urls)
+        finally:
+            self.__cpu.acquire()
+
+    def __put(self, job, kind, *args):
+        self.__queue.put((-job.priority, next(self.__order), job, kind, args))
+
+    def __save_status(self, job, force=False):
+        # 保存书籍状态，抓取章节时每本书每秒最多保存一次；
+        # 书籍名称可能相同，状态文件按唯一的输出文件区分
+        output = os.path.abspath(job.output)
+        with self.__status_lock:
+            now = time.monotonic()
+            if not force and now - self.__saved.get(output, 0) < 1:
+                return
+            self.__saved[output] = now
+            os.makedirs(self.status_dir, exist_ok=True)
+            path = os.path.join(self.status_dir, CrawlJournal.make_key(output) + '.json')
+            with open(path + '.tmp', mode='w', encoding='utf-8') as f:
+                json.dump(job.status(), f, ensure_ascii=False, indent=4)
+            os.replace(path + '.tmp', path)
+
+    def __admit(self):
+        # 按优先级开始新的书籍，已提取的内容超过内存上限时等待正在抓取的书籍完成
+        with self.__lock:
+            while self.__waiting and (not self.__running or (
+                    len(self.__running) < self.max_jobs and self.__held < self.memory_limit)):
+                job = self.__waiting.pop(0)
+                job.state = 'running'
+                job.started = time.time()
+                self.__running.append(job)
+                self.__put(job, 'toc')
+                self.__save_status(job, force=True)
+
+    def __finish(self, job, state, error=''):
+        with self.__lock:
+            if not job.alive:
+                return
+            job.state = state
+            job.error = error
+            job.finished = time.time()
+            self.__running.remove(job)
+            self.__held -= job.held
+            job.held = 0
+            job.results = {}
+            if job.journal:
+                job.journal.close()
+                if state == 'done':
+                    job.journal.remove()
+            self.__save_status(job, force=True)
+            last = not self.__running and not self.__waiting
+        if last:
+            for i in range(self.connections + self.cpu_workers):
+                self.__queue.put((float('inf'), next(self.__order), None, None, ()))
+        else:
+            self.__admit()
+
+    def __run_toc(self, job):
+        with self.__cpu:
+            job.fetch_chapter_list(self.__parsing_fetch(job.encoding))
+        job.journal = CrawlJournal(os.path.join(self.journal_dir, job.journal_key() + '.jsonl'), sync=False).load()
+        tasks = job.chapter_tasks()
+        job.tasks = len(tasks)
+        for source, item in tasks:
+            if job.journal.is_done(source):
+                self.__store(job, source, job.journal.chapters(source), record=False)
+            else:
+                self.__put(job, 'chapter', source, item)
+        self.__check_complete(job)
+
+    def __run_chapter(self, job, source, item):
+        with self.__cpu:
+            chapters = job.extract_chapter(self.__parsing_fetch(job.encoding), item)
+        self.__store(job, source, chapters)
+        self.__check_complete(job)
+
+    def __store(self, job, source, chapters, record=True):
+        size = sum(len(content) for title, content, url in chapters)
+        with job.lock:
+            if not job.alive:
+                return
+            if record:
+                job.journal.begin(source)
+                for title, content, url in chapters:
+                    job.journal.add_chapter(source, title, content, url)
+                job.journal.finish(source)
+            job.results[source] = chapters
+            job.finished_tasks += 1
+            job.held += size
+        with self.__lock:
+            self.__held += size
+        self.__save_status(job)
+
+    def __check_complete(self, job):
+        with job.lock:
+            ready = job.alive and job.state == 'running' and job.finished_tasks == job.tasks
+            if ready:
+                job.state = 'building'
+        if ready:
+            self.__put(job, 'build')
+
+    def __run_build(self, job):
+        with self.__cpu:
+            job.build(job.results, self.__parsing_fetch(), self.__parsing_fetch_many)
+        self.__finish(job, 'done')
+
+    def __worker(self):
+        while True:
+            priority, order, job, kind, args = self.__queue.get()
+            if job is None:
+                return
+            if not job.alive:
+                continue
+            try:
+                if kind == 'toc':
+                    self.__run_toc(job)
+                elif kind == 'chapter':
+                    self.__run_chapter(job, *args)
+                elif kind == 'build':
+                    self.__run_build(job)
+            except Exception as e:
+                traceback.print_exc()
+                self.__finish(job, 'failed', '{}: {}'.format(type(e).__name__, e))
+
+    def run(self):
+        # 执行所有书籍的任务，全部完成后返回每本书的状态列表
+        if not self.jobs:
+            return []
+        self.__waiting = sorted(self.jobs, key=lambda job: -job.priority)
+        for job in self.jobs:
+            self.__save_status(job, force=True)
+        # 下载线程数量为连接数与解析名额之和，等待网站请求间隔的线程不会阻塞其它任务
+        workers = [threading.Thread(target=self.__worker, daemon=True)
+                   for i in range(self.connections + self.cpu_workers)]
+        for worker in workers:
+            worker.start()
+        self.__admit()
+        for worker in workers:
+            worker.join()
+        return [job.status() for job in self.jobs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='批量抓取生成多本Epub电子书')
+    parser.add_argument('jobs', help='任务文件(JSON格式的书籍任务列表)')
+    parser.add_argument('--output-dir', default='.', help='未指定 output 的书籍保存目录')
+    parser.add_argument('--connections', type=int, default=8, help='同时进行的网络请求总数')
+    parser.add_argument('--host-rate', type=float, default=2.0, help='每个网站每秒的请求次数，0 为不限制')
+    parser.add_argument('--cpu', type=int, default=None, help='同时解析及生成电子书的任务数')
+    parser.add_argument('--memory', type=int, default=1024, help='已提取章节内容的内存上限(MB)')
+    parser.add_argument('--max-jobs', type=int, default=None, help='同时抓取的书籍数量')
+    parser.add_argument('--status-dir', default='./temp/status', help='保存每本书状态的目录')
+    args = parser.parse_args(argv)
+    with open(args.jobs, mode='r', encoding='utf-8') as f:
+        specs = json.load(f)
+    scheduler = BatchScheduler(connections=args.connections, host_rate=args.host_rate, cpu_workers=args.cpu,
+                               memory_limit=args.memory * 1024 * 1024, max_jobs=args.max_jobs,
+                               status_dir=args.status_dir)
+    for spec in specs:
+        try:
+            scheduler.add(BookJob(spec, args.output_dir))
+        except ValueError as e:
+            print(e)
+            return 1
+    failed = 0
+    for status in scheduler.run():
+        print('{:<8}{}  {}/{}  {}'.format(status['state'], status['name'], status['finished'],
+                                          status['chapters'], status['error']))
+        failed += status['state'] != 'done'
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())